@@ -2,28 +2,287 @@
 # Preprocess markdown files in a directory before passing to Hugo
 
 import os
+import sys
 import shutil
-
-# pip install python-frontmatter
-import frontmatter
-from io import BytesIO
+import hashlib
+import json
+import time
+import pickle
+import sqlite3
+import logging
+import argparse
+import itertools
+import contextlib
+import difflib
+import concurrent.futures
+
+from io import StringIO
 import re
+import posixpath
+import urllib.parse
 
 import yaml
 
-print("Obsigo v0.2 - Preprocess Obsidian markdown files for Hugo")
+from obsigo_assets import sync_assets_directory, prune_assets_directories, ASSETS_COPY_MODES
+from obsigo_images import normalize_images, generate_image_variants, VARIANT_EXTENSIONS, VARIANT_FORMATS
+from obsigo_redirects import compile_redirects, normalize_alias, normalize_path, split_path
+from obsigo_data import write_data_files, normalize_tag
+from obsigo_rules import compile_rewrite_rules, rules_scanner_pattern, index_rules, match_rules, expand_rule
+from obsigo_audit import write_audit_report, get_external_urls, check_urls
+from obsigo_scan import scan_source_directory, load_ignore_patterns, is_ignored
+from obsigo_db import open_index, update_index, get_historical_aliases, query_index, format_rows, QUERY_KINDS
+
+# Use the libyaml bindings when available (much faster than the pure Python loader & dumper)
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# Version of the manifest format. Bump it whenever the conversion output changes so that incremental runs rebuild
+# everything once.
+MANIFEST_VERSION = 6
+
+OBSIGO_VERSION = "0.2"
+
+logger = logging.getLogger('obsigo')
+
+
+# Frontmatter of a markdown document: `---` line, YAML header, `---` line
+FRONTMATTER_RE = re.compile(r'-{3,}[ \t]*\r?\n(?P<header>.*?)^-{3,}[ \t]*\r?$', re.DOTALL | re.MULTILINE)
+
+# First and last lines of a frontmatter, read line by line (see read_frontmatter())
+FRONTMATTER_START_RE = re.compile(r'-{3,}[ \t]*\r?\n\Z')
+FRONTMATTER_END_RE = re.compile(r'-{3,}[ \t]*\r?\n?\Z')
+
+# Line starting a top level key in a YAML header (plain or quoted key)
+YAML_TOP_LEVEL_KEY_RE = re.compile(r"""(?:"(?P<dq_key>[^"]*)"|'(?P<sq_key>[^']*)'|(?P<key>[^\s#'"\-\[\]{}?:,&*!|>%@`][^:#]*?))[ \t]*:(?:[ \t]|\r?$)""")
+
+# Blank or comment line in a YAML header
+YAML_BLANK_LINE_RE = re.compile(r'[ \t]*(#.*)?\r?$')
+
+
+# Serialize a YAML header from scratch:
+def dump_yaml(data):
+    return yaml.dump(data, Dumper=YamlDumper, default_flow_style=False, allow_unicode=True, sort_keys=False)
+
+
+# Split a markdown document into its frontmatter and its content.
+# Returns a dict with:
+# - 'text': the whole document
+# - 'header': the original YAML text of the frontmatter (None if there is no frontmatter)
+# - 'header_start', 'header_end': position of the YAML text in 'text'
+# - 'metadata': the parsed frontmatter
+# - 'content': the content after the frontmatter (stripped)
+# `parsed_headers` are the YAML headers already parsed by a batch (see parse_yaml_header()).
+def load_markdown(text, parsed_headers=None):
+    document = {
+        'text': text,
+        'header': None,
+        'header_start': None,
+        'header_end': None,
+        'metadata': {},
+        'content': text.strip(),
+    }
+    offset = len(text) - len(text.lstrip())
+    match = FRONTMATTER_RE.match(text, offset)
+    if match is None:
+        return document
+
+    document['header'] = match.group('header')
+    document['header_start'] = match.start('header')
+    document['header_end'] = match.end('header')
+    metadata = parse_yaml_header(document['header'], parsed_headers)
+    if isinstance(metadata, dict):
+        document['metadata'] = metadata
+    document['content'] = text[match.end():].strip()
+    return document
+
+
+# Frontmatter of a markdown file, without reading its content (same result as load_markdown()['metadata']):
+def read_frontmatter(file_path, parsed_headers=None):
+    lines = []
+    with open(file_path, 'r', encoding='utf-8', newline='') as input_file:
+        for line in input_file:
+            if not lines:
+                # (the frontmatter can follow blank lines)
+                if not line.strip():
+                    continue
+                if not FRONTMATTER_START_RE.match(line.lstrip()):
+                    return {}
+            elif FRONTMATTER_END_RE.match(line):
+                metadata = parse_yaml_header(''.join(lines[1:]), parsed_headers)
+                return metadata if isinstance(metadata, dict) else {}
+            lines.append(line)
+    return {}
+
+
+# Parse a YAML header (from the parsed headers of the batch when it was already parsed):
+# `parsed_headers` is {header text: pickled metadata}, None when not running a batch (the vaults of the sites of a
+# batch overlap: a note they share is only parsed once per process, unpickling the metadata is much faster than
+# parsing the YAML again)
+def parse_yaml_header(header, parsed_headers=None):
+    if parsed_headers is None:
+        return yaml.load(header, Loader=YamlLoader)
+    cached = parsed_headers.get(header)
+    if cached is not None:
+        return pickle.loads(cached)
+    metadata = yaml.load(header, Loader=YamlLoader)
+    parsed_headers[header] = pickle.dumps(metadata, pickle.HIGHEST_PROTOCOL)
+    return metadata
+
+
+# Split a YAML header into blocks, one for each top level key, plus blocks of blank/comment lines.
+# Returns a list of (key, text) with key None for blank/comment blocks, or None if the header can't be split safely.
+def split_yaml_header(header):
+    blocks = []
+    for line in header.splitlines(keepends=True):
+        match = YAML_TOP_LEVEL_KEY_RE.match(line)
+        if match:
+            key = match.group('key') or match.group('dq_key') or match.group('sq_key') or ''
+            blocks.append([key, line])
+        elif blocks:
+            blocks[-1][1] += line
+        else:
+            blocks.append([None, line])
+
+    # Trailing blank/comment lines don't belong to the value of the key before them:
+    split_blocks = []
+    for key, text in blocks:
+        lines = text.splitlines(keepends=True)
+        trailing = []
+        while key is not None and len(lines) > 1 and YAML_BLANK_LINE_RE.match(lines[-1]):
+            trailing.insert(0, lines.pop())
+        split_blocks.append((key, ''.join(lines)))
+        if trailing:
+            split_blocks.append((None, ''.join(trailing)))
+    return split_blocks
+
+
+# Get the frontmatter to write for a document whose metadata may have been changed:
+# The original YAML text is kept for all the keys that didn't change, only the changed or new keys are serialized
+# again (key order, quoting and comments are preserved). Falls back to serializing the whole metadata when the
+# original header can't be patched safely.
+def render_frontmatter(document, metadata, metadata_changed):
+    header = document['header']
+    if header is not None and not metadata_changed:
+        return header
+
+    if header is not None:
+        old_metadata = yaml.load(header, Loader=YamlLoader)
+        blocks = split_yaml_header(header)
+        if isinstance(old_metadata, dict):
+            old_keys = {str(key): key for key in old_metadata}
+            block_keys = [key for key, text in blocks if key is not None]
+            if len(block_keys) == len(set(block_keys)) and set(block_keys) == set(old_keys):
+                new_header = ''
+                for key, text in blocks:
+                    if key is None:
+                        new_header += text
+                        continue
+                    key = old_keys[key]
+                    if key not in metadata:
+                        # Key was removed
+                        continue
+                    value = metadata[key]
+                    if value == old_metadata[key] and type(value) is type(old_metadata[key]):
+                        new_header += text
+                    else:
+                        if not new_header.endswith('\n') and new_header:
+                            new_header += '\n'
+                        new_header += dump_yaml({key: value})
+                for key, value in metadata.items():
+                    if key not in old_metadata:
+                        if not new_header.endswith('\n') and new_header:
+                            new_header += '\n'
+                        new_header += dump_yaml({key: value})
+                return new_header
+
+    return dump_yaml(metadata) if metadata else ''
+
+
+# Build the text of a markdown file from its frontmatter and its content:
+def dump_markdown(header, content):
+    return f"---\n{header.strip(chr(10))}\n---\n\n{content}"
+
+
+# Build the new text of a source document with a new frontmatter and possibly a new content:
+# Everything else is kept byte for byte.
+def update_markdown(document, header, content):
+    text = document['text']
+    if document['header'] is None:
+        return dump_markdown(header, content)
+
+    if header and not header.endswith('\n'):
+        header += '\n'
+    new_text = text[:document['header_start']] + header
+    if content == document['content']:
+        # Keep the content as is (including its surrounding whitespace)
+        new_text += text[document['header_end']:]
+    else:
+        closing_end = FRONTMATTER_RE.match(text, len(text) - len(text.lstrip())).end()
+        new_text += text[document['header_end']:closing_end] + '\n\n' + content
+    return new_text
+
+
+# Aliases listed in the frontmatter (a copy, always a list):
+def get_metadata_aliases(metadata):
+    aliases = metadata.get('aliases')
+    if aliases is None:
+        return []
+    # make sure it is a list
+    if not isinstance(aliases, list):
+        return [aliases]
+    return aliases.copy()
+
+
+# Tags of a page: the `tags` of the frontmatter and the #hashtags of the content, normalized (see obsigo_data.py)
+def get_page_tags(metadata, hashtags):
+    tags = metadata.get('tags') or []
+    if not isinstance(tags, list):
+        tags = [tags]
+    return sorted({normalize_tag(tag) for tag in tags + hashtags} - {''})
+
+
+# Images of a page: the cover images of the frontmatter and the images of the content, as URLs of the Hugo content
+def get_page_images(metadata, content_images):
+    images = [metadata.get('cover_img')]
+    if isinstance(metadata.get('cover'), dict):
+        images.append(metadata['cover'].get('image'))
+    return list(dict.fromkeys(str(image) for image in images + content_images if image))
+
+
+# Main slug of a page: the last directory for an index.md (None for the home page), the filename otherwise
+# (can be an article, can also be search.md)
+def get_main_slug(rel_src_filepath):
+    split_path = rel_src_filepath.split('/')
+    if split_path[-1] == 'index.md' or split_path[-1] == '_index.md':
+        # We are in a sub directory if we have a parent:
+        if len(split_path) >= 2:
+            return split_path[-2]
+        return None
+    return re.sub(r'\.md$', '', split_path[-1])
+
+
+# Canonical URI of a page from its destination path:
+def get_canonical_uri(rel_dest_filepath):
+    # remove /_?index.md$ from the end of the canonical_uri:
+    canonical_uri = re.sub(r'/_?index\.md$', '/', '/'+rel_dest_filepath)
+    # If there is still a trailing .md, remove it (can happen for search.md for example)
+    canonical_uri = re.sub(r'\.md$', '/', canonical_uri)
+    return canonical_uri
+
 
 # Process the frontmatter of the markdown file.
+# Fills `page_info` with what this page contributes to the site (canonical URI, aliases, draft status)
+# `unimportant_frontmatter_keys` (from the config) are removed from the source.
 # TODO: converts tags with spaces to tags with hyphens
-def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_aliases_dict, stats_dict ):
+def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, page_info, stats_dict, unimportant_frontmatter_keys=()):
     source_changed = False      # Source data has not changed yet
 
-    print("  FRONTMATTER:")
+    logger.debug("  FRONTMATTER:")
 
     # Cleanup/Remove unimportant keys:
     for key in unimportant_frontmatter_keys:
         if key in src_metadata:
-            print(f"    CLEANUP: Removing unimportant key from source '{key}: {src_metadata[key]}")
+            logger.debug(f"    CLEANUP: Removing unimportant key from source '{key}: {src_metadata[key]}")
             del src_metadata[key]
             source_changed = True
             stats_dict['frontmatter_source_cleanups'] += 1
@@ -31,7 +290,7 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
 
     # Remove 'visibility' key if its value is 'published'
     if 'visibility' in src_metadata and src_metadata['visibility'] == 'published':
-        print(f"    CLEANUP: Removing key 'visibility': {src_metadata['visibility']}")
+        logger.debug(f"    CLEANUP: Removing key 'visibility': {src_metadata['visibility']}")
         del src_metadata['visibility']
         source_changed = True
         stats_dict['frontmatter_source_cleanups'] += 1
@@ -44,55 +303,31 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
     # ---
 
     # Collect aliases:
-    if 'aliases' in src_metadata:
-        # Make a copy of the aliases
-        post_collected_aliases = src_metadata['aliases'].copy()
-        # make sure it is a list
-        if not isinstance(post_collected_aliases, list):
-            post_collected_aliases = [post_collected_aliases]
-        stats_dict['aliases_collected'] += len(post_collected_aliases)
-    else:
-        post_collected_aliases = []
+    post_collected_aliases = get_metadata_aliases(src_metadata)
+    stats_dict['aliases_collected'] += len(post_collected_aliases)
     # print(f"  Collected Aliases: {post_collected_aliases}")
 
-    # Also add the last directory of the file path (not the filename) as an alias
-    split_path = rel_src_filepath.split('/')
-    # print( f"  Split path: {split_path} {len(split_path)}")
-    if split_path[-1] == 'index.md' or split_path[-1] == '_index.md':
-        # We are in a sub directory if we have a parent:
-        if len(split_path) >= 2:
-            # we have a parent: add the last directory of the file path (not the filename) as an alias
-            main_slug = split_path[-2]
-            post_collected_aliases.append(main_slug)
-            stats_dict['slugs_collected'] += 1
-            print(f"    CONTENT SUBDIR - Adding last directory '{main_slug}' as an alias.")
-        else:
-            # no parent
-            main_slug = None
-    else:
-        # We have a file name, not an `index.md` file
-        # Use the last part of the file path as the main slug
-        # remove .md from the end of the folder_name
-        # Can be an article, can also be search.md
-        main_slug = re.sub(r'\.md$', '', split_path[-1])
+    # Also add the main slug (last directory of an index.md, or filename) as an alias
+    main_slug = get_main_slug(rel_src_filepath)
+    if main_slug is not None:
         post_collected_aliases.append(main_slug)
         stats_dict['slugs_collected'] += 1
-        print(f"    NAMED MD - Adding last directory '{main_slug}' as an alias.")
+        logger.debug(f"    {'CONTENT SUBDIR' if rel_src_filepath.endswith('index.md') else 'NAMED MD'} - Adding '{main_slug}' as an alias.")
 
-    print(f"    SLUG: Main slug: {main_slug}" )
-    print(f"    ALIASES: Collected Aliases: {post_collected_aliases}")
+    logger.debug(f"    SLUG: Main slug: {main_slug}" )
+    logger.debug(f"    ALIASES: Collected Aliases: {post_collected_aliases}")
 
     # --
 
     # Fix 'slug:' in source if necessary:
     if main_slug is None:
         # root _index.md, do nothing
-        print( "      Home page, no slug needed.")
+        logger.debug("      Home page, no slug needed.")
         pass
 
     elif 'slug' not in src_metadata:
         # No 'slug', let's add it:
-        print(f"      Adding missing slug to source: '{main_slug}'")
+        logger.debug(f"      Adding missing slug to source: '{main_slug}'")
         src_metadata['slug'] = main_slug
         source_changed = True
         stats_dict['missing_slugs_fixed'] += 1
@@ -101,13 +336,15 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
         # Also add the slug as an alias if it's different from the main slug extracted from the file path
         # DIVERGENT slug found!
         # We need to roll the slugs:
-        print(f"      Divergent slugs found: '{src_metadata['slug']}' != '{main_slug}'")
+        logger.debug(f"      Divergent slugs found: '{src_metadata['slug']}' != '{main_slug}'")
         # Old slug must become an alias:
         post_collected_aliases.append(src_metadata['slug'])
         stats_dict['divergent_slugs_fixed'] += 1    # Old slug becomes an alias and filename becomes new slug
         # add to the original aliasses if not already there:
-        if not 'aliases' in src_metadata:
+        if src_metadata.get('aliases') is None:
             src_metadata['aliases'] = []
+        elif not isinstance(src_metadata['aliases'], list):
+            src_metadata['aliases'] = [src_metadata['aliases']]
         if src_metadata['slug'] not in src_metadata['aliases']:
             src_metadata['aliases'].append(src_metadata['slug'])
         # the new slug must become the canoncial slug:
@@ -117,33 +354,13 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
     # ---
 
     # Build page URI:
+    canonical_uri = get_canonical_uri(rel_dest_filepath)
 
-    # remove /_?index.md$ from the end of the canonical_uri:
-    # print( f"    Relative file path: {rel_dest_filepath}")
-    canonical_uri = re.sub(r'/_?index\.md$', '/', '/'+rel_dest_filepath)
-    # print( f"    canonical_uri: {canonical_uri}")
-    # If there is still a trailing .md, remove it (can happen for search.md for example)
-    canonical_uri = re.sub(r'\.md$', '/', canonical_uri)
-    # print( f"    canonical_uri: {canonical_uri}")
-
-    # Build redirects: (site aliases)
-
-    for alias in post_collected_aliases:
-        # Make sure alias is a string
-        alias = str(alias)
-        # Keep only the last part of the alias --> NO, we actually want to handle aliases like STMag/index.html
-        # alias = alias.split('/')[-1]
-
-        if alias in site_aliases_dict:
-            print(f"!!!WARNING!!! Alias '{alias}' already exists in the dictionary.")
-            stats_dict['foreverlinks_conflicts_detected'] += 1
-        else:
-            if draft:
-                print(f"    NOT ADDING alias {alias}->{canonical_uri} because it's a draft.")
-            else:
-                site_aliases_dict[alias] = canonical_uri
-                print(f"    Added alias {alias}->{canonical_uri} to the dictionary.")
-                stats_dict['foreverlinks_collected'] += 1
+    # Remember what this page contributes to the site aliases.
+    # They are added to the site aliases dictionary by add_site_aliases(), which can also replay them from the manifest.
+    page_info['canonical_uri'] = canonical_uri
+    page_info['aliases'] = [str(alias) for alias in post_collected_aliases]
+    page_info['draft'] = bool(draft)
 
 
     # ---
@@ -155,12 +372,12 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
             for i, tag in enumerate(tags):
                 # Convert tags with spaces to tags with hyphens
                 if ' ' in tag:
-                    print(f"    TAGS: Converting tag '{tag}' to '{tag.replace(' ', '-')}'")
+                    logger.debug(f"    TAGS: Converting tag '{tag}' to '{tag.replace(' ', '-')}'")
                     tags[i] = tag.replace(' ', '-')
                     source_changed = True
                 # Remove `#` character from tags
                 if '#' in tag:
-                    print(f"    TAGS: Removing '#' from tag '{tag}'")
+                    logger.debug(f"    TAGS: Removing '#' from tag '{tag}'")
                     tags[i] = tag.replace('#', '')
                     source_changed = True
             src_metadata['tags'] = tags
@@ -172,14 +389,14 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
         cover_img = src_metadata['cover_img']
         if cover_img is not None:
             if cover_img.endswith('.heic'):
-                print(f"    COVER: Converting cover_img:'{cover_img}' to JPEG")
+                logger.debug(f"    COVER: Converting cover_img:'{cover_img}' to JPEG")
                 src_metadata['cover_img'] = re.sub(r'\.heic$', '.jpeg', cover_img)
                 source_changed = True
     if 'cover' in src_metadata:
         cover = src_metadata['cover']['image']
         if cover is not None:
             if cover.endswith('.heic'):
-                print(f"    COVER: Converting cover.image:'{cover}' to JPEG")
+                logger.debug(f"    COVER: Converting cover.image:'{cover}' to JPEG")
                 src_metadata['cover']['image'] = re.sub(r'\.heic$', '.jpeg', cover)
                 source_changed = True
 
@@ -187,386 +404,2006 @@ def process_frontmatter(src_metadata, rel_src_filepath, rel_dest_filepath, site_
     return source_changed
 
 
+# Add the aliases collected for a page to the site aliases dictionary (redirects)
+# Pages must be added in a stable order since the first page to claim an alias wins.
+def add_site_aliases(page_info, site_aliases_dict, stats_dict):
+    canonical_uri = page_info['canonical_uri']
 
-# Extract and print all links from the markdown content:
-def process_links(content, file_path):
-    # Initialize the Hugo content with the original content
-    hugo_content = content
-
-    markdown_links = re.findall(r'(!?\[(.*?)\]\((.*?)\))', content)
-    if markdown_links:
-        print(f"  MD Links found in {file_path}:")
-        for match in markdown_links:
-            full_md_link, link_text, link_url = match
-            print(f"    - {full_md_link}")
-
-            # Check if the link is a YouTube embed and convert to Hugo tag
-            if full_md_link.startswith('!') and ('youtube.com/watch' in link_url or 'youtu.be/' in link_url):
-                youtube_id = re.findall(r'(?:https?://(?:www\.)?youtube\.com/watch\?v=|https?://youtu\.be/)([\w-]+)', link_url)
-                if youtube_id:
-                    # Convert the YouTube link to a Hugo shortcode https://gohugo.io/content-management/shortcodes/#youtube
-                    hugo_tag = f'{{{{< youtube {youtube_id[0]} >}}}}'
-                    print(f"      - Converting YouTube link to Hugo shortcode: {hugo_tag}")
-                    hugo_content = hugo_content.replace(full_md_link, hugo_tag)
-                    stats_dict['youtube_links_converted'] += 1
-
-            # Check if the link ends in index.md and remove it
-            elif link_url.endswith('/index.md'):
-                print(f"      - Removing 'index.md' from the link")
-                hugo_content = hugo_content.replace(full_md_link, f"[{match[1]}]({link_url.replace('/index.md', '/')})")
-                stats_dict['links_removed_index.md'] += 1
+    for alias in page_info['aliases']:
+        # Keep only the last part of the alias --> NO, we actually want to handle aliases like STMag/index.html
+        # alias = alias.split('/')[-1]
+
+        if alias in site_aliases_dict:
+            logger.warning(f"!!!WARNING!!! Alias '{alias}' already exists in the dictionary (claimed again by {canonical_uri}).")
+            stats_dict['foreverlinks_conflicts_detected'] += 1
+        else:
+            if page_info['draft']:
+                logger.debug(f"    NOT ADDING alias {alias}->{canonical_uri} because it's a draft.")
+            else:
+                site_aliases_dict[alias] = canonical_uri
+                logger.debug(f"    Added alias {alias}->{canonical_uri} to the dictionary.")
+                stats_dict['foreverlinks_collected'] += 1
+
+
+
+# Single pass markdown scanner used by process_links() (compiled with the rewrite rules of each site, see
+# compile_scanners()).
+# At each position, the alternatives are tried in this order: code, the user rewrite rules (see obsigo_rules.py) and
+# the built-in conversions.
+CODE_TOKENS = [
+    r'(?P<fence>```[\s\S]*?```)',                   # Code block
+    r'(?P<code>`[\s\S]*?`)',                        # Inline code span
+]
+MARKDOWN_TOKENS = [
+    # Image like ![alt text](image.jpg "title") "caption" (the caption may be on the next line)
+    r'(?P<image>!\[(?P<image_alt>.*?)\]\((?P<image_url>.*?)(\s*"(?P<image_title>.*?)"\s*)?\)( *?\s *?"(?P<image_caption>.*?)")?)',
+    r'(?P<link>\[(?P<link_text>.*?)\]\((?P<link_url>.*?)\))',
+    r'(?P<html_link><a\s+(?:[^>]*?\s+)?href=(?P<html_quote>["\'])(?P<html_url>.*?)(?P=html_quote).*?>(?P<html_text>.*?)</a>)',
+    r'(?<=\s)#(?P<tag>\w[\w-]*)',                   # #hashtag (must follow a whitespace)
+    r'(?P<highlight>==)',                           # ==highlighted text==
+    # Escape ` # ` (otherwise Hugo renders h1s for bullet list entries like '- # of sectors per track')
+    r'(?P<escape> # )',
+]
+
+YOUTUBE_ID_RE = re.compile(r'(?:https?://(?:www\.)?youtube\.com/watch\?v=|https?://youtu\.be/)([\w-]+)')
+
+# URL of a markdown link and its optional title: [text](url "title")
+LINK_TITLE_RE = re.compile(r'\s*(?P<target><[^>]*>|\S*)(?P<title>\s[\s\S]*)?')
+
+
+# Compile the scanners of the markdown content and of the code (for the rules with `in_code`) with the user rewrite
+# rules (compiled by compile_rewrite_rules()):
+# All the rules are a single `rules` alternative of the scanners (see rules_scanner_pattern()). Returns the scanners
+# and the indexes of the rules to find which rule matched (see Converter).
+def compile_scanners(rules):
+    code_rules = [rule for rule in rules if rule['in_code']]
+    rules_pattern = rules_scanner_pattern(rules)
+    code_rules_pattern = rules_scanner_pattern(code_rules)
+    markdown_tokens_re = re.compile('|'.join(
+        CODE_TOKENS + ([f"(?P<rules>{rules_pattern})"] if rules_pattern else []) + MARKDOWN_TOKENS))
+    code_tokens_re = re.compile('|'.join(
+        ([f"(?P<rules>{code_rules_pattern})"] if code_rules_pattern else []) + [r'(?P<escape> # )']))
+    return markdown_tokens_re, code_tokens_re, index_rules(rules), index_rules(code_rules)
+
+
+# Convert an image link to a YouTube video to a Hugo shortcode:
+# Returns the shortcode or None if the image is not a YouTube video.
+def youtube_shortcode(link_url, stats_dict, found):
+    if 'youtube.com/watch' in link_url or 'youtu.be/' in link_url:
+        youtube_id = YOUTUBE_ID_RE.findall(link_url)
+        if youtube_id:
+            # Convert the YouTube link to a Hugo shortcode https://gohugo.io/content-management/shortcodes/#youtube
+            hugo_tag = f'{{{{< youtube {youtube_id[0]} >}}}}'
+            if found is not None:
+                found['md_links'].append(f"      - Converting YouTube link to Hugo shortcode: {hugo_tag}")
+            stats_dict['youtube_links_converted'] += 1
+            return hugo_tag
+    return None
+
+
+# Rewrite the URL of a markdown link if it needs it.
+# Internal links are resolved with the site index when there is one (see build_site_index()), and recorded in
+# `page_info['links']`.
+# Returns the new URL (with its title) or None if the link can be kept as is.
+def rewrite_md_link(link_url, stats_dict, found, page_info, site_index):
+    # Internal link: go straight to the canonical URL of the target page
+    if site_index is not None and page_info is not None:
+        link_match = LINK_TITLE_RE.match(link_url)
+        link_target, link_title = link_match.group('target'), link_match.group('title') or ''
+        canonical_url = resolve_internal_link(link_target, page_info['rel_src_filepath'], site_index)
+        if canonical_url is not False:
+            page_info['links'][link_target] = canonical_url
+        if canonical_url:
+            stats_dict['internal_links_resolved'] += 1
+            if canonical_url == link_target:
+                return None
+            if found is not None:
+                found['md_links'].append(f"      - Canonical URL: {canonical_url}")
+            return f"{canonical_url}{link_title}"
+        if canonical_url is None:
+            stats_dict['internal_links_broken'] += 1
+            if found is not None:
+                found['md_links'].append(f"      - BROKEN LINK: no published page for {link_target}")
+
+    # Check if the link ends in index.md and remove it
+    if link_url.endswith('/index.md'):
+        if found is not None:
+            found['md_links'].append(f"      - Removing 'index.md' from the link")
+        stats_dict['links_removed_index.md'] += 1
+        return link_url.replace('/index.md', '/')
+
+    # Check if the link repeats the filename like /xyz/filename/filename.md
+    parts = link_url.split('/')
+    if len(parts) >= 2 and parts[-1] == parts[-2]+".md":
+        if found is not None:
+            found['md_links'].append(f"        - Repeated filename found: {parts[-1]}")
+        # remove the last part
+        new_link_url = '/'.join(parts[:-1])+ '/'
+        if found is not None:
+            found['md_links'].append(f"        - New link: {new_link_url}")
+        stats_dict['links_removed_duplicate_filename.md'] += 1
+        return new_link_url
+
+    return None
+
+
+# Rewrite the user rule match found by a scanner at `pos`:
+# The rules with the 'source' target also record their change in `src_edits` (see scan_markdown()).
+# Returns the end of the match and its replacement.
+def rewrite_rule_match(index, content, pos, stats_dict, found, src_edits, offset):
+    rule, match = match_rules(index, content, pos)
+    replacement = expand_rule(rule, match)
+    stats_dict[rule['stat']] += 1
+    if rule['target'] == 'source' and src_edits is not None:
+        src_edits.append((offset + pos, offset + match.end(), replacement))
+    if found is not None:
+        found['rules'].append(f"    - {rule['name']}: {match.group()!r} -> {replacement!r}")
+    return match.end(), replacement
+
+
+# Rewrite a code block or inline code span: only the rules with `in_code` apply (and the ` # ` escape)
+def scan_code(converter, content, stats_dict, found, src_edits, offset):
+    output = []
+    pos = 0
+    for match in converter.code_tokens_re.finditer(content):
+        output.append(content[pos:match.start()])
+        if match.lastgroup == 'escape':
+            output.append(r' \# ')
+            pos = match.end()
+        else:
+            pos, replacement = rewrite_rule_match(converter.code_rules_index, content, match.start(), stats_dict, found, src_edits, offset)
+            output.append(replacement)
+    output.append(content[pos:])
+    return ''.join(output)
+
+
+# Rewrite markdown content for Hugo in a single pass.
+# Code blocks and inline code spans are copied as is. Everything else is rewritten as it is found:
+# the user rewrite rules, links, YouTube embeds, images (captions and HEIC), #hashtags and ==highlights==.
+# `found` collects what was seen for the audit output of process_links() (None = no audit), and the links as
+# (type, URL, text) in `found['links']` for `obsigo audit` (see collect_site_links()).
+# The changes of the rules with the 'source' target are recorded in `src_edits` as (start, end, replacement), with
+# positions in the document (`content` starts at `offset` in it).
+# Internal links are resolved with `site_index` (None = links are not resolved, see rewrite_md_link()).
+# The scanners are the ones of the site (`converter`, see compile_scanners()).
+def scan_markdown(converter, content, stats_dict, found, page_info=None, site_index=None, src_edits=None, offset=0):
+    output = []                 # Parts of the rewritten content
+    highlight_index = None      # Position in `output` of an opening `==` waiting for its closing `==`
+    pos = 0
+
+    while True:
+        match = converter.markdown_tokens_re.search(content, pos)
+        text = content[pos:match.start()] if match else content[pos:]
+        # A highlight cannot span several lines:
+        if highlight_index is not None and '\n' in text:
+            highlight_index = None
+        output.append(text)
+        if match is None:
+            break
+
+        kind = match.lastgroup
+        replacement = None
+        next_pos = match.end()
+
+        if kind in ('fence', 'code'):
+            output.append(scan_code(converter, match.group(), stats_dict, found, src_edits, offset + match.start()))
+            pos = next_pos
+            continue
 
+        if kind == 'highlight':
+            if highlight_index is not None:
+                output[highlight_index] = '<mark>'
+                output.append('</mark>')
+                highlight_index = None
+                pos = next_pos
+            elif re.match(r'\w', content[next_pos:next_pos+1]):
+                highlight_index = len(output)
+                output.append('==')
+                pos = next_pos
             else:
-                # TODO: check if the link repeats the filename like /xyz/filename/filename.md
-                # print( f"      - Checking for repeated filename in link: {link_url}")
-                parts = link_url.split('/')
-                if len(parts) >= 2 and parts[-1] == parts[-2]+".md":
-                    print( f"        - Repeated filename found: {parts[-1]}")
-                    # remove the last part
-                    new_link_url = '/'.join(parts[:-1])+ '/'
-                    print( f"        - New link: {new_link_url}")
-                    hugo_content = hugo_content.replace(full_md_link, f"[{match[1]}]({new_link_url})")
-                    stats_dict['links_removed_duplicate_filename.md'] += 1
-
-    # Find HTML links
-    # html_links = re.findall(r'(<a\s+(?:[^>]*?\s+)?href=(["\'])(.*?)\2>(.*?)<\/a>)', content)
-    html_links = re.findall(r'(<a\s+(?:[^>]*?\s+)?href=(["\'])(.*?)\2.*?>(.*?)<\/a>)', content)
-    if html_links:
-        print(f"  HTML Links found in {file_path}:")
-        for match in html_links:
-            print(f"    - {match[0]}")
-            markdown_link = f"[{match[3]}]({match[2]})"
-            print(f"      - MD equiv: {markdown_link}")
-            # replace in the content
-            # content = content.replace(full_md_link, markdown_link)
-
-
-
-    # Find tags and make them links BUT only outside code spans and code blocks
-    # TODO: generalize this to all replacements
-
-    # Regex pattern to match code blocks and inline code spans
-    code_pattern = r'(```[\s\S]*?```|`[\s\S]*?`)'
-
-    # Find and store all code blocks and inline code spans
-    code_parts = re.findall(code_pattern, hugo_content, re.DOTALL)
-    # print(f"  Found {len(code_parts)} code blocks or inline code spans." )
-
-    # Temporarily replace code blocks and inline code spans with placeholders
-    placeholder = "\0CODE\0"
-    hugo_content_protected = re.sub(code_pattern, placeholder, hugo_content)
-    # print(hugo_content_protected)
-
-    # Now replace #tag outside code spans and code blocks
-    tags = re.findall(r'\s#(\w(\w|-)*)', hugo_content_protected)
-    if tags:
-        print(f"  Tags found in {file_path}:")
-        for tag, dummy in tags:
-            print(f"    - #{tag}")
-            # Make a link to the tag page
-            tag_link = f"[#{tag}](/tags/{tag}/)"
-            print(f"      - MD link: {tag_link}")
-            # replace in the content
-            hugo_content_protected = re.sub(rf"(\s)#{tag}", r"\1"+tag_link, hugo_content_protected)
-
-
-    # Now find markdown images like ![alt text](image.jpg "tile") "caption" and replace title with caption:
-    # TODO: https://gohugo.io/content-management/shortcodes/#figure
-    markdown_images = re.findall(r'(!\[(.*?)\]\((.*?)(\s*"(.*?)"\s*)?\)( *?\s *?"(.*?)")?)', hugo_content_protected)
-    if markdown_images:
-        print(f"  MD Images found in {file_path}:")
-        for match in markdown_images:
-            full_md_image, alt_text, image_url, extension, title_text, dummy, caption_text = match
-            print(f"    - Image URL: {image_url}")
-            print(f"      - Alt text: {alt_text}")
-            print(f"      - Title text: {title_text}")
-            print(f"      - Caption text: {caption_text}")
-            # If caption text is not present, use the title text
-            if caption_text == '':
-                caption_text = title_text
-            # Check if it's an heic image and convert to jpg
-            if image_url.endswith('.heic'):
-                image_url = re.sub(r'\.heic$', '.jpeg', image_url)
-                print(f"      - Converting heic to jpg: {image_url}")
-
-            # replace in the content, only write caption is we have one:
-            if caption_text == '':
-                hugo_content_protected = hugo_content_protected.replace(full_md_image, f"![{alt_text}]({image_url})")
+                # Not an opening `==`: the second `=` may start one
+                output.append('=')
+                pos = match.start() + 1
+            continue
+
+        if kind == 'rules':
+            next_pos, replacement = rewrite_rule_match(converter.rules_index, content, match.start(), stats_dict, found, src_edits, offset)
+            if next_pos == match.start():
+                # Empty match: keep the next character as is so that the scan goes on
+                replacement += content[next_pos:next_pos+1]
+                next_pos += 1
+
+        elif kind == 'escape':
+            replacement = r' \# '
+
+        elif kind == 'image':
+            # The link part of the image ends at the first `)`:
+            url_start = match.start('image_url')
+            url_end = content.index(')', url_start)
+            if found is not None:
+                found['md_links'].append(f"    - {content[match.start():url_end+1]}")
+                found['links'].append(('image', content[url_start:url_end], match.group('image_alt')))
+            replacement = youtube_shortcode(content[url_start:url_end], stats_dict, found)
+            if replacement is not None:
+                next_pos = url_end + 1
+            else:
+                # Replace title with caption:
+                # TODO: https://gohugo.io/content-management/shortcodes/#figure
+                alt_text = match.group('image_alt')
+                image_url = match.group('image_url')
+                title_text = scan_markdown(converter, match.group('image_title') or '', stats_dict, found, page_info, site_index,
+                                           src_edits, offset + match.start('image_title'))
+                caption_text = scan_markdown(converter, match.group('image_caption') or '', stats_dict, found, page_info, site_index,
+                                             src_edits, offset + match.start('image_caption'))
+                if found is not None:
+                    found['images'].append(f"    - Image URL: {image_url}")
+                    found['images'].append(f"      - Alt text: {alt_text}")
+                    found['images'].append(f"      - Title text: {title_text}")
+                    found['images'].append(f"      - Caption text: {caption_text}")
+                # If caption text is not present, use the title text
+                if caption_text == '':
+                    caption_text = title_text
+                # Check if it's an heic image and convert to jpg
+                if image_url.endswith('.heic'):
+                    image_url = re.sub(r'\.heic$', '.jpeg', image_url)
+                    if found is not None:
+                        found['images'].append(f"      - Converting heic to jpg: {image_url}")
+                if page_info is not None:
+                    page_info['images'].append(image_url)
+                # only write caption is we have one:
+                if caption_text == '':
+                    replacement = f"![{alt_text}]({image_url})"
+                else:
+                    replacement = f"![{alt_text}]({image_url} \"{caption_text}\")"
+
+        elif kind == 'link':
+            if found is not None:
+                found['md_links'].append(f"    - {match.group()}")
+                found['links'].append(('md_link', match.group('link_url'), match.group('link_text')))
+            new_link_url = rewrite_md_link(match.group('link_url'), stats_dict, found, page_info, site_index)
+            if new_link_url is None:
+                # Keep the link but keep scanning its text (it may contain images, #tags...)
+                replacement = '['
+                next_pos = match.start() + 1
             else:
-                hugo_content_protected = hugo_content_protected.replace(full_md_image, f"![{alt_text}]({image_url} \"{caption_text}\")")
+                link_text = scan_markdown(converter, match.group('link_text'), stats_dict, found, page_info, site_index,
+                                          src_edits, offset + match.start('link_text'))
+                replacement = f"[{link_text}]({new_link_url})"
+
+        elif kind == 'html_link':
+            if found is not None:
+                found['html_links'].append(f"    - {match.group()}")
+                found['html_links'].append(f"      - MD equiv: [{match.group('html_text')}]({match.group('html_url')})")
+                found['links'].append(('html_link', match.group('html_url'), match.group('html_text')))
+            # Only audited: keep it and keep scanning its text
+            replacement = '<'
+            next_pos = match.start() + 1
+
+        else:
+            # #hashtag: make a link to the tag page
+            tag = match.group('tag')
+            replacement = f"[#{tag}](/tags/{tag}/)"
+            if page_info is not None:
+                page_info['tags'].append(tag)
+            if found is not None:
+                found['tags'].append(f"    - #{tag}")
+                found['tags'].append(f"      - MD link: {replacement}")
 
+        if highlight_index is not None and '\n' in replacement:
+            highlight_index = None
+        output.append(replacement)
+        pos = next_pos
 
-    # Now find ==highlighted text== and replace with <mark>highlighted text</mark> (non-greedy)
-    # This can actually be done by Goldmark in Hugo but we do it here for consistency with Obsidian which
-    # accepts a space before the closing ==
-    hugo_content_protected = re.sub(r'==(\w.*?)==', r'<mark>\1</mark>', hugo_content_protected)
+    return ''.join(output)
 
-    # Restore the code blocks and inline code spans
-    if len(code_parts) > 0:
-        # print(f"  Restoring {len(code_parts)} code blocks or inline code spans...")
-        for code_part in code_parts:
-            # print("  Restoring code block or inline code span...: " + code_part)
-            hugo_content_protected = hugo_content_protected.replace(placeholder, code_part, 1)
 
-    hugo_content = hugo_content_protected
+# Extract and print all links from the markdown content:
+# With `page_info`, the internal links found are recorded in `page_info['links']` (see rewrite_md_link()), the
+# #hashtags in `page_info['tags']` and the image URLs in `page_info['images']`.
+# Internal links are resolved with `site_index` (see build_site_index()).
+# Returns the new source content (changed by the rewrite rules with the 'source' target) and the Hugo content.
+def process_links(converter, content, file_path, stats_dict, page_info=None, site_index=None):
+    # The audit is only collected when it is going to be logged:
+    if logger.isEnabledFor(logging.DEBUG):
+        found = {
+            'md_links': [],
+            'html_links': [],
+            'tags': [],
+            'images': [],
+            'rules': [],
+            'links': [],
+        }
+    else:
+        found = None
+
+    # Scan the content once and rewrite it for Hugo:
+    # (Obsidian accepts a space before the closing `==` of a highlight, so we convert them here for consistency
+    # instead of letting Goldmark do it in Hugo)
+    if page_info is not None:
+        page_info['links'] = {}
+        page_info['tags'] = []
+        page_info['images'] = []
+    src_edits = []
+    hugo_content = scan_markdown(converter, content, stats_dict, found, page_info, site_index, src_edits)
+
+    # Apply the changes of the rules with the 'source' target to the source content:
+    if src_edits:
+        parts = []
+        pos = 0
+        for start, end, replacement in sorted(src_edits, key=lambda edit: edit[0]):
+            parts.append(content[pos:start])
+            parts.append(replacement)
+            pos = end
+        parts.append(content[pos:])
+        content = ''.join(parts)
+
+    # Audit output:
+    for key, title in (('md_links', "MD Links"), ('html_links', "HTML Links"), ('tags', "Tags"), ('images', "MD Images"),
+                       ('rules', "Rewrite rules")):
+        if found and found[key]:
+            logger.debug(f"  {title} found in {file_path}:")
+            for line in found[key]:
+                logger.debug(line)
 
     return content, hugo_content
 
 
-# Process a single markdown file:
-def process_file(file_path, rel_src_filepath, dest_root, site_aliases_dict, stats_dict):
+# Write a file atomically: the data goes to a hidden temporary file next to the destination which is then renamed,
+# so Hugo never reads a half-written file.
+def write_file_atomic(file_path, data):
+    temp_file_path = os.path.join(os.path.dirname(file_path), '.' + os.path.basename(file_path) + '.obsigo-tmp')
+    with open(temp_file_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(temp_file_path, file_path)
 
-    stats_dict['source_md_files'] += 1
 
-    # Load the file with frontmatter lib:
-    post = frontmatter.load(file_path)
-    if "title" in post:
-        print( f"  Title: {post['title']}")
+# Compare new data with the current contents of a destination file:
+# Returns 'added', 'changed' or 'unchanged'.
+def compare_dest_file(dest_file_path, data):
+    try:
+        dest_stat = os.stat(dest_file_path)
+    except FileNotFoundError:
+        return 'added'
+    if dest_stat.st_size != len(data):
+        return 'changed'
+    with open(dest_file_path, 'rb') as dest_file:
+        if content_hash(dest_file.read()) != content_hash(data):
+            return 'changed'
+    return 'unchanged'
+
 
-    # DESTINATION PATH:
+# Compute the hash used to detect content changes in the manifest:
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
 
+
+# DESTINATION PATH of a source markdown file, relative to the destination directory:
+# Returns the path and how it was found (for the log).
+def get_dest_filepath(rel_src_filepath):
     # Check if the filename ends in _?index.md or search.md
     if re.search(r'(/|^)(_?index|search)\.md$', rel_src_filepath):
-        rel_dest_filepath = rel_src_filepath
-        print(f"  ALREADY INDEX - keep as is: {rel_dest_filepath}")
+        return rel_src_filepath, "ALREADY INDEX - keep as is"
+    # Get the filename without the extension
+    filename_base = re.sub(r'\.md$', '', os.path.basename(rel_src_filepath))
+    # Get the last directory from the path
+    lastlevel_dir = os.path.basename(os.path.dirname(rel_src_filepath))
+    if filename_base == lastlevel_dir:
+        return os.path.join( os.path.dirname(rel_src_filepath), 'index.md'), "FILE == DIR - keep only one"
+    # Need to make a leaf directory with index.md
+    return re.sub(r'\.md$', '/index.md', rel_src_filepath), "FILE != DIR - Make new leaf directory"
+
+
+# SITE INDEX: where every page of the site ends up.
+# It is built before the conversion, so that internal links can go straight to the canonical URI of their target
+# (no redirect hop) and links to nothing can be reported.
+
+# Scheme of an external link (https:, mailto:...)
+EXTERNAL_LINK_RE = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*:')
+
+
+# What a page contributes to the site index, with the same rules as process_frontmatter():
+def get_page_entry(metadata, rel_src_filepath):
+    rel_dest_filepath, dest_rule = get_dest_filepath(rel_src_filepath)
+    aliases = get_metadata_aliases(metadata)
+    main_slug = get_main_slug(rel_src_filepath)
+    if main_slug is not None:
+        aliases.append(main_slug)
+        # A divergent slug becomes an alias
+        if 'slug' in metadata and str(metadata['slug']) != main_slug:
+            aliases.append(metadata['slug'])
+    return {
+        'rel_src_filepath': rel_src_filepath,
+        'rel_dest_filepath': rel_dest_filepath,
+        'canonical_uri': get_canonical_uri(rel_dest_filepath),
+        'aliases': [str(alias) for alias in aliases],
+        'draft': bool(metadata.get('draft', False)),
+    }
+
+
+# Build the site index of the markdown files [(relative path, path)] in sorted order:
+# `known_entries` are the manifest entries of the unchanged files, the frontmatter of the other files is read.
+def build_site_index(md_files, known_entries, parsed_headers=None):
+    index = {
+        'sources': {},      # source path -> canonical URI
+        'dests': {},        # destination path -> canonical URI
+        'basenames': {},    # filename -> [canonical URIs] (Obsidian "shortest path" links)
+        'uris': set(),      # canonical URIs of the published pages
+        'drafts': set(),    # canonical URIs of the drafts (not published: links to them are broken)
+        'aliases': {},      # alias -> canonical URI (the first page in source order wins, like the redirects)
+    }
+    for rel_src_filepath, file_path in md_files:
+        entry = known_entries.get(rel_src_filepath)
+        if entry is None:
+            with open(file_path, 'rb') as input_file:
+                entry = get_page_entry(load_markdown(input_file.read().decode('utf-8'), parsed_headers)['metadata'], rel_src_filepath)
+        canonical_uri = entry['canonical_uri']
+        index['sources'][rel_src_filepath] = canonical_uri
+        index['dests'][entry['rel_dest_filepath']] = canonical_uri
+        index['basenames'].setdefault(posixpath.basename(rel_src_filepath), []).append(canonical_uri)
+        if entry['draft']:
+            index['drafts'].add(canonical_uri)
+            continue
+        index['uris'].add(canonical_uri)
+        for alias in entry['aliases']:
+            index['aliases'].setdefault(normalize_alias(alias), canonical_uri)
+    return index
+
+
+# Find the canonical URL of an internal link of a page:
+# - Obsidian links to a source file (`other.md`, `../dir/other.md`, `/dir/other.md`, `other`, `Other%20Note.md`)
+# - links to a URL of the site (`/dir/other/`, `../other/`), including the old URLs redirected by an alias
+# Returns the canonical URL (with its query and #fragment), None if the link doesn't match any published page or
+# False if it is not an internal link to a page (external link, anchor, image, file...).
+def resolve_internal_link(link_url, rel_src_filepath, site_index):
+    url = link_url.strip()
+    if url.startswith('<') and url.endswith('>'):
+        url = url[1:-1]
+    if not url or url.startswith(('#', '//')) or EXTERNAL_LINK_RE.match(url):
+        return False
+    path, hash_sign, fragment = url.partition('#')
+    path, question_mark, query = path.partition('?')
+    path = urllib.parse.unquote(path)
+    extension = posixpath.splitext(path.rstrip('/'))[1].lower()
+    if extension not in ('', '.md', '.html', '.htm'):
+        return False
+
+    canonical_uri = None
+    src_dir = posixpath.dirname(rel_src_filepath)
+    if extension in ('', '.md'):
+        # Path of a source file: relative to the source file, or to the source directory if absolute
+        rel_path = path.lstrip('/') if path.startswith('/') else posixpath.normpath(posixpath.join(src_dir, path))
+        if extension == '':
+            rel_path += '.md'
+        canonical_uri = index_lookup(site_index, 'sources', rel_path) or index_lookup(site_index, 'dests', rel_path)
+        if canonical_uri is None and extension == '.md':
+            candidates = site_index['basenames'].get(posixpath.basename(rel_path), [])
+            if len(candidates) == 1:
+                canonical_uri = candidates[0]
+
+    if canonical_uri is None and extension != '.md':
+        # URL of the site: relative to the URL of the page
+        page_uri = site_index['sources'].get(rel_src_filepath, '/')
+        url_path = normalize_path(path if path.startswith('/') else posixpath.join(page_uri, path))
+        url_path = normalize_path(posixpath.normpath(url_path))
+        candidate_uri = url_path if url_path == '/' else url_path + '/'
+        if candidate_uri in site_index['uris'] or candidate_uri in site_index['drafts']:
+            canonical_uri = candidate_uri
+        else:
+            # Old URL: redirected by the most specific matching alias (like `*/alias` in _redirects)
+            segments = split_path(url_path)
+            for start in range(len(segments)):
+                canonical_uri = site_index['aliases'].get(normalize_alias('/'.join(segments[start:])))
+                if canonical_uri is not None:
+                    break
+
+    if canonical_uri is None or canonical_uri in site_index['drafts']:
+        return None
+    return canonical_uri + ('?' + query if question_mark else '') + ('#' + fragment if hash_sign else '')
+
+
+def index_lookup(site_index, kind, rel_path):
+    if rel_path.startswith('../'):
+        return None
+    return site_index[kind].get(rel_path)
+
+
+# Check if the links of an unchanged page would now resolve differently (a target page was added, removed or
+# renamed, an alias changed...): the page must then be converted again.
+def links_changed(entry, site_index):
+    return any(resolve_internal_link(link_url, entry['rel_src_filepath'], site_index) != canonical_url
+               for link_url, canonical_url in entry.get('links', {}).items())
+
+
+# Links to no published page: [(source path, link URL)]
+def get_broken_links(manifest_files):
+    return [(rel_src_filepath, link_url)
+            for rel_src_filepath, entry in sorted(manifest_files.items())
+            for link_url, canonical_url in entry.get('links', {}).items() if canonical_url is None]
+
+
+# Path of a file of the vault linked from a page: relative to the page, or to the source directory if absolute
+def get_vault_path(url, rel_src_filepath):
+    path = urllib.parse.unquote(re.split(r'[?#]', url, 1)[0])
+    if path.startswith('/'):
+        return path.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(rel_src_filepath), path))
+
+
+# Classify a link of a page for `obsigo audit` (see obsigo_audit.py):
+# Returns its category, its target (canonical URL, URL or path of the file) and its status.
+def classify_link(link_type, link_url, rel_src_filepath, source_directory, site_index):
+    url = LINK_TITLE_RE.match(link_url).group('target').strip('<>')
+    if url.startswith('//'):
+        url = 'https:' + url
+    if EXTERNAL_LINK_RE.match(url):
+        category, target, status = 'external', url, None
+    elif not url or url.startswith('#'):
+        category, target, status = 'internal', url, 'ok'
     else:
-        print(f"  NOT INDEX.MD...")
-        # Get the filename without the extension
-        filename_base = re.sub(r'\.md$', '', os.path.basename(rel_src_filepath))
-        # Get the last directory from the path
-        lastlevel_dir = os.path.basename(os.path.dirname(rel_src_filepath))
-        if filename_base == lastlevel_dir:
-            rel_dest_filepath = os.path.join( os.path.dirname(rel_src_filepath), 'index.md')
-            print(f"  FILE == DIR - keep only one: {rel_dest_filepath}")
+        canonical_url = resolve_internal_link(url, rel_src_filepath, site_index)
+        if canonical_url is not False:
+            category, target, status = 'internal', canonical_url, 'ok' if canonical_url else 'broken'
         else:
-            # Need to make a leaf directory with index.md
-            rel_dest_filepath = re.sub(r'\.md$', '/index.md', rel_src_filepath)
-            print(f"  FILE != DIR - Make new leaf directory: {rel_dest_filepath}")
+            target = get_vault_path(url, rel_src_filepath)
+            category, status = 'asset', 'ok' if os.path.exists(os.path.join(source_directory, target)) else 'missing'
+    # (HTML links are classified apart, whatever their target)
+    if link_type == 'html_link':
+        category = 'html-legacy'
+    return category, target, status
+
+
+# Collect all the links of the site for `obsigo audit` (nothing is written):
+# Returns [{'source', 'type', 'url', 'text', 'category', 'target', 'status'}] in the order of the source paths
+# (the HTML links also have their `markdown` equivalent).
+def collect_site_links(converter, source_directory):
+    md_files = sorted((rel_path, path) for kind, rel_path, path, stat in
+                      scan_source_directory(source_directory, load_ignore_patterns(source_directory, converter.ignore_patterns))
+                      if kind == 'markdown')
+    site_index = build_site_index(md_files, {}, converter.parsed_headers)
+
+    links = []
+    stats_dict = new_stats_dict(converter.rewrite_rules)
+    for rel_src_filepath, file_path in md_files:
+        with open(file_path, 'rb') as input_file:
+            content = load_markdown(input_file.read().decode('utf-8'), converter.parsed_headers)['content']
+        found = {'md_links': [], 'html_links': [], 'tags': [], 'images': [], 'rules': [], 'links': []}
+        scan_markdown(converter, content, stats_dict, found)
+        for link_type, link_url, link_text in found['links']:
+            category, target, status = classify_link(link_type, link_url, rel_src_filepath, source_directory, site_index)
+            link = {
+                'source': rel_src_filepath,
+                'type': link_type,
+                'category': category,
+                'url': link_url,
+                'text': link_text,
+                'target': target,
+                'status': status,
+            }
+            if link_type == 'html_link':
+                link['markdown'] = f"[{link_text}]({link_url})"
+            links.append(link)
+    logger.info(f"Audit: {len(links)} links in {len(md_files)} markdown files.")
+    return links
 
-    # Process the frontmatter
-    source_changed = process_frontmatter(post.metadata, rel_src_filepath, rel_dest_filepath, site_aliases_dict, stats_dict)
 
-    # Extract and print links from the content and update the content
-    new_src_content, new_hugo_content = process_links(post.content, rel_src_filepath )
+# Process a single markdown file:
+# `src_stat` is the stat result of the source file when the scan already has it, internal links are resolved with
+# `site_index`. The config of the site and the state of the run are the ones of `converter`.
+# Returns the manifest entry for the file (see process_directory())
+def process_file(converter, file_path, rel_src_filepath, dest_root, stats_dict, site_index=None, src_stat=None):
+    start_time = time.perf_counter()
 
-    # Replace ` # ` with ` \# ` in the destination content only (otherwise Hugo will try to render h1s
-    # in case of bullet lists entries like '- # of sectors per track')
-    new_hugo_content = re.sub(r' # ', r' \# ', new_hugo_content)
+    stats_dict['source_md_files'] += 1
+
+    # Load the file with frontmatter lib:
+    with converter.timed('read'):
+        with open(file_path, 'rb') as input_file:
+            src_data = input_file.read()
+
+    with converter.timed('frontmatter'):
+        document = load_markdown(src_data.decode('utf-8'), converter.parsed_headers)
+        metadata = document['metadata']
+        if "title" in metadata:
+            logger.debug(f"  Title: {metadata['title']}")
+
+        rel_dest_filepath, dest_rule = get_dest_filepath(rel_src_filepath)
+        logger.debug(f"  {dest_rule}: {rel_dest_filepath}")
+
+        page_info = {
+            'rel_src_filepath': rel_src_filepath,
+            'rel_dest_filepath': rel_dest_filepath,
+        }
+
+        # Process the frontmatter
+        source_changed = process_frontmatter(metadata, rel_src_filepath, rel_dest_filepath, page_info, stats_dict,
+                                             converter.unimportant_frontmatter_keys)
+
+    with converter.timed('links'):
+        # Extract and print links from the content and update the content
+        new_src_content, new_hugo_content = process_links(converter, document['content'], rel_src_filepath, stats_dict, page_info, site_index)
+        page_info['tags'] = get_page_tags(metadata, page_info['tags'])
+        page_info['images'] = get_page_images(metadata, page_info['images'])
+
+    # The frontmatter is only serialized again if it was changed by process_frontmatter()
+    with converter.timed('frontmatter'):
+        header = render_frontmatter(document, metadata, source_changed)
 
     # Check if the source content has changed
-    if new_src_content != post.content:
-         post.content = new_src_content
+    if new_src_content != document['content']:
          source_changed = True
 
     # Check if the filename is a bland index.md
+    new_file_path = file_path
     if re.search(r'/index\.md$', rel_src_filepath):
-        print(f"  BLAND index.md - Renaming to to slug: {post.metadata['slug']}.md")
-        # Rename the file to the slug
-        new_filename = str(post.metadata['slug']) + '.md'
+        logger.debug(f"  BLAND index.md - Renaming to to slug: {metadata['slug']}.md")
+        # Rename the file to the slug (at the end of the run, see apply_source_journal())
+        new_filename = str(metadata['slug']) + '.md'
         new_file_path = os.path.join(os.path.dirname(file_path), new_filename)
-        print(f"  Renaming file: {file_path} -> {new_file_path}")
-        os.rename(file_path, new_file_path)
+        logger.debug(f"  Renaming file: {file_path} -> {new_file_path}")
         stats_dict['index_md_files_renamed'] += 1
+        # From now on, the source lives under its new name:
+        page_info['rel_src_filepath'] = os.path.join(os.path.dirname(rel_src_filepath), new_filename)
 
 
-    # Save the modified source file only if changes were made
+    # Save the modified source file only if changes were made (at the end of the run, see apply_source_journal())
+    read_hash = content_hash(src_data)
     if not source_changed:
-        print("  SOURCE unchanged.")
+        logger.debug("  SOURCE unchanged.")
+    else:
+        logger.debug(f"  Modified SOURCE file: {file_path}")
+        src_data = update_markdown(document, header, new_src_content).encode('utf-8')
+
+    # Remember the state of the source so the next incremental run can tell if it changed:
+    page_info['hash'] = content_hash(src_data)
+    if source_changed or new_file_path != file_path:
+        converter.source_journal.append({
+            'rel_src_filepath': rel_src_filepath,
+            'file_path': file_path,
+            'new_rel_src_filepath': page_info['rel_src_filepath'],
+            'new_file_path': new_file_path,
+            'hash': read_hash,
+            'data': src_data if source_changed else None,
+        })
+        # (the modification time is only known once the file is written)
+        page_info['mtime_ns'] = None
+        page_info['size'] = len(src_data)
     else:
-        print(f"  Saving modified SOURCE file: {file_path} ...")
-        # Create an in-memory bytes buffer
-        f = BytesIO()
-        # Dump the front matter into the bytes buffer
-        frontmatter.dump(post, f)
-        with open(file_path, 'wb') as output_file:
-            output_file.write(f.getvalue())
+        if src_stat is None:
+            src_stat = os.stat(file_path)
+        page_info['mtime_ns'] = src_stat.st_mtime_ns
+        page_info['size'] = src_stat.st_size
 
     # -----------------------
     # Save the new Hugo content to the destination path
-    post.content = new_hugo_content
+    dest_file_path = os.path.join(dest_root, rel_dest_filepath)
+    logger.debug(f"  Saving Hugo file: {dest_file_path} ...")
+    dest_data = dump_markdown(header, new_hugo_content).encode('utf-8')
+    with converter.timed('write'):
+        converter.write_dest_file(dest_file_path, dest_data)
+
+    converter.file_times[rel_src_filepath] = time.perf_counter() - start_time
+    return page_info
+
+
+# Unified diff of a source change of the journal (for --dry-run), with a git-like header for renames:
+def source_journal_diff(entry, old_data):
+    old_name, new_name = entry['rel_src_filepath'], entry['new_rel_src_filepath']
+    lines = [f"diff --obsigo a/{old_name} b/{new_name}\n"]
+    if new_name != old_name:
+        lines += [f"rename from {old_name}\n", f"rename to {new_name}\n"]
+    if entry['data'] is not None:
+        lines += difflib.unified_diff(old_data.decode('utf-8').splitlines(keepends=True),
+                                      entry['data'].decode('utf-8').splitlines(keepends=True),
+                                      f"a/{old_name}", f"b/{new_name}")
+    if not lines[-1].endswith('\n'):
+        lines[-1] += '\n\\ No newline at end of file\n'
+    return ''.join(lines)
+
+
+# Apply the source changes collected by the run in one batch (see `source_journal`):
+# - a file that changed since it was read (edited in Obsidian during the run...) is left alone, it will be converted
+#   again by the next run
+# - a file is only written if its contents change, through a temporary file next to it. All the temporary files are
+#   written first, then swapped in (and the renames done) in one go.
+# The manifest entries of the written files are updated. With `dry_run`, the changes are only printed as a diff.
+def apply_source_journal(journal, manifest_files, stats_dict, dry_run=False):
+    writes = []     # (temp file path or None for a rename, entry)
+    try:
+        for entry in sorted(journal, key=lambda entry: entry['rel_src_filepath']):
+            file_path, new_file_path = entry['file_path'], entry['new_file_path']
+            try:
+                with open(file_path, 'rb') as input_file:
+                    old_data = input_file.read()
+            except FileNotFoundError:
+                old_data = None
+            if old_data is None or content_hash(old_data) != entry['hash']:
+                logger.warning(f"!!!WARNING!!! {file_path} changed during the run: not saving it.")
+                stats_dict['source_writes_skipped'] += 1
+                continue
+            if new_file_path != file_path and os.path.exists(new_file_path):
+                logger.error(f"ERROR renaming {file_path}: {new_file_path} already exists.")
+                stats_dict['source_writes_skipped'] += 1
+                continue
+            if dry_run:
+                sys.stdout.write(source_journal_diff(entry, old_data))
+                continue
+
+            if entry['data'] is None or entry['data'] == old_data:
+                if new_file_path == file_path:
+                    continue
+                writes.append((None, entry))
+            else:
+                temp_file_path = os.path.join(os.path.dirname(new_file_path), '.' + os.path.basename(new_file_path) + '.obsigo-tmp')
+                with open(temp_file_path, 'wb') as output_file:
+                    output_file.write(entry['data'])
+                writes.append((temp_file_path, entry))
+    except BaseException:
+        for temp_file_path, entry in writes:
+            if temp_file_path is not None:
+                os.remove(temp_file_path)
+        raise
+
+    for temp_file_path, entry in writes:
+        file_path, new_file_path = entry['file_path'], entry['new_file_path']
+        if temp_file_path is None:
+            logger.debug(f"  Renaming SOURCE file: {file_path} -> {new_file_path}")
+            os.rename(file_path, new_file_path)
+            stats_dict['source_files_renamed'] += 1
+        else:
+            logger.debug(f"  Saving modified SOURCE file: {new_file_path}")
+            os.replace(temp_file_path, new_file_path)
+            stats_dict['source_files_written'] += 1
+            if new_file_path != file_path:
+                os.remove(file_path)
+                stats_dict['source_files_renamed'] += 1
+        manifest_entry = manifest_files.get(entry['new_rel_src_filepath'])
+        if manifest_entry is not None:
+            src_stat = os.stat(new_file_path)
+            manifest_entry['mtime_ns'] = src_stat.st_mtime_ns
+            manifest_entry['size'] = src_stat.st_size
+
+
+# Check if a source file is unchanged since it was recorded in the manifest:
+# Returns the manifest entry (updated if needed) or None if the file must be processed again.
+def check_manifest_entry(file_path, rel_src_filepath, dest_root, manifest_files, src_stat=None):
+    entry = manifest_files.get(rel_src_filepath)
+    if entry is None:
+        return None
+
+    # The destination file must still be there:
+    if not os.path.exists(os.path.join(dest_root, entry['rel_dest_filepath'])):
+        return None
+
+    if src_stat is None:
+        src_stat = os.stat(file_path)
+    if src_stat.st_size != entry['size']:
+        return None
+    if src_stat.st_mtime_ns == entry['mtime_ns']:
+        return entry
+
+    # Same size but touched: compare the content hash
+    with open(file_path, 'rb') as input_file:
+        if content_hash(input_file.read()) != entry['hash']:
+            return None
+    entry = dict(entry, mtime_ns=src_stat.st_mtime_ns)
+    return entry
+
+
+# Remove the destination files of sources that have disappeared since the manifest was written (orphans):
+def remove_deleted_files(converter, old_manifest_files, new_manifest_files, dest_root, stats_dict):
+    live_dest_filepaths = {entry['rel_dest_filepath'] for entry in new_manifest_files.values()}
+
+    for rel_src_filepath, entry in old_manifest_files.items():
+        if rel_src_filepath in new_manifest_files:
+            continue
+        rel_dest_filepath = entry.get('rel_dest_filepath')
+        if rel_dest_filepath is None:
+            continue
+        if rel_dest_filepath in live_dest_filepaths:
+            # Another (or the renamed) source still produces this file
+            continue
+        dest_file_path = os.path.join(dest_root, rel_dest_filepath)
+        logger.info(f" Source {rel_src_filepath} has been deleted: removing {dest_file_path}")
+        converter.remove_dest_file(dest_file_path, dest_root)
+        stats_dict['deleted_md_files_removed'] += 1
+
+
+# Load the manifest of the previous run. Returns (recorded files, up to date):
+# The files are only up to date if the manifest was made by this version with the same configuration. Outdated files
+# can still tell which destination files the previous run wrote, as long as it wrote them to the same directory.
+def load_manifest(manifest_file, config_fingerprint):
+    if not os.path.exists(manifest_file):
+        logger.info(f"No manifest found in '{manifest_file}': all files will be processed.")
+        return {}, False
+    try:
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.error(f"ERROR reading manifest file: {e}: all files will be processed.")
+        return {}, False
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('config') != config_fingerprint:
+        logger.info(f"Manifest '{manifest_file}' is outdated: all files will be processed.")
+        if (manifest.get('config') or {}).get('destination_directory') != config_fingerprint['destination_directory']:
+            return {}, False
+        return manifest.get('files', {}), False
+    return manifest['files'], True
+
+
+def save_manifest(manifest_file, config_fingerprint, manifest_files):
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'config': config_fingerprint,
+        'files': manifest_files,
+    }
+    try:
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    except OSError as e:
+        logger.error(f"ERROR writing manifest file: {e}")
 
 
-    dest_file_path = os.path.join(dest_root, rel_dest_filepath)
-    # Check if we need to create the directory:
-    dest_dir = os.path.dirname(dest_file_path)
-    if not os.path.exists(dest_dir):
-        print(f"  Creating destination directory: {dest_dir}")
-        os.makedirs(dest_dir)
+# Make a new set of counters for the stats (with the hits of the user rewrite rules of the site):
+def new_stats_dict(rewrite_rules=()):
+    return {
+        'source_md_files': 0,
+        'frontmatter_source_cleanups': 0,
+        'youtube_links_converted': 0,
+        'aliases_collected': 0,
+        'slugs_collected': 0,
+        'index_md_files_renamed': 0,  # index.md files renamed to slug.md
+        'divergent_slugs_fixed': 0, # Old slug becomes an alias and filename becomes new slug
+        'missing_slugs_fixed': 0,   # Missing slug added to source
+        'foreverlinks_collected': 0,
+        'foreverlinks_conflicts_detected': 0,
+        'foreverlinks_from_history': 0,     # Aliases no page claims anymore, kept from the index (see obsigo_db.py)
+        'index_rows_written': 0,            # Rows of the index upserted or closed by the run
+        'links_removed_index.md': 0,
+        'links_removed_duplicate_filename.md': 0,
+        'source_md_files_unchanged': 0,     # Skipped by an incremental run
+        'deleted_md_files_removed': 0,      # Destination files of deleted sources removed by an incremental run
+        'assets_files_copied': 0,
+        'assets_bytes_copied': 0,
+        'assets_files_skipped': 0,          # Unchanged assets
+        'assets_bytes_skipped': 0,
+        'assets_files_pruned': 0,           # Destination assets without a source anymore
+        'assets_files_shared': 0,           # Hard-linked to their copy in another site of the batch
+        'redirect_rules_written': 0,
+        'redirect_rules_removed': 0,        # Duplicates and rules that can never match
+        'redirect_chains_collapsed': 0,     # Rules that now redirect straight to the final destination
+        'redirect_loops_detected': 0,
+        'internal_links_resolved': 0,       # Links to a page of the site, rewritten to its canonical URL
+        'internal_links_broken': 0,         # Links to no published page (missing or draft)
+        'source_md_files_relinked': 0,      # Unchanged files converted again because their links changed
+        'source_md_files_out_of_scope': 0,  # Not converted by a scoped build (--only)
+        'source_md_files_frontmatter_only': 0,  # Out of scope and not in the manifest: only their frontmatter was read
+        'dest_files_added': 0,              # Destination changes, see write_changes_file()
+        'dest_files_changed': 0,
+        'dest_files_removed': 0,
+        'dest_files_unchanged': 0,          # Identical writes skipped
+        'source_files_written': 0,          # Source changes applied at the end of the run (see apply_source_journal())
+        'source_files_renamed': 0,
+        'source_writes_skipped': 0,         # Source files changed during the run (or rename conflicts)
+        'source_paths_ignored': 0,          # Hidden directories and paths of the ignore patterns (see obsigo_scan.py)
+        # Hits of each user rewrite rule:
+        **{rule['stat']: 0 for rule in rewrite_rules},
+    }
+
+
+# Make a new record of the destination changes (see Converter.record_dest_change()):
+def new_dest_changes():
+    return {'added': set(), 'changed': set(), 'removed': set(), 'unchanged': 0}
+
+
+# Keep the log records of a worker process so the parent can log them in order:
+class LogRecordsCollector(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Format the message now: the arguments may not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+# Converter and site index of the site whose files a worker process converts (see init_worker())
+worker_converter = None
+worker_site_index = None
+
+# Parsed YAML headers of a worker process of the pool of a batch, shared by the sites (see init_batch_worker())
+worker_parsed_headers = None
+
+
+# Setup a worker process of the pool used by `--jobs`:
+# (with the "spawn" start method, workers don't run `__main__` so they need the config passed explicitly)
+def init_worker(config, log_level, site_index):
+    global worker_converter, worker_site_index
+    worker_converter = Converter(config)
+    worker_converter.parsed_headers = worker_parsed_headers
+    worker_site_index = site_index
+    logger.setLevel(log_level)
+    logger.propagate = False
 
-    print(f"  Saving Hugo file: {dest_file_path} ...")
-    # Create an in-memory bytes buffer for the Hugo content
-    f = BytesIO()
-    # Dump the front matter into the bytes buffer
-    frontmatter.dump(post, f)
-    with open(dest_file_path, 'wb') as output_file:
-        output_file.write(f.getvalue())
 
+# Site whose state is installed in a worker process of the pool of a batch (see process_site_chunk_job())
+worker_site_key = None
+
+# Keys of the sites converted on the pool of a batch
+site_keys = itertools.count()
+
+
+# Setup a worker process of the pool of a batch (see run_batch()): the state of each site comes with its jobs
+def init_batch_worker(log_level):
+    global worker_parsed_headers
+    worker_parsed_headers = {}
+    logger.setLevel(log_level)
+    logger.propagate = False
+
+
+# Run a job of the pool of a batch in the directory of its site (the paths of the jobs are relative to it):
+def run_in_directory(job):
+    directory, function, argument = job
+    os.chdir(directory)
+    return function(argument)
+
+
+# Pool of worker processes of a batch, shared by its sites (see run_batch()):
+# Like a ProcessPoolExecutor, except that the jobs run in the current directory of the parent when they are submitted.
+class BatchExecutor:
+
+    def __init__(self, jobs):
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_batch_worker,
+                                                               initargs=(logger.getEffectiveLevel(),))
+
+    def map(self, function, iterable, chunksize=1):
+        directory = os.getcwd()
+        return self.executor.map(run_in_directory, [(directory, function, argument) for argument in iterable],
+                                 chunksize=chunksize)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
+
+
+# Process a chunk of markdown files of a site in a worker process of the pool of a batch:
+# The state of the site (the arguments of init_worker()) comes with each chunk and is only installed when the worker
+# switches to another site. Returns the results of process_file_job() for the files of the chunk.
+def process_site_chunk_job(site_job):
+    global worker_site_key
+    site_key, site_state, chunk = site_job
+    if site_key != worker_site_key:
+        init_worker(*site_state)
+        worker_site_key = site_key
+    return [process_file_job(job) for job in chunk]
+
+
+# Process a single markdown file in a worker process:
+# Returns the manifest entry, the stats for this file, its stage timings, its destination and source changes and its
+# log records so the parent can log them in order.
+def process_file_job(job):
+    file_path, rel_src_filepath, dest_root, src_stat = job
+    converter = worker_converter
+    file_stats_dict = new_stats_dict(converter.rewrite_rules)
+    # (a new state for each job: the results of a chunk of jobs are only sent once the whole chunk is done)
+    converter.start_run()
+    collector = LogRecordsCollector()
+    logger.addHandler(collector)
+    try:
+        logger.debug(f"\n Processing file: {rel_src_filepath} ...")
+        page_info = process_file(converter, file_path, rel_src_filepath, dest_root, file_stats_dict, worker_site_index, src_stat)
+    finally:
+        logger.removeHandler(collector)
+    return (page_info, file_stats_dict, converter.stage_times, converter.file_times[rel_src_filepath], converter.dest_changes,
+            converter.source_journal, collector.records)
+
+
+# Check if a path relative to the source directory is in the scope of a scoped build (`only`, see process_directory()):
+def is_in_scope(rel_path, only):
+    return only is None or rel_path == only or rel_path.startswith(os.path.join(only, ''))
 
 
 # Recursively process all markdown files in a directory:
-def process_directory(source_directory, destination_directory, site_aliases_dict, stats_dict ):
-    for root, dirs, files in os.walk(source_directory):
-
-        cur_dirname = os.path.basename(root)
-        if cur_dirname.startswith('.'):
-            # print()
-            # print()
-            # print(f"Skipping hidden directory: {root}")
+# `manifest_files` holds the entries of the previous run (empty for a full run). Unchanged files are not processed
+# again, their recorded aliases are reused. Returns the entries for the current run.
+# `assets_copy_mode` is 'copy' or 'hardlink' (see obsigo_assets.py).
+# With `jobs` > 1, files are converted by a pool of worker processes (`executor`, the pool of a batch, when given).
+# Aliases are always added in the order of the sorted source paths so that the first page to claim an alias doesn't
+# depend on the walk order or on the workers.
+# The site index is built before the conversion so that internal links can be resolved (see resolve_internal_link()).
+# The changes of the source files are applied at the end (or only printed with `dry_run`, see apply_source_journal()).
+# Scoped build: only the markdown files and the _assets directories under `only` (a path relative to the source
+# directory) are converted. The entries of the other pages (to collect their aliases and resolve the links to them)
+# come from `known_entries` (the manifest of the last run) when they are unchanged, else from their frontmatter only
+# (these entries have no hash, they are not recorded in the manifest).
+# The config of the site (ignore patterns, rewrite rules...) and the state of the run (timings, destination changes,
+# journal of the source changes) are the ones of `converter`.
+def process_directory(converter, source_directory, destination_directory, site_aliases_dict, stats_dict, manifest_files, jobs=1, assets_copy_mode='copy', dry_run=False, executor=None, only=None, known_entries=None ):
+    md_files = []
+    src_stats = {}
+    converter.source_journal = []
+
+    scan_start_time = time.perf_counter()
+    assets_sync_time = converter.stage_times.get('assets_sync', 0.0)
+    seen_assets_paths = set()
+    ignore_patterns = load_ignore_patterns(source_directory, converter.ignore_patterns)
+    # Hidden and ignored directories are never entered (see obsigo_scan.py)
+    for kind, relative_path, path, stat in scan_source_directory(source_directory, ignore_patterns, stats_dict):
+        if kind == 'assets':
+            if not is_in_scope(relative_path, only):
+                continue
+            seen_assets_paths.add(os.path.normpath(relative_path))
+            # Copy the _assets (images) directory to the destination
+            logger.debug(f"\n\nProcessing directory: {path} ... ")
+            dest_assets_path = os.path.join(destination_directory, relative_path)
+            with converter.timed('assets_sync'):
+                sync_assets_directory(path, dest_assets_path, stats_dict, assets_copy_mode, converter.record_dest_change, stat,
+                                      converter.shared_asset_copies)
+        else:
+            md_files.append((relative_path, path))
+            src_stats[relative_path] = stat
+    # Remove the destination _assets directories whose source directory is gone (in the scope, not ignored):
+    with converter.timed('assets_sync'):
+        prune_assets_directories(destination_directory, seen_assets_paths, stats_dict, converter.record_dest_change,
+                                 lambda rel_path: (not is_in_scope(rel_path, only) and not is_in_scope(only, rel_path))
+                                                  or is_ignored(ignore_patterns, rel_path, True))
+    # (the assets were synced during the walk)
+    converter.stage_times['scan'] = (converter.stage_times.get('scan', 0.0) + time.perf_counter() - scan_start_time
+                                     - (converter.stage_times.get('assets_sync', 0.0) - assets_sync_time))
+
+    # Process the markdown files in a stable order:
+    md_files.sort()
+    page_infos = {}
+    with converter.timed('manifest'):
+        for relative_file_path, file_path in md_files:
+            page_info = check_manifest_entry(file_path, relative_file_path, destination_directory,
+                                             manifest_files if is_in_scope(relative_file_path, only) else known_entries or {},
+                                             src_stats[relative_file_path])
+            if page_info is not None:
+                page_infos[relative_file_path] = page_info
+    if only is not None:
+        with converter.timed('frontmatter_scan'):
+            for relative_file_path, file_path in md_files:
+                if is_in_scope(relative_file_path, only):
+                    continue
+                stats_dict['source_md_files_out_of_scope'] += 1
+                if relative_file_path not in page_infos:
+                    page_infos[relative_file_path] = get_page_entry(read_frontmatter(file_path, converter.parsed_headers), relative_file_path)
+                    stats_dict['source_md_files_frontmatter_only'] += 1
+
+    with converter.timed('site_index'):
+        site_index = build_site_index(md_files, page_infos, converter.parsed_headers)
+
+    jobs_list = []
+    for relative_file_path, file_path in md_files:
+        if not is_in_scope(relative_file_path, only):
             continue
+        page_info = page_infos.get(relative_file_path)
+        if page_info is not None and links_changed(page_info, site_index):
+            # A page it links to was added, moved, removed...
+            logger.debug(f" Unchanged file with changed links: {relative_file_path}")
+            stats_dict['source_md_files_relinked'] += 1
+            page_info = None
+        if page_info is not None:
+            logger.debug(f" Unchanged file: {relative_file_path}")
+            stats_dict['source_md_files_unchanged'] += 1
+        else:
+            page_infos.pop(relative_file_path, None)
+            jobs_list.append((file_path, relative_file_path, destination_directory, src_stats[relative_file_path]))
+
+    logger.info(f"Processing {len(jobs_list)} markdown files ({stats_dict['source_md_files_unchanged']} unchanged)"
+                f"{f' with {jobs} worker processes' if jobs > 1 and len(jobs_list) > 1 else ''}...")
+    if jobs > 1 and len(jobs_list) > 1:
+        site_state = (converter.config, logger.getEffectiveLevel(), site_index)
+        chunksize = max(1, len(jobs_list) // (jobs * 8))
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=site_state))
+                results = executor.map(process_file_job, jobs_list, chunksize=chunksize)
+            else:
+                site_key = next(site_keys)
+                chunks = [(site_key, site_state, jobs_list[i:i + chunksize]) for i in range(0, len(jobs_list), chunksize)]
+                results = itertools.chain.from_iterable(executor.map(process_site_chunk_job, chunks))
+            for (file_path, relative_file_path, dest_root, src_stat), (page_info, file_stats_dict, file_stage_times, file_time, file_dest_changes, file_source_journal, records) in zip(jobs_list, results):
+                for record in records:
+                    logger.handle(record)
+                converter.merge_dest_changes(file_dest_changes)
+                converter.source_journal.extend(file_source_journal)
+                for key, value in file_stats_dict.items():
+                    stats_dict[key] += value
+                # (stage times are summed over all the workers)
+                for stage, seconds in file_stage_times.items():
+                    converter.stage_times[stage] = converter.stage_times.get(stage, 0.0) + seconds
+                converter.file_times[relative_file_path] = file_time
+                page_infos[relative_file_path] = page_info
+    else:
+        for file_path, relative_file_path, dest_root, src_stat in jobs_list:
+            logger.debug(f"\n Processing file: {relative_file_path} ...")
+            page_infos[relative_file_path] = process_file(converter, file_path, relative_file_path, dest_root, stats_dict, site_index, src_stat)
+
+    # Merge the aliases of all pages (processed or unchanged) in the order of the source paths:
+    logger.debug("\nCollecting site aliases...")
+    new_manifest_files = {}
+    with converter.timed('aliases'):
+        for relative_file_path, file_path in md_files:
+            page_info = page_infos[relative_file_path]
+            add_site_aliases(page_info, site_aliases_dict, stats_dict)
+            new_manifest_files[page_info['rel_src_filepath']] = page_info
+
+    with converter.timed('source_writes'):
+        apply_source_journal(converter.source_journal, new_manifest_files, stats_dict, dry_run)
+        converter.source_journal = []
+
+    # Broken links report (unchanged files included: their links were checked against the new site index)
+    for rel_src_filepath, link_url in get_broken_links({rel_src_filepath: entry for rel_src_filepath, entry in new_manifest_files.items()
+                                                        if is_in_scope(rel_src_filepath, only)}):
+        logger.warning(f"!!!WARNING!!! Broken link in {rel_src_filepath}: {link_url}")
+
+    return new_manifest_files
+
+
+# Write the aliases to a netlify _redirects file, followed by the rules of the base redirects file:
+# The rules are compiled first (see obsigo_redirects.py): duplicates and rules that can never match are removed and
+# chains are collapsed to a single hop. `live_uris` are the canonical URIs of the published pages.
+# The file is only rewritten if its contents changed (see write_dest_file()).
+def write_redirects_file(converter, site_aliases_dict, dest_redirects_file, src_redirects_base_file, live_uris=None, stats_dict=None):
+    logger.info("\nAliases dictionary:")
+    # for alias, uri in aliases_dict.items():
+        # print(f"  {alias} -> {uri}")
+    logger.info(f"  Total aliases: {len(site_aliases_dict)}")
 
-        print()
-        print()
-        # print(f"Processing directory: {root} ... files:{files} ... subdirs: {dirs} ...")
-        print(f"Processing directory: {root} ... ")
+    try:
+        # Add the rules of ./static/_redirects_base.txt to this file:
+        base_redirects = ''
+        if os.path.exists(src_redirects_base_file):
+            logger.debug(f"  Adding contents of {src_redirects_base_file} to {dest_redirects_file}")
+            with open(src_redirects_base_file, 'r') as base_file:
+                base_redirects = base_file.read()
+
+        redirects, report = compile_redirects(site_aliases_dict, base_redirects, live_uris)
+        logger.info(f"  Redirect rules: {report['rules_out']} written ({report['rules_in']} in), "
+                    f"{report['duplicates_removed']} duplicates and {report['never_match_removed'] + report['invalid_removed']} "
+                    f"rules that can never match removed, {report['chains_collapsed']} chains collapsed, "
+                    f"{report['loops_detected']} loops detected.")
+        if stats_dict is not None:
+            stats_dict['redirect_rules_written'] += report['rules_out']
+            stats_dict['redirect_rules_removed'] += report['duplicates_removed'] + report['never_match_removed'] + report['invalid_removed']
+            stats_dict['redirect_chains_collapsed'] += report['chains_collapsed']
+            stats_dict['redirect_loops_detected'] += report['loops_detected']
+
+        converter.write_dest_file(dest_redirects_file, redirects.encode('utf-8'))
+    except Exception as e:
+        logger.error(f"ERROR writing redirects file: {e}")
 
-        if cur_dirname == '_assets':
-            # Copy the _assets (images) directory to the destination
-            source_assets_path = root
-            relative_assets_path = os.path.relpath(source_assets_path, source_directory)
-            dest_assets_path = os.path.join(destination_directory, relative_assets_path)
-
-            # if not os.path.exists(dest_assets_path):
-            # CHECK: why do we check if it exists? When does it already exist?
-
-            print()
-            print(f" Copying _assets directory from {source_assets_path} to {dest_assets_path}")
-            # shutil.copytree(source_assets_path, dest_assets_path)
-            # Copy any new or more recent files but don't overwrite files that are newer in the destination
-            # shutil.copytree(source_assets_path, dest_assets_path, dirs_exist_ok=True)
-
-            os.makedirs(dest_assets_path, exist_ok=True)
-
-            for filename in os.listdir(source_assets_path):
-                print(f"  - File: {filename} :", end="")
-                src_file = os.path.join(source_assets_path, filename)
-                dst_file = os.path.join(dest_assets_path, filename)
-                dst_check_file = dst_file
-
-                # Remove destination file first to clear old xattr
-                # if os.path.exists(dst_file):
-                #     os.remove(dst_file)
-                # # Copy the file
-                # shutil.copy2(src_file, dst_file)
-
-                # If its an .heic file, the destination check must be on the .jpeg file
-                if filename.endswith('.heic'):
-                    print(" HEIC file, checked against JPEG equivalent:", end="")
-                    dst_check_file = re.sub(r'\.heic$', '.jpeg', dst_file)
-
-                # Copy if destination doesn't exist or source is newer
-                if not os.path.exists(dst_check_file):
-                    print(" New file.")
-                    shutil.copy2(src_file, dst_file)
-                elif os.path.getmtime(src_file) > os.path.getmtime(dst_check_file):
-                    print(" Updated file.")
-                    os.remove(dst_check_file)   # Remove in order to remove Xattr
-                    shutil.copy2(src_file, dst_file)
-                else:
-                    print(" Unchanged file.")
 
+# Record the run in the index of the site and add the aliases of the history that no page claims anymore to the site
+# aliases dictionary (with `dry_run`, the index is only read, and the history is skipped without an index of this
+# version):
+def add_historical_aliases(index_db_file, manifest_files, site_aliases_dict, stats_dict, dry_run=False):
+    try:
+        connection = open_index(index_db_file, read_only=dry_run)
+        if connection is None:
+            logger.info(f"No index '{index_db_file}' of this version: no aliases from the history.")
+            return
+        try:
+            if dry_run:
+                historical_aliases = get_historical_aliases(connection, manifest_files)
+            else:
+                run, rows_written = update_index(connection, manifest_files, get_main_slug)
+                stats_dict['index_rows_written'] += rows_written
+                historical_aliases = get_historical_aliases(connection, manifest_files, run)
+        finally:
+            connection.close()
+    except sqlite3.Error as e:
+        logger.error(f"ERROR updating index '{index_db_file}': {e}")
+        return
+    for alias, canonical_uri in sorted(historical_aliases.items()):
+        logger.debug(f"    Added alias {alias}->{canonical_uri} from the history.")
+        site_aliases_dict.setdefault(alias, canonical_uri)
+    stats_dict['foreverlinks_from_history'] += len(historical_aliases)
+
+
+# Original in the vault of an image of a page (URL of the Hugo content, see get_page_images()):
+# Returns its path, or None for an external image, a missing file or a format without variants.
+def get_image_source_path(image_url, rel_src_filepath, source_directory):
+    url = LINK_TITLE_RE.match(image_url).group('target').strip('<>')
+    if not url or url.startswith('//') or EXTERNAL_LINK_RE.match(url):
+        return None
+    rel_path = get_vault_path(url, rel_src_filepath)
+    if rel_path.startswith('../') or not rel_path.lower().endswith(VARIANT_EXTENSIONS):
+        return None
+    file_path = os.path.join(source_directory, rel_path)
+    # (HEIC originals are renamed to .jpeg in the Hugo content)
+    for candidate in (file_path, re.sub(r'\.jpeg$', '.heic', file_path)):
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+# Generate the responsive variants of the images of the pages (see obsigo_images.py) and write the images.json data
+# file for the templates:
+# (the originals are known by their absolute path in the cache, which can be shared by several sites)
+def build_image_variants(converter, source_directory, manifest_files, image_variants, data_directory, jobs, stats_dict, executor=None):
+    images = {}
+    for rel_src_filepath, entry in sorted(manifest_files.items()):
+        for image_url in entry['images']:
+            path = get_image_source_path(image_url, rel_src_filepath, source_directory)
+            if path is not None:
+                images.setdefault(os.path.abspath(path), []).append((entry['canonical_uri'], image_url))
+    data, variants_stats = generate_image_variants(
+        images, image_variants['widths'], image_variants['formats'], image_variants['quality'],
+        image_variants['cache_directory'], image_variants['directory'], image_variants['url'], jobs, converter.record_dest_change,
+        executor)
+    stats_dict.update(variants_stats)
+    if data_directory:
+        converter.write_dest_file(os.path.join(data_directory, 'images.json'),
+                                  json.dumps(data, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+
+# Convert the whole site (of `converter`): process the source directory, update the manifest and write the redirects.
+# Files recorded as unchanged in `manifest_files` are skipped (incremental run, empty for a full run) and the
+# destination files of the sources deleted since `previous_manifest_files` are removed. Returns the new manifest
+# entries.
+# With a `data_directory`, the backlinks, tags and related pages are written there for the Hugo templates.
+# With an `index_db_file`, the run is recorded in the index of the site and the aliases of its history that no page
+# claims anymore still redirect (see obsigo_db.py).
+# With `image_variants` settings, the responsive variants of the images of the pages are generated (see
+# build_image_variants()).
+# With `dry_run`, the source files are not modified (their changes are printed as a diff), the manifest is not saved
+# and the run is not recorded in the index.
+# `executor` is the pool of worker processes of a batch (see run_batch()), None to start a pool for the site.
+# Scoped build (`only`, see process_directory()): the destination files out of the scope are left untouched, the
+# manifest keeps the entries of `known_entries` for them, the index is only read and the data files and the image
+# variants (which need all the pages) are not updated. The _redirects file is the same as with a full run.
+def build_site(converter, source_directory, destination_directory, src_redirects_base_file, dest_redirects_file,
+               manifest_file, config_fingerprint, manifest_files, previous_manifest_files, jobs, assets_copy_mode, stats_dict,
+               data_directory=None, related_pages_count=5, dry_run=False, index_db_file=None, image_variants=None,
+               executor=None, only=None, known_entries=None):
+    site_aliases_dict = {}
 
-            continue
+    new_manifest_files = process_directory( converter, source_directory, destination_directory, site_aliases_dict, stats_dict, manifest_files, jobs, assets_copy_mode, dry_run, executor, only, known_entries )
 
-        # Else this is a regular directory, process the files
-        for file in files:
-            if file.endswith('.md'):
-                file_path = os.path.join(root, file)
-                relative_file_path = os.path.relpath(file_path, source_directory)
-                print()
-                print(f" Processing file: {relative_file_path} ...")
+    if only is None:
+        recorded_manifest_files = new_manifest_files
+    else:
+        previous_manifest_files = {rel_src_filepath: entry for rel_src_filepath, entry in previous_manifest_files.items()
+                                   if is_in_scope(rel_src_filepath, only)}
+        # (the entries read from the frontmatter only have no hash)
+        recorded_manifest_files = {rel_src_filepath: entry for rel_src_filepath, entry in new_manifest_files.items()
+                                   if 'hash' in entry}
+    remove_deleted_files(converter, previous_manifest_files, new_manifest_files, destination_directory, stats_dict)
+
+    # (with `dry_run`, the manifest would describe source files that were not written)
+    if not dry_run:
+        with converter.timed('manifest'):
+            save_manifest(manifest_file, config_fingerprint, recorded_manifest_files)
+
+    if index_db_file:
+        with converter.timed('index'):
+            add_historical_aliases(index_db_file, new_manifest_files, site_aliases_dict, stats_dict, dry_run or only is not None)
+
+    # Published pages: they are served instead of being redirected
+    live_uris = {entry['canonical_uri'] for entry in new_manifest_files.values() if not entry['draft']}
+    with converter.timed('redirects'):
+        write_redirects_file(converter, site_aliases_dict, dest_redirects_file, src_redirects_base_file, live_uris, stats_dict)
+
+    if data_directory and only is None:
+        with converter.timed('data'):
+            stats_dict.update(write_data_files(data_directory, new_manifest_files, manifest_files, related_pages_count, converter.write_dest_file))
+
+    if image_variants and only is None:
+        with converter.timed('image_variants'):
+            build_image_variants(converter, source_directory, new_manifest_files, image_variants, data_directory, jobs, stats_dict, executor)
+
+    return recorded_manifest_files
+
+
+# Write the JSON run report: the stats extended with the wall time of each stage, the slowest files and the broken
+# links of the site
+def write_run_report(converter, report_file, stats_dict, total_time, slowest_files_count, profile_report=None, manifest_files=None):
+    slowest_files = sorted(converter.file_times.items(), key=lambda item: item[1], reverse=True)[:slowest_files_count]
+    report = dict(stats_dict,
+                  obsigo_version=OBSIGO_VERSION,
+                  date=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                  total_seconds=round(total_time, 6),
+                  stage_seconds={stage: round(seconds, 6) for stage, seconds in sorted(converter.stage_times.items(), key=lambda item: item[1], reverse=True)},
+                  slowest_files=[{'file': file, 'seconds': round(seconds, 6)} for file, seconds in slowest_files])
+    if manifest_files is not None:
+        report['broken_links'] = [{'file': file, 'link': link_url} for file, link_url in get_broken_links(manifest_files)]
+    if profile_report is not None:
+        report['profile'] = profile_report
+    try:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info(f"Run report written to {report_file}")
+    except OSError as e:
+        logger.error(f"ERROR writing run report file: {e}")
+
+
+# Profile the run (`--profile`) with cProfile (time) and tracemalloc (memory):
+# Only the main process is profiled: worker processes (`--jobs`) are not.
+def start_profiling():
+    import cProfile
+    import tracemalloc
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+# Stop profiling, dump the cProfile stats to `profile_file` (open them with `python3 -m pstats`) and log the top
+# functions and allocations. Returns the profile summary for the run report.
+def stop_profiling(profiler, profile_file, top_count=20):
+    import pstats
+    import tracemalloc
+    profiler.disable()
+    snapshot = tracemalloc.take_snapshot()
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    profiler.dump_stats(profile_file)
+    output = StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(top_count)
+    logger.info(f"\nProfile (saved to {profile_file}):\n{output.getvalue()}")
+
+    top_allocations = snapshot.statistics('lineno')[:top_count]
+    logger.info(f"Memory: {peak_memory / 1e6:.1f} MB peak, {current_memory / 1e6:.1f} MB at the end. Top allocations:")
+    for stat in top_allocations:
+        logger.info(f"  {stat}")
+
+    return {
+        'profile_file': profile_file,
+        'peak_memory_bytes': peak_memory,
+        'top_allocations': [{'location': str(stat.traceback[0]), 'size_bytes': stat.size, 'count': stat.count}
+                            for stat in top_allocations],
+    }
 
-                process_file(file_path, relative_file_path, destination_directory, site_aliases_dict, stats_dict)
 
+# Keep running and regenerate the site each time something changes in the source directory:
+# The manifest stays in memory between batches so only the changed files are processed again.
+# `images_cache_file`: also process the images of the destination after each batch (None = don't)
+def watch_site(converter, source_directory, destination_directory, src_redirects_base_file, dest_redirects_file,
+               manifest_file, config_fingerprint, manifest_files, assets_copy_mode, images_cache_file, changes_file, debounce,
+               data_directory=None, related_pages_count=5, index_db_file=None, image_variants=None):
+    from obsigo_watch import make_watcher, wait_for_changes
 
-if __name__ == "__main__":
+    watcher = make_watcher(source_directory)
+    logger.info(f"\nWatching '{source_directory}' for changes ({type(watcher).__name__})... Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed_paths = wait_for_changes(watcher, debounce)
+            if changed_paths is not None:
+                # Only markdown files, assets and directories (renames...) matter:
+                changed_paths = [path for path in changed_paths
+                                 if path.endswith('.md') or '_assets' in path.split(os.sep) or os.path.isdir(path) or not os.path.exists(path)]
+                if not changed_paths:
+                    continue
+                logger.info(f"\nChanges detected: {', '.join(sorted(changed_paths)[:5])}{' ...' if len(changed_paths) > 5 else ''}")
+            else:
+                logger.info("\nToo many changes detected: checking everything.")
+
+            start_time = time.perf_counter()
+            stats_dict = new_stats_dict(converter.rewrite_rules)
+            converter.dest_changes = new_dest_changes()
+            converter.staged_dest_writes = {}
+            try:
+                manifest_files = build_site(converter, source_directory, destination_directory, src_redirects_base_file, dest_redirects_file,
+                                            manifest_file, config_fingerprint, manifest_files, manifest_files, 1, assets_copy_mode, stats_dict,
+                                            data_directory, related_pages_count, index_db_file=index_db_file,
+                                            image_variants=image_variants)
+            finally:
+                updated_count = converter.commit_staged_writes()
+            if images_cache_file is not None and (stats_dict['assets_files_copied'] or stats_dict['assets_files_pruned']):
+                normalize_images(destination_directory, images_cache_file, record_change=converter.record_dest_change)
+            logger.info(f"\nUpdated {updated_count} destination files ({stats_dict['source_md_files']} markdown files processed) in {time.perf_counter() - start_time:.3f}s.")
+            converter.write_changes_file(changes_file, stats_dict)
+    except KeyboardInterrupt:
+        logger.info("\nStopped watching.")
+    finally:
+        watcher.close()
+
+
+# A site to convert: its configuration (the contents of obsigo.yaml) and the state kept between its runs
+# Other tools can import obsigo and convert in-process, for instance:
+#   converter = Converter(yaml.safe_load(open('obsigo.yaml')))
+#   stats = converter.run(incremental=True)
+# The manifest of the last run stays in memory: the next incremental run doesn't read it again, unless another process
+# saved it since. `stats`, `stage_times` and `file_times` are the ones of the last run.
+# The state of a run (timings, destination changes, journal of the source changes...) is kept by the converter, which
+# the conversion functions of this module take as their first argument. Conversions run in parallel with `jobs` worker
+# processes.
+class Converter:
+
+    # Raises KeyError for a missing setting and ValueError for an invalid one
+    def __init__(self, config):
+        self.config = config
+        self.source_directory = config['source_directory']
+        self.destination_directory = config['destination_directory']
+        self.src_redirects_base_file = config['src_redirects_base_file']
+        self.dest_redirects_file = config['dest_redirects_file']
+        self.unimportant_frontmatter_keys = config['unimportant_frontmatter_keys']
+        self.manifest_file = config.get('manifest_file', './obsigo_manifest.json')
+        self.assets_copy_mode = config.get('assets_copy_mode', 'copy')
+        self.images_cache_file = config.get('images_cache_file', './obsigo_images.json')
+        self.report_file = config.get('report_file', './obsigo_report.json')
+        self.report_slowest_files = config.get('report_slowest_files', 20)
+        self.profile_file = config.get('profile_file', './obsigo.prof')
+        self.changes_file = config.get('changes_file', './obsigo_changes.json')
+        self.data_directory = config.get('hugo_data_directory', './data/obsigo')
+        self.related_pages_count = config.get('related_pages_count', 5)
+        self.rewrite_rules_config = config.get('rewrite_rules') or []
+        self.ignore_patterns = config.get('ignore') or []
+        self.index_db_file = config.get('index_db_file', './obsigo_index.sqlite')
+        # Responsive image variants (see obsigo_images.py): off without widths and formats
+        self.image_variants = {
+            'widths': [int(width) for width in config.get('image_variant_widths') or []],
+            'formats': list(config.get('image_variant_formats') or []),
+            'quality': config.get('image_variant_quality', 80),
+            'cache_directory': config.get('image_variants_cache_directory', './obsigo_variants_cache'),
+            'directory': config.get('image_variants_directory', './static/images/variants'),
+            'url': config.get('image_variants_url', '/images/variants/'),
+        }
+        if not self.image_variants['widths'] and not self.image_variants['formats']:
+            self.image_variants = None
+        if self.assets_copy_mode not in ASSETS_COPY_MODES:
+            raise ValueError(f"Invalid assets_copy_mode '{self.assets_copy_mode}' in config, must be one of: {', '.join(ASSETS_COPY_MODES)}")
+        if self.image_variants and not set(self.image_variants['formats']) <= set(VARIANT_FORMATS):
+            raise ValueError(f"Invalid image_variant_formats in config, must be some of: {', '.join(VARIANT_FORMATS)}")
+        try:
+            self.rewrite_rules = compile_rewrite_rules(self.rewrite_rules_config)
+        except (ValueError, re.error) as e:
+            raise ValueError(f"Invalid rewrite_rules in config: {e}")
+        self.markdown_tokens_re, self.code_tokens_re, self.rules_index, self.code_rules_index = compile_scanners(self.rewrite_rules)
+
+        # Anything in the config that changes the output of the conversion must invalidate the manifest:
+        self.config_fingerprint = {
+            'source_directory': self.source_directory,
+            'destination_directory': self.destination_directory,
+            'unimportant_frontmatter_keys': self.unimportant_frontmatter_keys,
+            'related_pages_count': self.related_pages_count,
+            'rewrite_rules': self.rewrite_rules_config,
+        }
+
+        self.manifest_files = None      # Manifest of the last run (None: read it from manifest_file)
+        self.manifest_mtime_ns = None   # Modification time of manifest_file when it was saved by the last run
+        self.stats = None
+        # Caches shared with the other sites of a batch (see run_batch()), None when not running a batch:
+        # the parsed YAML headers (see parse_yaml_header()) and the copies of the assets (see sync_assets_directory())
+        self.parsed_headers = None
+        self.shared_asset_copies = None
+        self.start_run()
+
+    # Reset the state of a run:
+    # - `stage_times` and `file_times`: wall time of the run, {stage: seconds} and {source file: seconds} (see timed()
+    #   and write_run_report())
+    # - `dest_changes`: destination files added, changed and removed by the run, for the deploy tooling (see
+    #   write_changes_file()). Identical writes are skipped and only counted in 'unchanged'.
+    # - `source_journal`: changes of the source files (vault) collected during the run, applied in one batch at the end
+    #   by apply_source_journal(): [{'rel_src_filepath', 'file_path', 'new_rel_src_filepath', 'new_file_path', 'hash',
+    #   'data'}] (`hash` is the hash of the data read, `data` the new data or None if the file is only renamed)
+    # - `staged_dest_writes`: destination writes of the current watch batch, {dest_file_path: (data or None to remove,
+    #   dest_root)}. None when files are written immediately (see write_dest_file()).
+    def start_run(self):
+        self.stage_times = {}
+        self.file_times = {}
+        self.dest_changes = new_dest_changes()
+        self.source_journal = []
+        self.staged_dest_writes = None
+
+    # Add the wall time spent in a block to a stage of the run report:
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_times[stage] = self.stage_times.get(stage, 0.0) + time.perf_counter() - start_time
+
+    # Record a change of the destination in `dest_changes`:
+    def record_dest_change(self, change, dest_file_path):
+        dest_file_path = os.path.normpath(dest_file_path)
+        if change == 'unchanged':
+            self.dest_changes['unchanged'] += 1
+        elif change == 'removed':
+            self.dest_changes['changed'].discard(dest_file_path)
+            if dest_file_path in self.dest_changes['added']:
+                # Added and removed by the same run: nothing to deploy
+                self.dest_changes['added'].discard(dest_file_path)
+            else:
+                self.dest_changes['removed'].add(dest_file_path)
+        elif change == 'added' and dest_file_path in self.dest_changes['removed']:
+            self.dest_changes['removed'].discard(dest_file_path)
+            self.dest_changes['changed'].add(dest_file_path)
+        elif dest_file_path not in self.dest_changes['added']:
+            self.dest_changes[change].add(dest_file_path)
+
+    # Write a file to the destination directory, creating its directory if needed:
+    # Files with the same contents are not written again (their mtime doesn't change, so Hugo and the deploy tooling
+    # leave them alone). Other files are written atomically.
+    # In watch mode, writes are staged and applied by commit_staged_writes() at the end of the batch.
+    def write_dest_file(self, dest_file_path, data):
+        if self.staged_dest_writes is not None:
+            self.staged_dest_writes[dest_file_path] = (data, None)
+            return
+
+        change = compare_dest_file(dest_file_path, data)
+        self.record_dest_change(change, dest_file_path)
+        if change == 'unchanged':
+            logger.debug(f"  Unchanged destination file: {dest_file_path}")
+            return
+
+        # Check if we need to create the directory:
+        dest_dir = os.path.dirname(dest_file_path)
+        if dest_dir and not os.path.exists(dest_dir):
+            logger.debug(f"  Creating destination directory: {dest_dir}")
+            os.makedirs(dest_dir)
+
+        write_file_atomic(dest_file_path, data)
+
+    # Remove a file from the destination directory, and its parent directories if they are now empty:
+    def remove_dest_file(self, dest_file_path, dest_root):
+        if self.staged_dest_writes is not None:
+            self.staged_dest_writes[dest_file_path] = (None, dest_root)
+            return
+
+        if os.path.exists(dest_file_path):
+            os.remove(dest_file_path)
+            self.record_dest_change('removed', dest_file_path)
+        # Clean up the now empty directories:
+        dest_dir = os.path.dirname(dest_file_path)
+        while os.path.abspath(dest_dir) != os.path.abspath(dest_root) and os.path.isdir(dest_dir) and not os.listdir(dest_dir):
+            os.rmdir(dest_dir)
+            dest_dir = os.path.dirname(dest_dir)
+
+    # Apply the destination writes staged during a watch batch:
+    # All new contents are first written to hidden temporary files next to their destination, then they are all swapped
+    # in with os.replace() in one go, so Hugo never reads a half-written file and its watcher rebuilds the site once.
+    # Files with the same contents are left alone.
+    # Returns the number of destination files updated.
+    def commit_staged_writes(self):
+        staged_writes, self.staged_dest_writes = self.staged_dest_writes, None
+
+        temp_files = []
+        for dest_file_path, (data, dest_root) in staged_writes.items():
+            if data is None:
+                continue
+            change = compare_dest_file(dest_file_path, data)
+            self.record_dest_change(change, dest_file_path)
+            if change == 'unchanged':
+                continue
+            dest_dir = os.path.dirname(dest_file_path)
+            if dest_dir:
+                os.makedirs(dest_dir, exist_ok=True)
+            temp_file_path = os.path.join(dest_dir, '.' + os.path.basename(dest_file_path) + '.obsigo-tmp')
+            with open(temp_file_path, 'wb') as output_file:
+                output_file.write(data)
+            temp_files.append((temp_file_path, dest_file_path))
+
+        for temp_file_path, dest_file_path in temp_files:
+            os.replace(temp_file_path, dest_file_path)
+        removed_count = 0
+        for dest_file_path, (data, dest_root) in staged_writes.items():
+            if data is None:
+                removed_count += os.path.exists(dest_file_path)
+                self.remove_dest_file(dest_file_path, dest_root)
+
+        return len(temp_files) + removed_count
+
+    # Merge the destination changes of a worker process:
+    def merge_dest_changes(self, changes):
+        for change in ('added', 'changed', 'removed'):
+            for dest_file_path in changes[change]:
+                self.record_dest_change(change, dest_file_path)
+        self.dest_changes['unchanged'] += changes['unchanged']
+
+    # Write the list of the destination files added, changed and removed by the run (JSON), so that the deploy tooling
+    # can only upload the delta. Paths are relative to the current directory, like the paths of the config.
+    def write_changes_file(self, changes_file, stats_dict):
+        changes = {change: sorted(self.dest_changes[change]) for change in ('added', 'changed', 'removed')}
+        changes['unchanged_count'] = self.dest_changes['unchanged']
+        stats_dict['dest_files_added'] = len(changes['added'])
+        stats_dict['dest_files_changed'] = len(changes['changed'])
+        stats_dict['dest_files_removed'] = len(changes['removed'])
+        stats_dict['dest_files_unchanged'] = changes['unchanged_count']
+        try:
+            write_file_atomic(changes_file, (json.dumps(changes, indent=1) + '\n').encode('utf-8'))
+        except OSError as e:
+            logger.error(f"ERROR writing changes file: {e}")
+        logger.info(f"Destination changes: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+                    f"{len(changes['removed'])} removed, {changes['unchanged_count']} unchanged (see {changes_file}).")
+
+
+    # Manifest of the previous run: (recorded files, up to date), see load_manifest()
+    # The one kept in memory by the last run, unless another process saved a manifest since.
+    def load_previous_manifest(self):
+        try:
+            mtime_ns = os.stat(self.manifest_file).st_mtime_ns
+        except OSError:
+            mtime_ns = None
+        if self.manifest_files is not None and mtime_ns == self.manifest_mtime_ns:
+            return self.manifest_files, True
+        return load_manifest(self.manifest_file, self.config_fingerprint)
+
+    # Convert the site (see the options of obsigo.py): `keep` the destination directory, `incremental` run (only the
+    # files changed since the last run), `images` processed in the destination (-i)... on the pool of worker processes
+    # of a batch (`executor`, see run_batch()) or a pool of `jobs` workers started for the run.
+    # Scoped build (`only`, see get_scope()): only the files under this path of the source directory are converted,
+    # the rest of the destination is kept.
+    # Returns the stats of the run.
+    def run(self, keep=False, incremental=False, jobs=1, dry_run=False, images=False, profile=False, executor=None, only=None):
+        self.start_run()
+        # Ensure the destination directory is empty
+        if os.path.exists(self.destination_directory):
+            # Check if we got the -k or --keep argument
+            if keep or incremental or only is not None:
+                logger.info(f"Keeping destination directory: '{self.destination_directory}'.")
+            else:
+                logger.info(f"Emptying destination directory: '{self.destination_directory}'.")
+                shutil.rmtree(self.destination_directory)
+        else:
+            logger.info(f"Creating destination directory: '{self.destination_directory}'.")
+            os.makedirs(self.destination_directory)
+
+        stats_dict = new_stats_dict(self.rewrite_rules)
+        run_start_time = time.perf_counter()
+        if profile:
+            profiler = start_profiling()
+
+        # The manifest of the previous run tells which files are unchanged (incremental run) and which destination
+        # files have no source anymore (whenever the destination directory is kept):
+        if keep or incremental or only is not None:
+            previous_manifest_files, manifest_up_to_date = self.load_previous_manifest()
+        else:
+            previous_manifest_files, manifest_up_to_date = {}, False
+        if incremental and manifest_up_to_date:
+            manifest_files = previous_manifest_files
+        else:
+            manifest_files = {}
+        # (a scoped build takes the entries of the pages out of its scope from the manifest when it is up to date)
+        known_entries = previous_manifest_files if manifest_up_to_date else {}
+        if only is not None:
+            logger.info(f"Scoped build: only converting '{only}'.")
+
+        jobs = jobs if jobs > 0 else os.cpu_count()
+
+        manifest_files = build_site(self, self.source_directory, self.destination_directory, self.src_redirects_base_file,
+                                    self.dest_redirects_file, self.manifest_file, self.config_fingerprint, manifest_files,
+                                    previous_manifest_files, jobs, self.assets_copy_mode, stats_dict, self.data_directory,
+                                    self.related_pages_count, dry_run, self.index_db_file, self.image_variants, executor,
+                                    only, known_entries)
+        # (with `dry_run`, the manifest was not saved)
+        if not dry_run and os.path.exists(self.manifest_file):
+            self.manifest_files = manifest_files
+            self.manifest_mtime_ns = os.stat(self.manifest_file).st_mtime_ns
+
+        images_root = self.destination_directory if only is None else os.path.join(self.destination_directory, only)
+        if images and os.path.isdir(images_root):
+            logger.info("\nProcessing images...")
+            with self.timed('images'):
+                stats_dict.update(normalize_images(images_root, self.images_cache_file, jobs, self.record_dest_change, executor))
+
+        run_time = time.perf_counter() - run_start_time
+        profile_report = stop_profiling(profiler, self.profile_file) if profile else None
+
+        self.write_changes_file(self.changes_file, stats_dict)
+
+        logger.info(f"\nDone in {run_time:.3f}s.")
+        logger.info(f"Assets: {stats_dict['assets_bytes_copied'] / 1e6:.1f} MB copied, {stats_dict['assets_bytes_skipped'] / 1e6:.1f} MB skipped.")
+
+        # Display stats:
+        logger.info("\nStats:")
+        for key, value in stats_dict.items():
+            logger.info(f"  {key}: {value}")
+
+        # Display the time spent in each stage (summed over the worker processes with --jobs):
+        logger.info("\nTimings:")
+        for stage, seconds in sorted(self.stage_times.items(), key=lambda item: item[1], reverse=True):
+            logger.info(f"  {stage}: {seconds:.3f}s")
+
+        write_run_report(self, self.report_file, stats_dict, run_time, self.report_slowest_files, profile_report, manifest_files)
+        self.stats = stats_dict
+        return stats_dict
+
+    # Scope of a scoped build (--only): a path relative to the source directory, or a path under the source directory
+    # relative to the current directory. Returns the path relative to the source directory (None for the whole site),
+    # raises ValueError if it is not in the source directory.
+    def get_scope(self, only):
+        scope = os.path.normpath(only)
+        if not os.path.exists(os.path.join(self.source_directory, scope)):
+            scope = os.path.relpath(os.path.abspath(only), os.path.abspath(self.source_directory))
+            if scope.startswith('..') or not os.path.exists(only):
+                raise ValueError(f"--only: '{only}' is not in the source directory '{self.source_directory}'.")
+        return None if scope == '.' else scope
+
+    # Keep running and convert the site again when it changes (after a run, see watch_site())
+    def watch(self, images=False):
+        watch_site(self, self.source_directory, self.destination_directory, self.src_redirects_base_file,
+                   self.dest_redirects_file, self.manifest_file, self.config_fingerprint, self.manifest_files or {},
+                   self.assets_copy_mode, self.images_cache_file if images else None, self.changes_file,
+                   self.config.get('watch_debounce', 0.3), self.data_directory, self.related_pages_count,
+                   self.index_db_file, self.image_variants)
+
+    # Write the link audit of the site (see obsigo_audit.py): returns its summary
+    def audit(self, output='-', report_format='json', check=False):
+        links = collect_site_links(self, self.source_directory)
+        check_results = None
+        if check:
+            check_results, checked_count = check_urls(
+                list(get_external_urls(links)), self.config.get('audit_cache_file', './obsigo_audit_cache.json'),
+                self.config.get('audit_cache_ttl_days', 7) * 24 * 3600, self.config.get('audit_concurrency', 20),
+                self.config.get('audit_per_host', 2), self.config.get('audit_timeout', 10))
+        return write_audit_report(links, output, report_format, check_results)
+
+    # Look up the index of the site (see obsigo_db.py): returns the rows, None without index (of this version)
+    def query(self, kind, value=None):
+        if not self.index_db_file:
+            return None
+        connection = open_index(self.index_db_file, read_only=True)
+        if connection is None:
+            return None
+        try:
+            return query_index(connection, kind, value)
+        finally:
+            connection.close()
+
+
+def read_config(config_file):
+    with open(config_file, 'r') as file:
+        return yaml.safe_load(file) or {}
+
+
+# Converter of a site, kept in `converters` (by the daemon, see main()) as long as its config files don't change:
+# `load_config()` returns its config. Raises KeyError or ValueError for an invalid config (see Converter).
+def get_converter(converters, name, config_files, load_config):
+    config_key = tuple(os.stat(config_file).st_mtime_ns for config_file in config_files)
+    cached = converters.get(name) if converters is not None else None
+    if cached is not None and cached[0] == config_key:
+        return cached[1]
+    converter = Converter(load_config())
+    if converters is not None:
+        converters[name] = (config_key, converter)
+    return converter
+
+
+# Settings of a multi-site config that are paths (relative to the multi-site config)
+def is_path_setting(key):
+    return key.endswith(('_file', '_directory'))
+
+
+# Sites of a batch: [(name, directory, config, config files)]
+# A batch file is the config of a site (an obsigo.yaml, its paths are relative to its directory) or a multi-site
+# config: its `sites` are config files (relative to it) or inline configs (with the `directory` their paths are
+# relative to), and its other settings are the defaults of all its sites (a shared images cache...).
+def load_batch_sites(batch_files):
+    sites = []
+    for batch_file in batch_files:
+        batch_file = os.path.abspath(batch_file)
+        batch_directory = os.path.dirname(batch_file)
+        batch_config = read_config(batch_file)
+        if 'sites' not in batch_config:
+            sites.append((batch_file, batch_directory, batch_config, (batch_file,)))
+            continue
+        shared = {key: os.path.join(batch_directory, value) if is_path_setting(key) and isinstance(value, str) and value else value
+                  for key, value in batch_config.items() if key != 'sites'}
+        for position, site in enumerate(batch_config['sites'] or []):
+            if isinstance(site, str):
+                site_file = os.path.join(batch_directory, site)
+                sites.append((site_file, os.path.dirname(site_file), dict(shared, **read_config(site_file)),
+                              (batch_file, site_file)))
+            else:
+                sites.append((f"{batch_file}#{position + 1}", os.path.join(batch_directory, site.get('directory', '.')),
+                              dict(shared, **site), (batch_file,)))
+    return sites
+
+
+# Convert several sites in one process (`obsigo.py batch`):
+# The sites share a pool of worker processes, the parsed frontmatters of their notes (see parse_yaml_header()) and the
+# copies of their assets (see sync_assets_directory()). Each site is converted in its directory with its own aliases,
+# redirects, manifest and report. The stats and timings of each site and of the whole batch are written to
+# `report_file`. Returns the exit code: 1 if a site failed (the other sites are converted anyway).
+def run_batch(sites, converters, keep, incremental, jobs, dry_run, images, profile, report_file):
+    jobs = jobs if jobs > 0 else os.cpu_count()
+    batch_start_time = time.perf_counter()
+    results = []
+    saved_cwd = os.getcwd()
+    parsed_headers, shared_asset_copies = {}, {}
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if jobs > 1:
+            executor = stack.enter_context(BatchExecutor(jobs))
+        for name, directory, config, config_files in sites:
+            site = os.path.relpath(name, saved_cwd)
+            logger.info(f"\n=== Site {site} ===")
+            result = {'site': site, 'directory': os.path.relpath(directory, saved_cwd)}
+            results.append(result)
+            site_start_time = time.perf_counter()
+            converter = None
+            try:
+                converter = get_converter(converters, name, config_files, lambda config=config: config)
+                converter.parsed_headers, converter.shared_asset_copies = parsed_headers, shared_asset_copies
+                os.chdir(directory)
+                if not os.path.exists(converter.source_directory):
+                    raise ValueError(f"Source directory '{converter.source_directory}' does not exist.")
+                result['stats'] = converter.run(keep, incremental, jobs, dry_run, images, profile, executor)
+                result['stages'] = {stage: round(seconds, 6) for stage, seconds in converter.stage_times.items()}
+            except KeyError as e:
+                result['error'] = f"Missing {e} in config."
+            except (OSError, ValueError) as e:
+                result['error'] = str(e)
+            except Exception as e:
+                logger.exception(f"ERROR converting site {site}: {e}")
+                result['error'] = f"{type(e).__name__}: {e}"
+            finally:
+                os.chdir(saved_cwd)
+                # (the daemon keeps the converter: its next runs may not be part of a batch)
+                if converter is not None:
+                    converter.parsed_headers, converter.shared_asset_copies = None, None
+            result['time'] = round(time.perf_counter() - site_start_time, 6)
+            if 'error' in result:
+                logger.error(f"ERROR: site {site} failed: {result['error']}")
+
+    # Totals of the batch:
+    total_stats = {}
+    total_stages = {}
+    for result in results:
+        for key, value in result.get('stats', {}).items():
+            total_stats[key] = total_stats.get(key, 0) + value
+        for stage, seconds in result.get('stages', {}).items():
+            total_stages[stage] = round(total_stages.get(stage, 0.0) + seconds, 6)
+    total_time = time.perf_counter() - batch_start_time
+
+    logger.info(f"\nBatch: {len(results)} sites in {total_time:.3f}s.")
+    for result in results:
+        if 'error' in result:
+            logger.info(f"  {result['site']}: failed in {result['time']:.3f}s")
+            continue
+        stats = result['stats']
+        logger.info(f"  {result['site']}: {result['time']:.3f}s, {stats['source_md_files']} files converted "
+                    f"({stats['source_md_files_unchanged']} unchanged), {stats['assets_files_copied']} assets copied, "
+                    f"{stats['assets_files_shared']} shared")
+    logger.info("\nTimings (all sites):")
+    for stage, seconds in sorted(total_stages.items(), key=lambda item: item[1], reverse=True):
+        logger.info(f"  {stage}: {seconds:.3f}s")
+
+    report = {
+        'obsigo_version': OBSIGO_VERSION,
+        'total_time': round(total_time, 6),
+        'jobs': jobs,
+        'stats': total_stats,
+        'stages': total_stages,
+        'sites': results,
+    }
+    try:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=1)
+        logger.info(f"Batch report written to {report_file}")
+    except OSError as e:
+        logger.error(f"ERROR writing batch report file: {e}")
+    return 1 if any('error' in result for result in results) else 0
 
-    # Use a library to get command line options
-    import argparse
 
+def make_parser():
     parser = argparse.ArgumentParser(description='Preprocess Obsidian markdown files for Hugo')
     parser.add_argument('-k', '--keep', action='store_true', help='Keep the destination directory')
-    parser.add_argument('-i', action='store_true', help='Process images in the destination directory')
+    parser.add_argument('-i', action='store_true', help='Process images in the destination directory (HEIC to JPEG, sRGB)')
     parser.add_argument('-lhs', action='store_true', help='Start a Local Hugo Server after processing')
-    args = parser.parse_args()
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes used to convert files (0 = one per CPU core)')
+    parser.add_argument('-u', '--incremental', action='store_true', help='Only process files that changed since the last run (implies --keep)')
+    parser.add_argument('-w', '--watch', action='store_true', help='Keep running and process files again when they change (implies --incremental)')
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument('-q', '--quiet', action='store_true', help='Only log errors')
+    verbosity.add_argument('-v', '--verbose', action='store_true', help='Log the details of every file (links, tags, images, assets...)')
+    parser.add_argument('--profile', action='store_true', help='Profile the run with cProfile and tracemalloc')
+    parser.add_argument('--only', metavar='SUBPATH', help='Only convert the files under this path of the source directory, leave the rest of the destination untouched')
+    parser.add_argument('-n', '--dry-run', action='store_true', help="Don't modify the source files: print their changes as a diff")
+    subparsers = parser.add_subparsers(dest='command')
+    audit_parser = subparsers.add_parser('audit', help="Report all the links of the site, without writing anything else (see obsigo_audit.py)")
+    audit_parser.add_argument('-o', '--output', default='-', help='Report file (default: stdout)')
+    audit_parser.add_argument('--format', choices=('json', 'csv'), default='json', help='Report format (default: json)')
+    audit_parser.add_argument('--check', action='store_true', help='Check the external URLs (results cached in audit_cache_file)')
+    query_parser = subparsers.add_parser('query', help="Look up the index of the site: aliases, pages, slugs and their history (see obsigo_db.py)")
+    query_parser.add_argument('kind', choices=QUERY_KINDS, help='What to look up (conflicts: aliases claimed by several pages)')
+    query_parser.add_argument('value', nargs='?', help='Alias, page (source path, URI, slug or alias) or slug')
+    query_parser.add_argument('--json', action='store_true', help='Print the rows as JSON')
+    batch_parser = subparsers.add_parser('batch', help="Convert several sites in one process, sharing the worker processes and the caches (see run_batch())")
+    batch_parser.add_argument('configs', nargs='+', help='Config files of the sites (obsigo.yaml) or multi-site configs (with `sites:`)')
+    batch_parser.add_argument('--report', default='./obsigo_batch_report.json', help='Batch report file (default: ./obsigo_batch_report.json)')
+    daemon_parser = subparsers.add_parser('daemon', help="Keep obsigo running and serve the runs of obsigo.sh on a Unix socket (see obsigo_daemon.py)")
+    daemon_parser.add_argument('--socket', default=os.environ.get('OBSIGO_SOCKET', os.path.expanduser('~/.obsigo.sock')),
+                               help='Path of the socket (default: $OBSIGO_SOCKET or ~/.obsigo.sock)')
+    return parser
+
+
+# Run obsigo.py with its command line arguments (`argv`, default: sys.argv) in the current directory:
+# Returns the exit code. `converters` keeps the converters between calls, by config file (see obsigo_daemon.py).
+def main(argv=None, converters=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.dry_run and args.watch:
+        parser.error("--dry-run can't be used with --watch")
+    if args.command == 'batch' and args.watch:
+        parser.error("batch can't be used with --watch")
+    if args.only is not None and (args.watch or args.command == 'batch'):
+        parser.error("--only can't be used with --watch or batch")
+    if args.command == 'query' and (args.value is None) != (args.kind == 'conflicts'):
+        parser.error(f"query {args.kind} {'takes no value' if args.kind == 'conflicts' else 'needs a value'}")
+
+    # Log to stderr, without decoration. Other libraries (Pillow...) only log their warnings.
+    # (stdout is kept for the dry-run diff, the audit report and the query results)
+    logging.basicConfig(level=logging.WARNING, format='%(message)s', stream=sys.stderr)
+    logger.setLevel(logging.ERROR if args.quiet else logging.DEBUG if args.verbose else logging.INFO)
+
+    if args.command == 'daemon':
+        from obsigo_daemon import serve
+        return serve(args.socket, main)
+    if args.watch and converters is not None:
+        logger.error("The daemon can't watch the source directory: run obsigo.py -w directly.")
+        return 1
+
+    logger.info(f"Obsigo v{OBSIGO_VERSION} - Preprocess Obsidian markdown files for Hugo")
+
+    if args.command == 'batch':
+        try:
+            sites = load_batch_sites(args.configs)
+        except (OSError, yaml.YAMLError) as e:
+            logger.error(f"Can't read the batch configs: {e}")
+            return 1
+        return run_batch(sites, converters, args.keep, args.incremental, args.jobs, args.dry_run, args.i, args.profile, args.report)
 
     # Load config
     config_file = "./obsigo.yaml"
     if not os.path.exists(config_file):
-        print(f"Configuration file '{config_file}' does not exist.")
-        exit(1)
-    with open(config_file, 'r') as file:
-        config = yaml.safe_load(file)
-
-    source_directory = config['source_directory']
-    destination_directory = config['destination_directory']
-    src_redirects_base_file = config['src_redirects_base_file']
-    dest_redirects_file = config['dest_redirects_file']
-    unimportant_frontmatter_keys = config['unimportant_frontmatter_keys']
-
-    with open("./obsigo_dest.txt", "w") as f:
-        f.write(destination_directory)
-
-
-    site_aliases_dict = {}
+        logger.error(f"Configuration file '{config_file}' does not exist.")
+        return 1
+    # (the daemon keeps the converter of a site as long as its config doesn't change)
+    try:
+        converter = get_converter(converters, os.path.abspath(config_file), (config_file,), lambda: read_config(config_file))
+    except KeyError as e:
+        logger.error(f"Missing {e} in config.")
+        return 1
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
+
+    if args.command == 'query':
+        rows = converter.query(args.kind, args.value)
+        if rows is None:
+            logger.error(f"Index '{converter.index_db_file}' does not exist or was made by another version: run obsigo first.")
+            return 1
+        if args.json:
+            print(json.dumps(rows, indent=1))
+        else:
+            sys.stdout.write(format_rows(rows))
+        logger.info(f"{len(rows)} rows.")
+        # (no rows is an answer too: no conflicts, unknown alias...)
+        return 0
 
     # Check if teh source directory exists
-    if not os.path.exists(source_directory):
-        print(f"Source directory '{source_directory}' does not exist.")
-        exit(1)
-
-    # Ensure the destination directory is empty
-    if os.path.exists(destination_directory):
-        # Check if we got the -k or --keep argument
-        if args.keep:
-            print(f"Keeping destination directory: '{destination_directory}'.")
-        else:
-            print(f"Emptying destination directory: '{destination_directory}'.")
-            shutil.rmtree(destination_directory)
-    else:
-        print(f"Creating destination directory: '{destination_directory}'.")
-        os.makedirs(destination_directory)
+    if not os.path.exists(converter.source_directory):
+        logger.error(f"Source directory '{converter.source_directory}' does not exist.")
+        return 1
 
+    if args.command == 'audit':
+        summary = converter.audit(args.output, args.format, args.check)
+        logger.info(', '.join(f"{key}: {value}" for key, value in summary.items()))
+        return 0
 
-    stats_dict = {
-        'source_md_files': 0,
-        'frontmatter_source_cleanups': 0,
-        'youtube_links_converted': 0,
-        'aliases_collected': 0,
-        'slugs_collected': 0,
-        'index_md_files_renamed': 0,  # index.md files renamed to slug.md
-        'divergent_slugs_fixed': 0, # Old slug becomes an alias and filename becomes new slug
-        'missing_slugs_fixed': 0,   # Missing slug added to source
-        'foreverlinks_collected': 0,
-        'foreverlinks_conflicts_detected': 0,
-        'links_removed_index.md': 0,
-        'links_removed_duplicate_filename.md': 0
-    }
+    try:
+        only = converter.get_scope(args.only) if args.only is not None else None
+    except ValueError as e:
+        logger.error(str(e))
+        return 1
 
-    process_directory( source_directory, destination_directory, site_aliases_dict, stats_dict )
+    converter.run(args.keep or args.watch, args.incremental or args.watch, args.jobs, args.dry_run, args.i, args.profile, only=only)
 
-    # Display the aliases dictionary in alphabetical order:
-    site_aliases_dict = dict(sorted(site_aliases_dict.items()))
-    print("\nAliases dictionary:")
-    # for alias, uri in aliases_dict.items():
-        # print(f"  {alias} -> {uri}")
-    print(f"  Total aliases: {len(site_aliases_dict)}")
-    # Write it to a netlify _redirects file:
-    try:
-        with open( dest_redirects_file, 'w') as f:
-            for alias, uri in site_aliases_dict.items():
-                f.write(f"*/{alias} {uri} 301\n")
-
-            # Add the contents of ./static/_redirects_base.txt to this file:
-            if os.path.exists(src_redirects_base_file):
-                print(f"  Adding contents of {src_redirects_base_file} to {dest_redirects_file}")
-                with open(src_redirects_base_file, 'r') as base_file:
-                    f.write(base_file.read())
-    except Exception as e:
-        print(f"ERROR writing redirects file: {e}")
+    if args.watch:
+        converter.watch(args.i)
+    return 0
 
-    print("\nDone.")
 
-    # Display stats:
-    print("\nStats:")
-    for key, value in stats_dict.items():
-        print(f"  {key}: {value}")
+if __name__ == "__main__":
+    exit(main())
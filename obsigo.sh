@@ -8,35 +8,83 @@ echo "The script is located at: $script_path"
 # Display current working directory
 echo "Current working directory: $(pwd)"
 
-# Activate python venv
-source $script_path/venv/bin/activate
+# Check which options were passed (exact matches: '--incremental' is not '-i')
+run_hugo_server=0
+watch=0
+for arg in "$@"; do
+    case "$arg" in
+        -lhs) run_hugo_server=1 ;;
+        -w|--watch) watch=1 ;;
+    esac
+done
 
-# Run the python script and pass any arguments
-python $script_path/obsigo.py "$@"
+# In watch mode obsigo keeps running: start the local hugo server in the background first
+if [[ $watch -eq 1 && $run_hugo_server -eq 1 ]]; then
+    echo "Starting local hugo server in the background..."
+    ./hugo134-3 server &
+    hugo_pid=$!
+    trap 'kill $hugo_pid 2>/dev/null' EXIT
+    run_hugo_server=0
+fi
 
-# Store the exit code
-exit_code=$?
+# With a running daemon (obsigo.py daemon), send it the run instead of starting python with all the imports (see
+# obsigo_daemon.py): the client only uses the standard library of python3. The run fails if the answer doesn't end with
+# the exit code line (daemon stopped during the run...).
+socket_path="${OBSIGO_SOCKET:-$HOME/.obsigo.sock}"
+daemon_client='
+import socket, sys
+prefix = "obsigo-exit: "
+exit_line = None
+try:
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(sys.argv[1])
+        client.sendall(("\n".join(sys.argv[2:]) + "\n\n").encode("utf-8"))
+        with client.makefile("r", encoding="utf-8", newline="\n") as answer:
+            for line in answer:
+                if exit_line is not None:
+                    sys.stdout.write(exit_line)
+                    exit_line = None
+                if line.startswith(prefix):
+                    exit_line = line
+                else:
+                    sys.stdout.write(line)
+                    sys.stdout.flush()
+except OSError as e:
+    sys.exit(f"Error: obsigo daemon: {e}")
+if exit_line is None or not exit_line[len(prefix):].strip().isdigit():
+    sys.exit("Error: obsigo daemon: no exit code in the answer")
+sys.exit(int(exit_line[len(prefix):]))
+'
+if [[ $watch -eq 0 && -S "$socket_path" ]] && command -v python3 >/dev/null; then
+    python3 -c "$daemon_client" "$socket_path" "$PWD" "$@"
+    exit_code=$?
+    if [[ $exit_code -ne 0 ]]; then
+        echo "Error: obsigo daemon run failed with exit code $exit_code"
+        exit $exit_code
+    fi
+else
+    # Activate python venv
+    source $script_path/venv/bin/activate
 
-# Check if python script failed
-if [ $exit_code -ne 0 ]; then
-    echo "Error: obsigo.py failed with exit code $exit_code"
-    deactivate  # Make sure to deactivate venv before exiting
-    exit $exit_code
-fi
+    # Run the python script and pass any arguments
+    python $script_path/obsigo.py "$@"
 
-# Deactivate python venv
-deactivate
+    # Store the exit code
+    exit_code=$?
 
-# check if any of the params is '-i' for imagego:
-if [[ "$@" == *"-i"* ]]; then
-    echo
-    OBSIGO_DEST=$(cat ./obsigo_dest.txt)
-    echo "Running imagego on $OBSIGO_DEST"
-    $script_path/imagego.sh "$OBSIGO_DEST"
+    # Check if python script failed
+    if [ $exit_code -ne 0 ]; then
+        echo "Error: obsigo.py failed with exit code $exit_code"
+        deactivate  # Make sure to deactivate venv before exiting
+        exit $exit_code
+    fi
+
+    # Deactivate python venv
+    deactivate
 fi
 
 # check if any of the params is '-lhs'
-if [[ "$@" == *"-lhs"* ]]; then
+if [[ $run_hugo_server -eq 1 ]]; then
     echo
     echo "Starting local hugo server..."
     ./hugo134-3 server
@@ -0,0 +1,212 @@
+# Synchronize the _assets directories (images...) from the source to the destination
+
+import os
+import re
+import shutil
+import logging
+
+try:
+    import fcntl
+except ImportError:     # Windows
+    fcntl = None
+
+logger = logging.getLogger('obsigo.assets')
+
+# ioctl to clone a file on copy-on-write filesystems (Btrfs, XFS, bcachefs...): see `man ioctl_ficlone`
+FICLONE = 0x40049409
+
+# How to copy assets: 'copy' (reflink or regular copy) or 'hardlink' (no copy at all, but the destination then
+# shares its data with the source: never edit destination assets in place!)
+ASSETS_COPY_MODES = ('copy', 'hardlink')
+
+
+# Name of the destination file for a source asset:
+# HEIC images are copied as is but converted to JPEG in the destination (see obsigo_images.py)
+# so the JPEG counts too.
+def dest_asset_names(filename):
+    if filename.endswith('.heic'):
+        return [re.sub(r'\.heic$', '.jpeg', filename), filename]
+    return [filename]
+
+
+# Check if a destination asset is up to date with the source:
+# The destination may have been converted after the copy (sRGB, HEIC->JPEG) so a more recent destination file is
+# up to date whatever its size.
+def is_asset_up_to_date(src_stat, dest_stat):
+    if dest_stat.st_mtime_ns > src_stat.st_mtime_ns:
+        return True
+    return dest_stat.st_mtime_ns == src_stat.st_mtime_ns and dest_stat.st_size == src_stat.st_size
+
+
+# Copy data from a file to another with the fastest method available:
+# Returns the name of the method used.
+def copy_file_data(fsrc, fdst, size):
+    # Reflink: the destination shares the data blocks of the source until one of them is modified
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+
+    # copy_file_range(): copy in the kernel (may also reflink or do a server side copy on NFS)
+    if hasattr(os, 'copy_file_range'):
+        try:
+            copied = 0
+            while copied < size:
+                count = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return 'copy_file_range'
+        except OSError:
+            # Not supported here (cross filesystem on old kernels...): start over
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    return 'copy'
+
+
+# Copy a single asset, keeping its modification time (like shutil.copy2()):
+# Returns the name of the method used.
+def copy_asset(src_file, dst_file, size, copy_mode):
+    # Never write into an existing destination: it may be a hard link to the source!
+    if os.path.lexists(dst_file):
+        os.remove(dst_file)
+
+    if copy_mode == 'hardlink':
+        try:
+            os.link(src_file, dst_file)
+            return 'hardlink'
+        except OSError:
+            # Different filesystems...: fall back to a copy
+            pass
+
+    with open(src_file, 'rb') as fsrc, open(dst_file, 'wb') as fdst:
+        method = copy_file_data(fsrc, fdst, size)
+    shutil.copystat(src_file, dst_file)
+    return method
+
+
+# Get the stats of all the files in a directory in one go:
+def scan_files(path):
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name: entry.stat() for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return {}
+
+
+# Key of a source file in the shared copies of a batch: the same file, unchanged
+def source_file_key(src_stat):
+    return src_stat.st_dev, src_stat.st_ino, src_stat.st_size, src_stat.st_mtime_ns
+
+
+# Check if a destination file is still an exact copy of its source (not converted since, see is_asset_up_to_date()):
+def is_exact_copy(src_stat, dest_stat):
+    return dest_stat is not None and dest_stat.st_mtime_ns == src_stat.st_mtime_ns and dest_stat.st_size == src_stat.st_size
+
+
+def scan_file(path):
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
+# Synchronize a source _assets directory to the destination:
+# New or updated files are copied, unchanged files are skipped and destination files that don't match any source
+# file anymore are removed (pruned).
+# `record_change(change, dest_file_path)` is called for each destination file 'added', 'changed' or 'removed'.
+# `src_files` are the stat results of the source files when the scan already has them ({filename: stat result}).
+# `shared_copies` are the copies of the sites built before by the same batch ({source file key: absolute path}, see
+# source_file_key()): a source file already copied to another site is hard-linked to that copy instead of being copied
+# again. (Like with the 'hardlink' mode, the copies must never be edited in place.)
+def sync_assets_directory(source_assets_path, dest_assets_path, stats_dict, copy_mode='copy', record_change=None, src_files=None,
+                          shared_copies=None):
+    logger.debug(f"\n Syncing _assets directory from {source_assets_path} to {dest_assets_path}")
+
+    if src_files is None:
+        src_files = scan_files(source_assets_path)
+    os.makedirs(dest_assets_path, exist_ok=True)
+    dest_files = scan_files(dest_assets_path)
+
+    expected_dest_names = set()
+    for filename in sorted(src_files):
+        src_stat = src_files[filename]
+        dest_names = dest_asset_names(filename)
+        expected_dest_names.update(dest_names)
+        heic_note = " HEIC file, checked against JPEG equivalent:" if len(dest_names) > 1 else ""
+
+        if any(name in dest_files and is_asset_up_to_date(src_stat, dest_files[name]) for name in dest_names):
+            logger.debug(f"  - File: {filename} :{heic_note} Unchanged file.")
+            stats_dict['assets_files_skipped'] += 1
+            stats_dict['assets_bytes_skipped'] += src_stat.st_size
+            if shared_copies is not None and copy_mode == 'copy' and is_exact_copy(src_stat, dest_files.get(filename)):
+                shared_copies.setdefault(source_file_key(src_stat), os.path.abspath(os.path.join(dest_assets_path, filename)))
+            continue
+
+        if any(name in dest_files for name in dest_names):
+            status = "Updated file"
+            # Remove the outdated destination files (including the converted JPEG of a HEIC)
+            for name in dest_names:
+                if name in dest_files:
+                    os.remove(os.path.join(dest_assets_path, name))
+                    if record_change is not None and name != filename:
+                        record_change('removed', os.path.join(dest_assets_path, name))
+        else:
+            status = "New file"
+
+        dest_file = os.path.join(dest_assets_path, filename)
+        shared_copy = shared_copies.get(source_file_key(src_stat)) if shared_copies is not None else None
+        if shared_copy is not None and is_exact_copy(src_stat, scan_file(shared_copy)):
+            method = copy_asset(shared_copy, dest_file, src_stat.st_size, 'hardlink')
+            stats_dict['assets_files_shared'] += 1
+        else:
+            method = copy_asset(os.path.join(source_assets_path, filename), dest_file, src_stat.st_size, copy_mode)
+            stats_dict['assets_files_copied'] += 1
+            stats_dict['assets_bytes_copied'] += src_stat.st_size
+            if shared_copies is not None and copy_mode == 'copy':
+                shared_copies.setdefault(source_file_key(src_stat), os.path.abspath(dest_file))
+        if record_change is not None:
+            record_change('changed' if filename in dest_files else 'added', dest_file)
+        logger.debug(f"  - File: {filename} :{heic_note} {status} ({method}).")
+
+    # Prune the destination files that have no source anymore:
+    for filename in sorted(dest_files.keys() - expected_dest_names):
+        logger.debug(f"  - File: {filename} : No source anymore, removing.")
+        os.remove(os.path.join(dest_assets_path, filename))
+        if record_change is not None:
+            record_change('removed', os.path.join(dest_assets_path, filename))
+        stats_dict['assets_files_pruned'] += 1
+
+
+# Remove the destination _assets directories that have no source directory anymore:
+# `seen_assets_paths` are the relative paths of the _assets directories synced by the run (see
+# sync_assets_directory()). Hidden directories and the ones `skip(relative path)` tells (out of the scope of a scoped
+# build, ignored in the source) are left alone. `record_change('removed', dest_file_path)` is called for each file.
+def prune_assets_directories(dest_root, seen_assets_paths, stats_dict, record_change=None, skip=None):
+    for dir_path, dirs, files in os.walk(dest_root):
+        rel_dir = os.path.relpath(dir_path, dest_root)
+        kept_dirs = []
+        for name in sorted(dirs):
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            if name.startswith('.') or (skip is not None and skip(rel_path)):
+                continue
+            if name != '_assets':
+                kept_dirs.append(name)
+                continue
+            if rel_path in seen_assets_paths:
+                continue
+            dest_assets_path = os.path.join(dir_path, name)
+            logger.debug(f"\n Removing _assets directory without a source anymore: {dest_assets_path}")
+            for assets_dir_path, _, assets_files in os.walk(dest_assets_path):
+                for filename in sorted(assets_files):
+                    if record_change is not None:
+                        record_change('removed', os.path.join(assets_dir_path, filename))
+                    stats_dict['assets_files_pruned'] += 1
+            shutil.rmtree(dest_assets_path)
+        # (the _assets directories are not descended into)
+        dirs[:] = kept_dirs
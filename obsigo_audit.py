@@ -0,0 +1,310 @@
+#! python3
+# Link audit of the site: report of all the links and check of the external URLs
+#
+# `obsigo.py audit` collects the links of every page without writing anything (see collect_site_links() in
+# obsigo.py) and writes the report here, as JSON or CSV. Each link is classified as:
+#
+# - internal: link to a page of the site (`target` is its canonical URL, `status` 'ok' or 'broken')
+# - external: link to another site (`status` is the result of the check, if any)
+# - asset: link to a file of the vault, an image... (`status` 'ok' or 'missing')
+# - html-legacy: `<a href>` link, with its Markdown equivalent (to clean up legacy content)
+#
+# The external URLs are deduplicated site-wide and, with `--check`, checked by an asyncio checker: HEAD requests
+# (GET when HEAD is not allowed) with keep-alive connections pooled per host, a limit of requests per host and in
+# total, and redirects followed. The results are cached with a TTL so a new audit only checks the stale URLs.
+# The checker only uses the standard library and also works on its own, for instance against a local server:
+#   python3 obsigo_audit.py http://127.0.0.1:8000/ok http://127.0.0.1:8000/missing --cache-file /tmp/cache.json
+# (test_obsigo_audit.py checks it against a stub server: python3 -m unittest test_obsigo_audit)
+
+import os
+import sys
+import csv
+import ssl
+import json
+import time
+import asyncio
+import logging
+import argparse
+import urllib.parse
+
+logger = logging.getLogger('obsigo.audit')
+
+LINK_CATEGORIES = ('internal', 'external', 'asset', 'html-legacy')
+
+# Columns of the CSV report (one row per link)
+CSV_COLUMNS = ('source', 'type', 'category', 'url', 'text', 'target', 'status')
+
+USER_AGENT = 'obsigo-link-checker/0.2'
+
+# Redirects followed before giving up
+MAX_REDIRECTS = 10
+
+# Bodies drained to reuse a connection after a GET (bigger ones close the connection instead)
+MAX_DRAINED_BODY = 1024 * 1024
+
+
+# External URLs of the links, deduplicated: {url: [source paths]}
+# Only http(s) URLs can be checked, the fragment is not part of the URL requested.
+def get_external_urls(links):
+    urls = {}
+    for link in links:
+        url = urllib.parse.urldefrag(link['target'] or '')[0]
+        if urllib.parse.urlsplit(url).scheme in ('http', 'https'):
+            sources = urls.setdefault(url, [])
+            if link['source'] not in sources:
+                sources.append(link['source'])
+    return urls
+
+
+def load_check_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_check_cache(cache_file, cache):
+    temp_file = cache_file + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(temp_file, cache_file)
+
+
+# Keep-alive connections of a host, at most `limit` requests at a time:
+class HostPool:
+
+    def __init__(self, scheme, host, port, limit, ssl_context):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self.semaphore = asyncio.Semaphore(limit)
+        self.idle = []
+
+    async def connect(self):
+        if self.idle:
+            return self.idle.pop(), True
+        reader, writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context if self.scheme == 'https' else None,
+            server_hostname=self.host if self.scheme == 'https' else None)
+        return (reader, writer), False
+
+    def release(self, connection, reusable):
+        if reusable:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+    # Send a request and read the response (its body is drained or the connection closed):
+    # `timeout` only starts once the request has a slot of the host (waiting behind the other requests to the same
+    # host doesn't count). Returns the status and the headers (lowercase names), raises asyncio.TimeoutError.
+    async def request(self, method, url, timeout):
+        parts = urllib.parse.urlsplit(url)
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        request = (f"{method} {target} HTTP/1.1\r\nHost: {parts.netloc}\r\nUser-Agent: {USER_AGENT}\r\n"
+                   f"Accept: */*\r\nConnection: keep-alive\r\n\r\n").encode('latin-1')
+        async with self.semaphore:
+            return await asyncio.wait_for(self.send(method, request), timeout)
+
+    # Send a request on an idle connection of the host, or a new one:
+    async def send(self, method, request):
+        while True:
+            connection, reused = await self.connect()
+            try:
+                return await self.exchange(connection, method, request)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection[1].close()
+                # The server closed an idle connection: try again with a new one
+                if not reused:
+                    raise
+            except BaseException:
+                # (including a timeout: the response may still come on this connection)
+                connection[1].close()
+                raise
+
+    async def exchange(self, connection, method, request):
+        reader, writer = connection
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed by the server")
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        status = int(status)
+
+        reusable = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            pass
+        elif 'content-length' in headers:
+            length = int(headers['content-length'])
+            if length > MAX_DRAINED_BODY:
+                reusable = False
+            else:
+                await reader.readexactly(length)
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            drained = 0
+            while reusable:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                await reader.readexactly(size + 2)
+                drained += size
+                if size == 0:
+                    break
+                reusable = drained <= MAX_DRAINED_BODY
+        else:
+            # The body ends with the connection
+            reusable = False
+        self.release(connection, reusable)
+        return status, headers
+
+
+# Check URLs with connections pooled per host:
+# Returns {url: {'status': HTTP status or None, 'final_url', 'error', 'checked_at'}}
+async def check_urls_async(urls, concurrency, per_host, timeout):
+    ssl_context = ssl.create_default_context()
+    pools = {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    def get_pool(url):
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        if key not in pools:
+            pools[key] = HostPool(parts.scheme, parts.hostname, port, per_host, ssl_context)
+        return pools[key]
+
+    async def check_url(url):
+        result = {'status': None, 'final_url': url, 'error': None}
+        method = 'HEAD'
+        current_url = url
+        async with semaphore:
+            try:
+                for hop in range(MAX_REDIRECTS + 1):
+                    status, headers = await get_pool(current_url).request(method, current_url, timeout)
+                    if method == 'HEAD' and status in (403, 405, 501):
+                        # Some servers don't answer HEAD requests
+                        method = 'GET'
+                        status, headers = await get_pool(current_url).request(method, current_url, timeout)
+                    result['status'] = status
+                    result['final_url'] = current_url
+                    if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                        current_url = urllib.parse.urljoin(current_url, headers['location'])
+                        if urllib.parse.urlsplit(current_url).scheme not in ('http', 'https'):
+                            break
+                        continue
+                    break
+                else:
+                    result['error'] = f"more than {MAX_REDIRECTS} redirects"
+            except asyncio.TimeoutError:
+                result['error'] = f"timeout after {timeout}s"
+            except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+                result['error'] = str(e) or e.__class__.__name__
+        result['checked_at'] = time.time()
+        logger.debug(f"  {url}: {result['status'] or result['error']}")
+        return url, result
+
+    try:
+        return dict(await asyncio.gather(*(check_url(url) for url in urls)))
+    finally:
+        for pool in pools.values():
+            pool.close()
+
+
+# Check the external URLs, except the ones checked less than `ttl` seconds ago (results from `cache_file`):
+# Returns the results of all the URLs (see check_urls_async()) and the number of URLs checked.
+def check_urls(urls, cache_file, ttl, concurrency=20, per_host=2, timeout=10.0):
+    cache = load_check_cache(cache_file) if cache_file else {}
+    now = time.time()
+    stale_urls = [url for url in urls if url not in cache or now - cache[url].get('checked_at', 0) > ttl]
+    logger.info(f"Checking {len(stale_urls)} external URLs ({len(urls) - len(stale_urls)} cached)...")
+    if stale_urls:
+        cache.update(asyncio.run(check_urls_async(stale_urls, concurrency, per_host, timeout)))
+        if cache_file:
+            save_check_cache(cache_file, cache)
+    return {url: cache[url] for url in urls}, len(stale_urls)
+
+
+# Status of a checked URL for the report: the HTTP status, with the final URL when redirected, or the error
+def check_status(url, result):
+    if result['status'] is None:
+        return f"error: {result['error']}"
+    if result['final_url'] != url:
+        return f"{result['status']} -> {result['final_url']}"
+    return str(result['status'])
+
+
+# Summary of the audit: links per category and problems found
+def get_audit_summary(links, external_urls, check_results=None):
+    summary = {'links': len(links)}
+    for category in LINK_CATEGORIES:
+        summary[category] = sum(1 for link in links if link['category'] == category)
+    summary['external_urls'] = len(external_urls)
+    summary['broken_internal'] = sum(1 for link in links if link['status'] == 'broken')
+    summary['missing_assets'] = sum(1 for link in links if link['status'] == 'missing')
+    if check_results is not None:
+        summary['external_errors'] = sum(1 for result in check_results.values()
+                                         if result['status'] is None or result['status'] >= 400)
+    return summary
+
+
+# Write the audit report (`output` '-' = stdout) as 'json' or 'csv':
+# With the check results, the status of the external links is the result of their check.
+def write_audit_report(links, output, report_format='json', check_results=None):
+    external_urls = get_external_urls(links)
+    if check_results is not None:
+        for link in links:
+            url = urllib.parse.urldefrag(link['target'] or '')[0]
+            if url in check_results:
+                link['status'] = check_status(url, check_results[url])
+
+    output_file = sys.stdout if output == '-' else open(output, 'w', newline='')
+    try:
+        if report_format == 'csv':
+            writer = csv.DictWriter(output_file, CSV_COLUMNS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(links)
+        else:
+            report = {
+                'summary': get_audit_summary(links, external_urls, check_results),
+                'links': links,
+                'external_urls': {url: dict(sources=sources, **(check_results or {}).get(url, {}))
+                                  for url, sources in sorted(external_urls.items())},
+            }
+            json.dump(report, output_file, indent=1)
+            output_file.write('\n')
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+    return get_audit_summary(links, external_urls, check_results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check URLs with the link checker of the audit')
+    parser.add_argument('urls', nargs='+', help='URLs to check')
+    parser.add_argument('--cache-file', help='Cache of the results (default: no cache)')
+    parser.add_argument('--ttl', type=float, default=7 * 24 * 3600, help='Seconds before a cached result is stale')
+    parser.add_argument('--concurrency', type=int, default=20, help='Requests at a time')
+    parser.add_argument('--per-host', type=int, default=2, help='Requests at a time to the same host')
+    parser.add_argument('--timeout', type=float, default=10.0, help='Timeout of a request in seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+
+    results, checked = check_urls(list(dict.fromkeys(args.urls)), args.cache_file, args.ttl, args.concurrency,
+                                  args.per_host, args.timeout)
+    for url, result in results.items():
+        print(f"{url}\t{check_status(url, result)}")
+    if any(result['status'] is None or result['status'] >= 400 for result in results.values()):
+        sys.exit(1)
@@ -0,0 +1,455 @@
+#! python3
+# Benchmark obsigo on reproducible synthetic Obsidian vaults
+#
+# Each stage of the conversion is timed separately (site index, frontmatter, links, file I/O, assets sync, redirects,
+# Hugo data files) and then
+# the whole conversion is timed end to end. Results are written as JSON so runs can be compared over time.
+#
+# The converted output (destination tree, _redirects and source write-backs) is hashed and checked against
+# obsigo_bench_golden.json, so a speedup cannot silently change the converted content.
+#
+# Usage:
+#   python3 obsigo_bench.py                         # 1k pages
+#   python3 obsigo_bench.py --sizes 1000 10000 50000 -j 4 -o bench.json
+#   python3 obsigo_bench.py --update-golden         # after an intended change of the output
+
+import os
+import sys
+import json
+import time
+import logging
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import yaml
+
+import obsigo
+from obsigo_assets import sync_assets_directory
+from obsigo_data import write_data_files
+from obsigo_scan import scan_source_directory
+
+GOLDEN_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'obsigo_bench_golden.json')
+
+# Frontmatter keys removed by the conversion (`unimportant_frontmatter_keys` in obsigo.yaml)
+BENCH_UNIMPORTANT_KEYS = ['obsidianUIMode', 'cssclass']
+
+# Default parameters of the synthetic vaults:
+VAULT_DEFAULTS = {
+    'seed': 1,
+    'links': 5,             # Links to other pages per page
+    'tags': 3,              # #hashtags per page
+    'code_blocks': 1,       # Code blocks per page
+    'images': 1,            # Image embeds per page
+    'index_ratio': 0.1,     # Pages stored as <page>/index.md
+    'leaf_ratio': 0.2,      # Pages stored as <page>/<page>.md
+    'alias_conflicts': 0.05,    # Pages claiming an alias shared with other pages
+    'paragraphs': 6,
+    'asset_size': 16384,    # Size of each image file (random bytes)
+}
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et dolore "
+         "magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+         "consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla pariatur").split()
+
+TAGS = ['retro', 'hardware', 'atari st', 'amiga', '#demoscene', 'music', 'tools', 'floppy', 'assembly', 'c64']
+
+
+def sentence(rng, count):
+    return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+
+# Generate a synthetic vault in `root` (which must not exist):
+# The same parameters always give the same vault, byte for byte.
+def generate_vault(root, pages, seed=1, links=5, tags=3, code_blocks=1, images=1, index_ratio=0.1, leaf_ratio=0.2,
+                   alias_conflicts=0.05, paragraphs=6, asset_size=16384):
+    rng = random.Random(seed)
+    sections = [f"section-{i:03d}" for i in range(max(1, pages // 100))]
+    assets_per_section = 8
+
+    # Layout of the pages: plain file, <page>/index.md or leaf node <page>/<page>.md
+    page_paths = []
+    for i in range(pages):
+        section = sections[i % len(sections)]
+        name = f"page-{i:05d}"
+        layout = rng.random()
+        if layout < index_ratio:
+            page_paths.append(f"{section}/{name}/index.md")
+        elif layout < index_ratio + leaf_ratio:
+            page_paths.append(f"{section}/{name}/{name}.md")
+        else:
+            page_paths.append(f"{section}/{name}.md")
+
+    os.makedirs(root)
+    with open(os.path.join(root, '_index.md'), 'w') as f:
+        f.write("---\ntitle: Home\n---\n\nSynthetic vault.\n")
+
+    for section in sections:
+        assets_path = os.path.join(root, section, '_assets')
+        os.makedirs(assets_path)
+        for k in range(assets_per_section):
+            extension = 'heic' if k == 0 else 'jpg'
+            with open(os.path.join(assets_path, f"img-{k}.{extension}"), 'wb') as f:
+                f.write(rng.randbytes(asset_size))
+
+    for i, rel_path in enumerate(page_paths):
+        name = f"page-{i:05d}"
+        depth = rel_path.count('/')
+
+        # Frontmatter:
+        metadata = {'title': sentence(rng, 4).capitalize(), 'date': f"20{10 + i % 15:02d}-0{1 + i % 9}-1{i % 10}"}
+        slug_kind = rng.random()
+        if slug_kind < 0.6:
+            metadata['slug'] = name
+        elif slug_kind < 0.8:
+            metadata['slug'] = f"old-{name}"
+        aliases = []
+        if rng.random() < alias_conflicts:
+            aliases.append(f"shared-alias-{rng.randrange(max(1, int(pages * alias_conflicts / 3)))}")
+        if rng.random() < 0.3:
+            aliases.append(f"archive/{i}/index.html")
+        if aliases:
+            metadata['aliases'] = aliases
+        metadata['tags'] = rng.sample(TAGS, min(len(TAGS), rng.randint(0, 3)))
+        if rng.random() < 0.05:
+            metadata['cover_img'] = '_assets/img-0.heic'
+        if rng.random() < 0.1:
+            metadata['obsidianUIMode'] = 'preview'
+        if rng.random() < 0.05:
+            metadata['visibility'] = 'published'
+        if rng.random() < 0.02:
+            metadata['draft'] = True
+
+        # Body: the inline elements are spread over the paragraphs
+        inlines = []
+        for _ in range(links):
+            j = rng.randrange(pages)
+            target = page_paths[j]
+            kind = rng.random()
+            if kind < 0.7:
+                inlines.append(f"[{sentence(rng, 2)}]({'../' * depth}{target})")
+            else:
+                inlines.append(f"[{sentence(rng, 2)}](https://example.com/{sentence(rng, 1)}/{j})")
+        for _ in range(tags):
+            inlines.append(f"#{rng.choice(TAGS).replace(' ', '-').replace('#', '')}")
+        for _ in range(images):
+            k = rng.randrange(assets_per_section)
+            extension = 'heic' if k == 0 else 'jpg'
+            inlines.append(f'![{sentence(rng, 2)}]({"../" * (depth - 1)}_assets/img-{k}.{extension} "{sentence(rng, 3)}")')
+        if rng.random() < 0.05:
+            inlines.append(f"![video](https://www.youtube.com/watch?v=bench{i})")
+        if rng.random() < 0.2:
+            inlines.append(f"=={sentence(rng, 2)}==")
+        if rng.random() < 0.2:
+            inlines.append(f"`inline [code]({name}/index.md)`")
+        if rng.random() < 0.1:
+            inlines.append(f'<a href="https://example.com/{i}">{sentence(rng, 2)}</a>')
+        rng.shuffle(inlines)
+
+        blocks = []
+        per_paragraph = -(-len(inlines) // paragraphs)
+        for p in range(paragraphs):
+            words = sentence(rng, rng.randint(30, 80)).split()
+            for inline in inlines[p * per_paragraph:(p + 1) * per_paragraph]:
+                words.insert(rng.randrange(len(words) + 1), inline)
+            blocks.append(' '.join(words).capitalize() + '.')
+            if p < code_blocks:
+                blocks.append(f"```\n# not a #tag\nsee [the page]({name}/{name}.md)\n```")
+        if rng.random() < 0.2:
+            blocks.append(f"- # of pages: {i}\n- # of links: {links}")
+
+        file_path = os.path.join(root, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as f:
+            f.write("---\n")
+            f.write(yaml.safe_dump(metadata, sort_keys=False, allow_unicode=True))
+            f.write("---\n\n")
+            f.write('\n\n'.join(blocks) + '\n')
+
+
+# Collect the markdown files of a vault like process_directory(): [(relative path, path, size)] in sorted order
+def list_markdown_files(root):
+    md_files = []
+    for dir_path, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith('.') and d != '_assets']
+        for file in files:
+            if file.endswith('.md'):
+                file_path = os.path.join(dir_path, file)
+                md_files.append((os.path.relpath(file_path, root), file_path, os.path.getsize(file_path)))
+    md_files.sort()
+    return md_files
+
+
+def list_assets_directories(root):
+    assets_dirs = []
+    for dir_path, dirs, files in os.walk(root):
+        if os.path.basename(dir_path) == '_assets':
+            assets_dirs.append((os.path.relpath(dir_path, root), dir_path,
+                                sum(os.path.getsize(os.path.join(dir_path, file)) for file in files), len(files)))
+    assets_dirs.sort()
+    return assets_dirs
+
+
+# Hash a directory tree (paths and contents):
+def tree_hash(root):
+    digest = hashlib.sha256()
+    paths = []
+    for dir_path, dirs, files in os.walk(root):
+        for file in files:
+            paths.append(os.path.relpath(os.path.join(dir_path, file), root))
+    for rel_path in sorted(paths):
+        with open(os.path.join(root, rel_path), 'rb') as f:
+            digest.update(f"{rel_path}\0{hashlib.sha256(f.read()).hexdigest()}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+# Converter of a copy of a vault (`src`) converted to `dest`, with the settings of the benchmark:
+def bench_converter(src, dest, work_dir):
+    return obsigo.Converter({
+        'source_directory': src,
+        'destination_directory': dest,
+        'src_redirects_base_file': os.path.join(work_dir, 'no_redirects_base.txt'),
+        'dest_redirects_file': os.path.join(dest, '_redirects'),
+        'unimportant_frontmatter_keys': BENCH_UNIMPORTANT_KEYS,
+    })
+
+
+def stage_result(seconds, files, data_bytes):
+    return {
+        'seconds': round(seconds, 6),
+        'files': files,
+        'bytes': data_bytes,
+        'files_per_second': round(files / seconds, 1) if seconds else None,
+        'mb_per_second': round(data_bytes / seconds / 1e6, 2) if seconds else None,
+    }
+
+
+# Time the stages of the conversion separately, without writing anything to the source:
+# Returns {stage: seconds} (the best of `repeat` runs for each stage).
+def time_stages(vault, work_dir, md_files, assets_dirs, repeat):
+    best = {}
+    for run in range(repeat):
+        dest = os.path.join(work_dir, f"stages-{run}")
+        converter = bench_converter(vault, dest, work_dir)
+        timers = dict.fromkeys(('scan', 'site_index', 'frontmatter', 'links', 'file_io', 'assets_sync', 'redirects', 'data'), 0.0)
+        stats_dict = obsigo.new_stats_dict()
+        page_infos = []
+
+        start = time.perf_counter()
+        for entry in scan_source_directory(vault):
+            pass
+        timers['scan'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        site_index = obsigo.build_site_index([(rel_path, file_path) for rel_path, file_path, size in md_files], {})
+        timers['site_index'] = time.perf_counter() - start
+
+        for rel_path, file_path, size in md_files:
+            start = time.perf_counter()
+            with open(file_path, 'rb') as f:
+                src_data = f.read()
+            timers['file_io'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            document = obsigo.load_markdown(src_data.decode('utf-8'))
+            metadata = document['metadata']
+            rel_dest_filepath, dest_rule = obsigo.get_dest_filepath(rel_path)
+            page_info = {'rel_src_filepath': rel_path, 'rel_dest_filepath': rel_dest_filepath}
+            metadata_changed = obsigo.process_frontmatter(metadata, rel_path, rel_dest_filepath, page_info, stats_dict,
+                                                          BENCH_UNIMPORTANT_KEYS)
+            header = obsigo.render_frontmatter(document, metadata, metadata_changed)
+            timers['frontmatter'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            new_src_content, hugo_content = obsigo.process_links(converter, document['content'], rel_path, stats_dict, page_info, site_index)
+            page_info['tags'] = obsigo.get_page_tags(metadata, page_info['tags'])
+            timers['links'] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            converter.write_dest_file(os.path.join(dest, rel_dest_filepath),
+                                      obsigo.dump_markdown(header, hugo_content).encode('utf-8'))
+            timers['file_io'] += time.perf_counter() - start
+            page_infos.append(page_info)
+
+        start = time.perf_counter()
+        for rel_path, assets_path, size, count in assets_dirs:
+            sync_assets_directory(assets_path, os.path.join(dest, rel_path), stats_dict)
+        timers['assets_sync'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        site_aliases_dict = {}
+        for page_info in page_infos:
+            obsigo.add_site_aliases(page_info, site_aliases_dict, stats_dict)
+        live_uris = {page_info['canonical_uri'] for page_info in page_infos if not page_info['draft']}
+        obsigo.write_redirects_file(converter, site_aliases_dict, os.path.join(dest, '_redirects'),
+                                    os.path.join(work_dir, 'no_redirects_base.txt'), live_uris)
+        timers['redirects'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        write_data_files(os.path.join(dest, 'data'), {page_info['rel_src_filepath']: page_info for page_info in page_infos},
+                         {}, 5, converter.write_dest_file)
+        timers['data'] = time.perf_counter() - start
+
+        shutil.rmtree(dest)
+        for stage, seconds in timers.items():
+            best[stage] = min(best.get(stage, seconds), seconds)
+    return best, len(site_aliases_dict)
+
+
+# Convert a copy of the vault with process_directory() + write_redirects_file() + write_data_files(), like an obsigo run:
+# Returns (seconds, hash of the output) where the output is the destination and the source after the conversion.
+def time_conversion(vault, work_dir, jobs):
+    src = os.path.join(work_dir, f"src-j{jobs}")
+    dest = os.path.join(work_dir, f"dest-j{jobs}")
+    shutil.copytree(vault, src)
+    converter = bench_converter(src, dest, work_dir)
+
+    start = time.perf_counter()
+    site_aliases_dict = {}
+    manifest_files = obsigo.process_directory(converter, src, dest, site_aliases_dict, obsigo.new_stats_dict(), {}, jobs)
+    live_uris = {entry['canonical_uri'] for entry in manifest_files.values() if not entry['draft']}
+    obsigo.write_redirects_file(converter, site_aliases_dict, os.path.join(dest, '_redirects'),
+                                os.path.join(work_dir, 'no_redirects_base.txt'), live_uris)
+    write_data_files(os.path.join(dest, 'data'), manifest_files, {}, 5, converter.write_dest_file)
+    seconds = time.perf_counter() - start
+
+    digest = hashlib.sha256(f"{tree_hash(dest)} {tree_hash(src)}".encode('ascii')).hexdigest()
+    shutil.rmtree(src)
+    shutil.rmtree(dest)
+    return seconds, digest
+
+
+def vault_key(pages, params):
+    return ','.join([f"pages={pages}"] + [f"{key}={value}" for key, value in params.items()])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(GOLDEN_FILE),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(pages, params, work_dir, jobs, repeat, golden):
+    vault = os.path.join(work_dir, 'vault')
+    print(f"\n== {pages} pages: generating vault...")
+    generate_vault(vault, pages, **params)
+    md_files = list_markdown_files(vault)
+    assets_dirs = list_assets_directories(vault)
+    md_bytes = sum(size for rel_path, file_path, size in md_files)
+    assets_bytes = sum(size for rel_path, path, size, count in assets_dirs)
+    assets_count = sum(count for rel_path, path, size, count in assets_dirs)
+
+    result = {
+        'pages': pages,
+        'vault': dict(params, md_files=len(md_files), md_bytes=md_bytes, assets_files=assets_count,
+                      assets_bytes=assets_bytes),
+        'stages': {},
+    }
+
+    print(f"   {len(md_files)} markdown files ({md_bytes / 1e6:.1f} MB), {assets_count} assets ({assets_bytes / 1e6:.1f} MB)")
+    print("   Timing stages...")
+    stage_seconds, aliases_count = time_stages(vault, work_dir, md_files, assets_dirs, repeat)
+    for stage, seconds in stage_seconds.items():
+        if stage == 'assets_sync':
+            result['stages'][stage] = stage_result(seconds, assets_count, assets_bytes)
+        elif stage == 'redirects':
+            result['stages'][stage] = stage_result(seconds, aliases_count, 0)
+        else:
+            result['stages'][stage] = stage_result(seconds, len(md_files), md_bytes)
+
+    hashes = {}
+    for run_jobs in sorted({1, jobs}):
+        print(f"   Timing conversion with {run_jobs} job(s)...")
+        best = None
+        for run in range(repeat):
+            seconds, output_hash = time_conversion(vault, work_dir, run_jobs)
+            best = seconds if best is None else min(best, seconds)
+            hashes[run_jobs] = output_hash
+        result['stages'][f"conversion_j{run_jobs}"] = stage_result(best, len(md_files), md_bytes + assets_bytes)
+
+    shutil.rmtree(vault)
+
+    # Golden output check:
+    output_hash = hashes[1]
+    result['output_hash'] = output_hash
+    expected = golden.get(vault_key(pages, params))
+    if len(set(hashes.values())) > 1:
+        result['golden'] = 'jobs mismatch'
+    elif expected is None:
+        result['golden'] = 'missing'
+    elif expected == output_hash:
+        result['golden'] = 'ok'
+    else:
+        result['golden'] = 'mismatch'
+
+    for stage, stage_data in result['stages'].items():
+        print(f"   {stage:16} {stage_data['seconds']:9.3f} s  {stage_data['files_per_second'] or 0:10.1f} files/s"
+              f"  {stage_data['mb_per_second'] or 0:8.2f} MB/s")
+    print(f"   Output hash: {output_hash} (golden: {result['golden']})")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark obsigo on synthetic Obsidian vaults')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000], help='Vault sizes in pages (default: 1000)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Also time the conversion with this many worker processes')
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Run each timing this many times and keep the best')
+    parser.add_argument('-o', '--output', default='obsigo_bench.json', help='JSON results file (default: obsigo_bench.json)')
+    parser.add_argument('--work-dir', default=None, help='Where to generate the vaults (default: system temp directory)')
+    parser.add_argument('--verbose-log', action='store_true', help='Time the conversion with the verbose log level of `obsigo -v`')
+    parser.add_argument('--update-golden', action='store_true', help='Record the output hashes as the new golden values')
+    for key, value in VAULT_DEFAULTS.items():
+        parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+
+    # Log at the default level of obsigo (the messages are built like in a real run) but discard the output:
+    obsigo.logger.setLevel(logging.DEBUG if args.verbose_log else logging.INFO)
+    obsigo.logger.addHandler(logging.NullHandler())
+    obsigo.logger.propagate = False
+    params = {key: getattr(args, key) for key in VAULT_DEFAULTS}
+
+    try:
+        with open(GOLDEN_FILE, 'r') as f:
+            golden = json.load(f)
+    except FileNotFoundError:
+        golden = {}
+
+    report = {
+        'obsigo_version': obsigo.OBSIGO_VERSION,
+        'git_commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'jobs': args.jobs,
+        'repeat': args.repeat,
+        'results': [],
+    }
+
+    for pages in args.sizes:
+        work_dir = tempfile.mkdtemp(prefix='obsigo_bench_', dir=args.work_dir)
+        try:
+            report['results'].append(run_benchmark(pages, params, work_dir, args.jobs, args.repeat, golden))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.update_golden:
+        for result in report['results']:
+            golden[vault_key(result['pages'], params)] = result['output_hash']
+        with open(GOLDEN_FILE, 'w') as f:
+            json.dump(dict(sorted(golden.items())), f, indent=2)
+            f.write('\n')
+        print(f"Golden output hashes updated in {GOLDEN_FILE}")
+    elif any(result['golden'] in ('mismatch', 'jobs mismatch') for result in report['results']):
+        print("!!!WARNING!!! The converted output differs from the golden output.")
+        sys.exit(1)
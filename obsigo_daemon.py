@@ -0,0 +1,119 @@
+# Resident obsigo: serve the runs of obsigo.sh from a process that stays up, on a local Unix socket
+#
+#   python3 obsigo.py daemon [--socket ~/.obsigo.sock]
+#
+# A run through the daemon doesn't pay for the start of the interpreter and the imports (yaml, Pillow...), and the
+# converter of each site stays warm between runs (config parsed, rewrite rules compiled, manifest of the last run in
+# memory, see Converter in obsigo.py). obsigo.sh sends its arguments to the daemon when the socket exists.
+#
+# Protocol, one request per connection (text lines, UTF-8): the working directory of the request, then one argument per
+# line, then an empty line. The daemon answers with the output of the run (stdout and logs) and a last line
+# `obsigo-exit: <exit code>`, then closes the connection. Requests are served one at a time, in their working
+# directory. A client must treat an answer without the exit code line as a failure (see the client of obsigo.sh).
+
+import os
+import signal
+import socket
+import logging
+import contextlib
+
+logger = logging.getLogger('obsigo.daemon')
+
+EXIT_PREFIX = 'obsigo-exit: '
+
+
+# Read a request: (working directory, arguments)
+def read_request(stream):
+    lines = []
+    for line in stream:
+        line = line.rstrip('\n')
+        if not line:
+            break
+        lines.append(line)
+    if not lines:
+        raise ValueError("empty request")
+    return lines[0], lines[1:]
+
+
+# Serve a request: run obsigo (`run(arguments, converters)`, see main() in obsigo.py) with its output sent back
+def serve_request(connection, run, converters):
+    with connection, connection.makefile('rw', encoding='utf-8', newline='\n') as stream:
+        try:
+            cwd, args = read_request(stream)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            logger.warning(f"Invalid request: {e}")
+            return
+        logger.info(f"Request: {cwd}: obsigo.py {' '.join(args)}")
+
+        # The logs of the run go to the client only
+        root_logger = logging.getLogger()
+        saved_handlers = root_logger.handlers[:]
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root_logger.handlers = [handler]
+        saved_level = logging.getLogger('obsigo').level
+        saved_cwd = os.getcwd()
+        try:
+            os.chdir(cwd)
+            with contextlib.redirect_stdout(stream), contextlib.redirect_stderr(stream):
+                exit_code = run(args, converters)
+        except SystemExit as e:
+            # (invalid arguments)
+            exit_code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+        except Exception as e:
+            logging.getLogger('obsigo').exception(f"ERROR: {e}")
+            exit_code = 1
+        finally:
+            os.chdir(saved_cwd)
+            root_logger.handlers = saved_handlers
+            logging.getLogger('obsigo').setLevel(saved_level)
+        try:
+            stream.write(f"{EXIT_PREFIX}{exit_code}\n")
+            stream.flush()
+        except OSError:
+            pass
+        logger.info(f"  exit code {exit_code}")
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+# Listen on the socket and serve the requests until interrupted (Ctrl+C or SIGTERM): returns the exit code
+def serve(socket_path, run):
+    if os.path.exists(socket_path):
+        # A daemon still running answers, a stale socket file is replaced
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+                logger.error(f"A daemon is already listening on {socket_path}.")
+                return 1
+            except OSError:
+                os.remove(socket_path)
+
+    signal.signal(signal.SIGTERM, stop)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    converters = {}
+    try:
+        # (only the user can send requests: they run with the user's rights)
+        saved_umask = os.umask(0o177)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(saved_umask)
+        server.listen()
+        logger.info(f"Obsigo daemon listening on {socket_path} (Ctrl+C to stop).")
+        while True:
+            connection, address = server.accept()
+            try:
+                serve_request(connection, run, converters)
+            except OSError as e:
+                # (the client went away before the end of the answer)
+                logger.warning(f"  answer not sent: {e}")
+    except KeyboardInterrupt:
+        logger.info("\nStopped.")
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
@@ -0,0 +1,189 @@
+# Write the data files used by the Hugo templates: backlinks, tags and related pages
+#
+# After the conversion, obsigo knows every internal link and every tag of the site (the `links` and `tags` of the
+# manifest entries), so the templates don't need to scan `.Site.Pages` on every page to find them (O(n²)).
+# The files are compact JSON in a directory of the Hugo `data/` directory (default `./data/obsigo`):
+#
+# - backlinks.json: {uri: [uris of the pages linking to it]}
+# - tags.json: {tag: {"count": n, "pages": [uris]}}
+# - related.json: {uri: [uris of the most related pages]}
+#
+# For instance in a template: {{ range index .Site.Data.obsigo.backlinks .RelPermalink }} ... {{ end }}
+
+import os
+import re
+import json
+import logging
+
+logger = logging.getLogger('obsigo.data')
+
+# Score of a related page: 1 per shared tag, plus LINK_SCORE per link between the two pages (in either direction)
+LINK_SCORE = 2
+
+
+# Tag as it appears in the URLs of Hugo (like `urlize`): `Atari ST` and `#atari-st` are the same tag
+def normalize_tag(tag):
+    return str(tag).strip().lstrip('#').strip().lower().replace(' ', '-')
+
+
+# Graph of the published pages from the manifest entries: {uri: (tags, uris of the pages it links to)}
+def get_site_graph(manifest_files):
+    graph = {}
+    for entry in manifest_files.values():
+        if entry.get('draft', True) or 'canonical_uri' not in entry:
+            continue
+        uri = entry['canonical_uri']
+        links = set()
+        for canonical_url in entry.get('links', {}).values():
+            if canonical_url:
+                links.add(re.split(r'[?#]', canonical_url, 1)[0])
+        tags, old_links = graph.get(uri, (frozenset(), frozenset()))
+        graph[uri] = (tags | frozenset(entry.get('tags', [])), old_links | frozenset(links))
+    # Only links between published pages count (no self links):
+    return {uri: (tags, frozenset(link for link in links if link != uri and link in graph))
+            for uri, (tags, links) in graph.items()}
+
+
+def get_backlinks(graph):
+    backlinks = {}
+    for uri, (tags, links) in graph.items():
+        for target in links:
+            backlinks.setdefault(target, []).append(uri)
+    return {uri: sorted(sources) for uri, sources in sorted(backlinks.items())}
+
+
+def get_tags(graph):
+    tag_pages = {}
+    for uri, (tags, links) in graph.items():
+        for tag in tags:
+            tag_pages.setdefault(tag, []).append(uri)
+    return {tag: {'count': len(uris), 'pages': sorted(uris)} for tag, uris in sorted(tag_pages.items())}
+
+
+# Set of pages as a bitset (Python int): bit i is the i-th page in URI order
+def pages_bitset(indexes, pages_count):
+    bits = bytearray((pages_count + 7) // 8)
+    for index in indexes:
+        bits[index >> 3] |= 1 << (index & 7)
+    return int.from_bytes(bits, 'little')
+
+
+# Top `count` related pages of each page of `uris`, best score first (then in URI order):
+# Every page is compared with all the others at once: the pages of each tag are a bitset and the shared tags of each
+# page are counted with a bit-sliced adder (slice i holds bit i of the count of every page), so there's no loop over
+# the pages of a tag (a few tags are usually shared by most of the site).
+def get_related(graph, uris, count):
+    page_uris = sorted(graph)
+    page_indexes = {uri: index for index, uri in enumerate(page_uris)}
+    tag_indexes = {}
+    for uri, (tags, links) in graph.items():
+        for tag in tags:
+            tag_indexes.setdefault(tag, []).append(page_indexes[uri])
+    # (a tag of a single page doesn't relate it to anything)
+    tag_bitsets = {tag: pages_bitset(indexes, len(page_uris)) for tag, indexes in tag_indexes.items() if len(indexes) > 1}
+    all_pages = (1 << len(page_uris)) - 1
+
+    link_counts = {}        # uri -> {linked uri: links between the two pages}
+    for uri, (tags, links) in graph.items():
+        for target in links:
+            link_counts.setdefault(uri, {})
+            link_counts[uri][target] = link_counts[uri].get(target, 0) + 1
+            link_counts.setdefault(target, {})
+            link_counts[target][uri] = link_counts[target].get(uri, 0) + 1
+
+    related = {}
+    for uri in uris:
+        tags = graph[uri][0]
+        # Linked pages: score of each page
+        linked = link_counts.get(uri, {})
+        candidates = [(len(tags & graph[other][0]) + LINK_SCORE * links_count, other) for other, links_count in linked.items()]
+
+        # Other pages: count the shared tags of all the pages at once
+        slices = []
+        for tag in tags:
+            carry = tag_bitsets.get(tag, 0)
+            for i in range(len(slices)):
+                if not carry:
+                    break
+                slices[i], carry = slices[i] ^ carry, slices[i] & carry
+            if carry:
+                slices.append(carry)
+        exclude = pages_bitset([page_indexes[uri]] + [page_indexes[other] for other in linked], len(page_uris))
+        slices = [bits & ~exclude for bits in slices]
+
+        # Best scores first: the pages with exactly `score` shared tags, in URI order
+        needed = count
+        for score in range(min(len(tags), (1 << len(slices)) - 1), 0, -1):
+            if needed <= 0:
+                break
+            matches = all_pages
+            for i, bits in enumerate(slices):
+                matches &= bits if score >> i & 1 else ~bits
+            while matches and needed > 0:
+                lowest = matches & -matches
+                candidates.append((score, page_uris[lowest.bit_length() - 1]))
+                matches ^= lowest
+                needed -= 1
+
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1]))
+        related[uri] = [other for score, other in candidates[:count]]
+    return related
+
+
+# Pages whose related pages may have changed since the previous run: the changed pages (added, removed, new tags or
+# links), the pages sharing one of their old or new tags and the pages linking to one of them.
+def get_affected_pages(graph, previous_graph):
+    changed_pages = set()
+    changed_tags = set()
+    for uri in graph.keys() | previous_graph.keys():
+        old, new = previous_graph.get(uri), graph.get(uri)
+        if old == new:
+            continue
+        changed_pages.add(uri)
+        for tags, links in filter(None, (old, new)):
+            changed_tags |= tags
+            changed_pages |= links
+    return {uri for uri, (tags, links) in graph.items()
+            if uri in changed_pages or tags & changed_tags or links & changed_pages}
+
+
+def load_data_file(data_directory, name):
+    try:
+        with open(os.path.join(data_directory, name + '.json'), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+# Write the data files of the site from the manifest entries:
+# With the entries of the previous run (incremental run), only the related pages of the affected pages are computed
+# again. The files are written with `write_file(file_path, data)` (only when their contents change).
+# Returns the stats of the run.
+def write_data_files(data_directory, manifest_files, previous_manifest_files, related_count, write_file):
+    graph = get_site_graph(manifest_files)
+
+    previous_related = load_data_file(data_directory, 'related') if previous_manifest_files else None
+    if previous_related is None:
+        related_uris = set(graph)
+        related = {}
+    else:
+        related_uris = get_affected_pages(graph, get_site_graph(previous_manifest_files))
+        related = {uri: pages for uri, pages in previous_related.items() if uri in graph and uri not in related_uris}
+    related.update(get_related(graph, sorted(related_uris), related_count))
+
+    data = {
+        'backlinks': get_backlinks(graph),
+        'tags': get_tags(graph),
+        'related': {uri: pages for uri, pages in sorted(related.items()) if pages},
+    }
+    for name, content in data.items():
+        write_file(os.path.join(data_directory, name + '.json'),
+                   json.dumps(content, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+    logger.info(f"Hugo data: {len(data['backlinks'])} pages with backlinks, {len(data['tags'])} tags, "
+                f"related pages of {len(related_uris)}/{len(graph)} pages computed.")
+    return {
+        'data_pages_with_backlinks': len(data['backlinks']),
+        'data_tags': len(data['tags']),
+        'data_related_pages_computed': len(related_uris),
+    }
@@ -0,0 +1,231 @@
+# Index of the site in an SQLite database: the pages with their canonical URIs and slugs, and the aliases, with the
+# first and the last run they were seen in
+#
+# The manifest only describes the site of the last run. The index keeps the history, so the foreverlinks of a page
+# survive when an alias is dropped from its frontmatter by mistake or when the page moves (see
+# get_historical_aliases()), and `obsigo.py query` answers without converting anything:
+#
+#   python3 obsigo.py query alias old-name          # Pages that claim or claimed an alias
+#   python3 obsigo.py query page notes/x.md         # URIs, slugs and aliases of a page (by source path, URI, slug or alias)
+#   python3 obsigo.py query slug x                  # Pages that had this slug
+#   python3 obsigo.py query conflicts               # Aliases claimed by several pages in the last run
+#
+# A run only writes what changed: the rows still current are carried over to the new run by a single UPDATE and the
+# new or changed rows are upserted.
+
+import os
+import time
+import sqlite3
+import logging
+import urllib.request
+
+logger = logging.getLogger('obsigo.db')
+
+# Version of the schema (PRAGMA user_version). An index with another version is created again (or ignored when it is
+# only read).
+INDEX_DB_VERSION = 1
+
+INDEX_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at TEXT NOT NULL,
+    pages INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    rel_src_filepath TEXT NOT NULL,
+    canonical_uri TEXT NOT NULL,
+    slug TEXT,
+    draft INTEGER NOT NULL,
+    aliases TEXT NOT NULL,
+    first_run INTEGER NOT NULL,
+    last_run INTEGER NOT NULL,
+    PRIMARY KEY (rel_src_filepath, canonical_uri)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pages_canonical_uri ON pages (canonical_uri);
+CREATE INDEX IF NOT EXISTS pages_slug ON pages (slug);
+CREATE TABLE IF NOT EXISTS aliases (
+    alias TEXT NOT NULL,
+    canonical_uri TEXT NOT NULL,
+    rel_src_filepath TEXT NOT NULL,
+    first_run INTEGER NOT NULL,
+    last_run INTEGER NOT NULL,
+    PRIMARY KEY (alias, canonical_uri, rel_src_filepath)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS aliases_canonical_uri ON aliases (canonical_uri);
+CREATE INDEX IF NOT EXISTS aliases_rel_src_filepath ON aliases (rel_src_filepath);
+"""
+
+QUERY_KINDS = ('alias', 'page', 'slug', 'conflicts')
+
+
+# Open the index (created if needed):
+# With `read_only` (dry runs, scoped builds, queries), nothing is created or written: returns None when the index
+# doesn't exist or has another version.
+def open_index(index_db_file, read_only=False):
+    if read_only:
+        if not os.path.isfile(index_db_file):
+            return None
+        connection = sqlite3.connect(f"file:{urllib.request.pathname2url(os.path.abspath(index_db_file))}?mode=ro", uri=True)
+        if connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_DB_VERSION:
+            connection.close()
+            return None
+        return connection
+
+    connection = sqlite3.connect(index_db_file)
+    if connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_DB_VERSION:
+        logger.info(f"Creating the index '{index_db_file}'.")
+        with connection:
+            connection.executescript("DROP TABLE IF EXISTS runs; DROP TABLE IF EXISTS pages; DROP TABLE IF EXISTS aliases;")
+            connection.executescript(INDEX_DB_SCHEMA)
+            connection.execute(f"PRAGMA user_version = {INDEX_DB_VERSION}")
+    return connection
+
+
+def get_last_run(connection):
+    return connection.execute("SELECT MAX(id) FROM runs").fetchone()[0]
+
+
+# Record a run of the pages of the manifest in the index:
+# The rows of the previous run still there are carried over. The pages whose canonical URI, draft status or aliases
+# changed are upserted, with the rows of the aliases they gained, and the rows they lost are closed (their last run is
+# the previous run). Returns the id of the run and the number of rows written (apart from the carried over ones).
+def update_index(connection, manifest_files, get_main_slug):
+    # (the aliases of a page are also kept in its row, so an unchanged page is found without reading its aliases)
+    page_rows = {(rel_src_filepath, entry['canonical_uri']): (int(entry['draft']), '\n'.join(entry['aliases']))
+                 for rel_src_filepath, entry in manifest_files.items()}
+    with connection:
+        previous_run = get_last_run(connection)
+        run = connection.execute("INSERT INTO runs (started_at, pages) VALUES (?, ?)",
+                                 (time.strftime('%Y-%m-%d %H:%M:%S'), len(manifest_files))).lastrowid
+        previous_page_rows = {(rel_src_filepath, canonical_uri): (draft, aliases) for rel_src_filepath, canonical_uri, draft, aliases in connection.execute(
+            "SELECT rel_src_filepath, canonical_uri, draft, aliases FROM pages WHERE last_run = ?", (previous_run,))}
+        connection.execute("UPDATE pages SET last_run = ? WHERE last_run = ?", (run, previous_run))
+        connection.execute("UPDATE aliases SET last_run = ? WHERE last_run = ?", (run, previous_run))
+
+        removed_pages = previous_page_rows.keys() - page_rows.keys()
+        changed_pages = [key for key, value in page_rows.items() if previous_page_rows.get(key) != value]
+        removed_aliases = []
+        added_aliases = []
+        for key in list(removed_pages) + changed_pages:
+            rel_src_filepath, canonical_uri = key
+            previous_aliases = set(previous_page_rows[key][1].split('\n')) - {''} if key in previous_page_rows else set()
+            aliases = set(page_rows[key][1].split('\n')) - {''} if key in page_rows else set()
+            removed_aliases += [(previous_run, alias, canonical_uri, rel_src_filepath) for alias in previous_aliases - aliases]
+            added_aliases += [(alias, canonical_uri, rel_src_filepath, run, run) for alias in aliases - previous_aliases]
+
+        # (the rows gone since the previous run were last seen in the previous run)
+        connection.executemany("UPDATE pages SET last_run = ? WHERE rel_src_filepath = ? AND canonical_uri = ?",
+                               [(previous_run,) + key for key in removed_pages])
+        connection.executemany("UPDATE aliases SET last_run = ? WHERE alias = ? AND canonical_uri = ? AND rel_src_filepath = ?",
+                               removed_aliases)
+        connection.executemany("INSERT INTO pages VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE "
+                               "SET draft = excluded.draft, aliases = excluded.aliases, last_run = excluded.last_run",
+                               [key + (get_main_slug(key[0]),) + page_rows[key] + (run, run) for key in changed_pages])
+        connection.executemany("INSERT INTO aliases VALUES (?, ?, ?, ?, ?) ON CONFLICT DO UPDATE "
+                               "SET last_run = excluded.last_run", added_aliases)
+    return run, len(removed_pages) + len(changed_pages) + len(removed_aliases) + len(added_aliases)
+
+
+# Foreverlinks from the history: {alias: canonical URI} for the aliases and the old canonical URIs of the pages that
+# no page claims anymore
+# An alias still redirects to its page when the page is live, or when its source file is still there under another
+# URI. The latest claim of an alias wins. `before_run`: only the rows not seen since this run (None = all).
+def get_historical_aliases(connection, manifest_files, before_run=None):
+    current_uris = {rel_src_filepath: entry['canonical_uri']
+                    for rel_src_filepath, entry in manifest_files.items() if not entry['draft']}
+    live_uris = set(current_uris.values())
+    claimed = {alias for entry in manifest_files.values() for alias in entry['aliases']}
+    claimed.update(uri.strip('/') for uri in live_uris)
+
+    condition = "" if before_run is None else f"WHERE last_run < {int(before_run)}"
+    rows = connection.execute(
+        f"SELECT alias, canonical_uri, rel_src_filepath, last_run FROM aliases {condition} "
+        f"UNION ALL SELECT TRIM(canonical_uri, '/'), canonical_uri, rel_src_filepath, last_run FROM pages {condition} "
+        f"ORDER BY last_run DESC")
+    historical_aliases = {}
+    for alias, canonical_uri, rel_src_filepath, last_run in rows:
+        if not alias or alias in claimed or alias in historical_aliases:
+            continue
+        target = canonical_uri if canonical_uri in live_uris else current_uris.get(rel_src_filepath)
+        if target is not None and target.strip('/') != alias:
+            historical_aliases[alias] = target
+    return historical_aliases
+
+
+# Rows of a query as dicts:
+def fetch_dicts(connection, sql, parameters=()):
+    cursor = connection.execute(sql, parameters)
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+# Lookups of `obsigo.py query`: rows with the dates of the first and last runs and `current` (seen in the last run)
+HISTORY_COLUMNS = ("first.started_at AS first_seen, last.started_at AS last_seen, "
+                   "t.last_run = (SELECT MAX(id) FROM runs) AS current FROM {table} t "
+                   "JOIN runs first ON first.id = t.first_run JOIN runs last ON last.id = t.last_run")
+
+
+def query_alias(connection, alias):
+    return fetch_dicts(connection,
+                       "SELECT t.alias, t.canonical_uri, t.rel_src_filepath, " + HISTORY_COLUMNS.format(table='aliases') +
+                       " WHERE t.alias = ? ORDER BY t.last_run DESC, t.rel_src_filepath", (alias,))
+
+
+def query_slug(connection, slug):
+    return fetch_dicts(connection,
+                       "SELECT t.slug, t.canonical_uri, t.rel_src_filepath, t.draft, " + HISTORY_COLUMNS.format(table='pages') +
+                       " WHERE t.slug = ? ORDER BY t.last_run DESC, t.rel_src_filepath", (slug,))
+
+
+# Page by source path, canonical URI, slug or alias: its URIs and slugs, then its aliases
+def query_page(connection, value):
+    uri = '/' + value.strip('/') + '/' if value.strip('/') else '/'
+    rel_src_filepaths = [row[0] for row in connection.execute(
+        "SELECT rel_src_filepath FROM pages WHERE rel_src_filepath = ? OR canonical_uri = ? OR slug = ? "
+        "UNION SELECT rel_src_filepath FROM aliases WHERE alias = ?", (value, uri, value, value))]
+    placeholders = ', '.join('?' * len(rel_src_filepaths))
+    rows = fetch_dicts(connection,
+                       "SELECT 'page' AS kind, t.rel_src_filepath, t.canonical_uri, t.slug AS value, t.draft, " +
+                       HISTORY_COLUMNS.format(table='pages') +
+                       f" WHERE t.rel_src_filepath IN ({placeholders}) ORDER BY t.rel_src_filepath, t.last_run DESC",
+                       rel_src_filepaths)
+    rows += fetch_dicts(connection,
+                        "SELECT 'alias' AS kind, t.rel_src_filepath, t.canonical_uri, t.alias AS value, NULL AS draft, " +
+                        HISTORY_COLUMNS.format(table='aliases') +
+                        f" WHERE t.rel_src_filepath IN ({placeholders}) ORDER BY t.rel_src_filepath, t.last_run DESC, t.alias",
+                        rel_src_filepaths)
+    return rows
+
+
+# Aliases claimed by several pages in the last run: `owner` is the page that gets the redirect (the first published
+# page in the order of the source paths, see add_site_aliases() in obsigo.py)
+def query_conflicts(connection):
+    last_run = get_last_run(connection)
+    rows = fetch_dicts(connection,
+                       "SELECT a.alias, a.canonical_uri, a.rel_src_filepath, p.draft FROM aliases a "
+                       "JOIN pages p ON p.rel_src_filepath = a.rel_src_filepath AND p.canonical_uri = a.canonical_uri "
+                       "WHERE a.last_run = ?1 AND p.last_run = ?1 AND a.alias IN "
+                       "(SELECT alias FROM aliases WHERE last_run = ?1 GROUP BY alias HAVING COUNT(*) > 1) "
+                       "ORDER BY a.alias, a.rel_src_filepath", (last_run,))
+    owners = {}
+    for row in rows:
+        if not row['draft']:
+            owners.setdefault(row['alias'], row['rel_src_filepath'])
+        row['owner'] = int(owners.get(row['alias']) == row['rel_src_filepath'])
+    return rows
+
+
+def query_index(connection, kind, value=None):
+    if kind == 'conflicts':
+        return query_conflicts(connection)
+    return {'alias': query_alias, 'page': query_page, 'slug': query_slug}[kind](connection, value)
+
+
+# Rows as a text table (tab separated, with a header line):
+def format_rows(rows):
+    if not rows:
+        return ''
+    columns = list(rows[0])
+    lines = ['\t'.join(columns)]
+    lines += ['\t'.join('' if row[column] is None else str(row[column]) for column in columns) for row in rows]
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,449 @@
+# Normalize the images of the destination directory for the web:
+# - Convert HEIC images to JPEG (obsigo already renames `.heic` to `.jpeg` in links and cover images)
+# - Convert images with a color profile other than sRGB to sRGB
+#
+# And generate the responsive variants of the images used by the pages (see generate_image_variants()): resized
+# copies and WebP/AVIF alternates, encoded once in a cache directory outside the destination and keyed by the hash of
+# the original, so a clean build or a new destination never encodes them again.
+#
+# Requires Pillow, plus pillow-heif for HEIC images:
+#   pip install pillow pillow-heif
+
+import os
+import io
+import re
+import json
+import logging
+import hashlib
+import concurrent.futures
+
+from obsigo_assets import copy_asset
+
+try:
+    from PIL import Image, ImageCms, ImageOps
+except ImportError:
+    Image = None
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+logger = logging.getLogger('obsigo.images')
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.heic')
+
+# JPEG quality used when an image has to be encoded again (ImageMagick's default)
+JPEG_QUALITY = 92
+
+IMAGES_CACHE_VERSION = 1
+
+# Images with variants (HEIC originals are published as JPEG)
+VARIANT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic')
+
+# Formats of the variants: (Pillow format, extension, MIME type)
+VARIANT_FORMATS = {
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'png': ('PNG', '.png', 'image/png'),
+    'webp': ('WEBP', '.webp', 'image/webp'),
+    'avif': ('AVIF', '.avif', 'image/avif'),
+}
+
+# Names of the variants (see generate_variants): the other files of the publish directory are left alone
+VARIANT_NAME_RE = re.compile(r'[0-9a-f]{32}-\d+w-q\d+('
+                             + '|'.join(re.escape(extension) for _, extension, _ in VARIANT_FORMATS.values()) + ')')
+
+VARIANTS_INDEX_VERSION = 1
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# The sRGB profile shipped with LittleCMS (through Pillow): no need for an ICC file from the OS
+def srgb_profile():
+    return ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB'))
+
+
+# Check if an embedded ICC profile is sRGB (no profile means sRGB for browsers)
+def is_srgb(icc_profile):
+    if not icc_profile:
+        return True
+    try:
+        profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+    except (OSError, ImageCms.PyCMSError):
+        return False
+    description = ImageCms.getProfileDescription(profile) or ''
+    return 'sRGB' in description
+
+
+# Write an image as an sRGB JPEG: the image is written to a temporary file first and then renamed, so the file is
+# replaced and not rewritten in place (it may be a hard link to the source file).
+def save_srgb_jpeg(image, output_path):
+    icc_profile = image.info.get('icc_profile')
+    exif = image.info.get('exif')
+    if icc_profile and not is_srgb(icc_profile):
+        source_profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        image = ImageCms.profileToProfile(image, source_profile, srgb_profile(), outputMode='RGB')
+    elif image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    save_options = {
+        'quality': JPEG_QUALITY,
+    }
+    # (an RGB profile can't be embedded in a grayscale JPEG)
+    if image.mode == 'RGB':
+        save_options['icc_profile'] = srgb_profile().tobytes()
+    if exif:
+        save_options['exif'] = exif
+    temp_path = os.path.join(os.path.dirname(output_path), '.' + os.path.basename(output_path) + '.obsigo-tmp')
+    image.save(temp_path, 'JPEG', **save_options)
+    os.replace(temp_path, output_path)
+
+
+# Normalize a single image (runs in a worker process):
+# Returns (action, output_path, output_hash) with action one of 'heic', 'srgb', 'unchanged' or 'error: ...'
+def normalize_image(path):
+    try:
+        if path.lower().endswith('.heic'):
+            if pillow_heif is None:
+                return "error: pillow-heif is needed to convert HEIC images (pip install pillow-heif)", path, None
+            output_path = os.path.splitext(path)[0] + '.jpeg'
+            with Image.open(path) as image:
+                save_srgb_jpeg(image, output_path)
+            os.remove(path)
+            return 'heic', output_path, file_hash(output_path)
+
+        with Image.open(path) as image:
+            if is_srgb(image.info.get('icc_profile')):
+                return 'unchanged', path, file_hash(path)
+            save_srgb_jpeg(image, path)
+        return 'srgb', path, file_hash(path)
+    except Exception as e:
+        return f"error: {e}", path, None
+
+
+def load_images_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        if cache.get('version') == IMAGES_CACHE_VERSION:
+            return cache
+    except (OSError, ValueError):
+        pass
+    return {'version': IMAGES_CACHE_VERSION, 'processed_hashes': [], 'files': {}}
+
+
+def save_images_cache(cache_file, cache):
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f)
+    except OSError as e:
+        logger.error(f"ERROR writing images cache file: {e}")
+
+
+# Normalize all the images found in a directory tree:
+# Files are identified by their content hash in the cache file, so an image that was already normalized is skipped
+# even if it was copied or moved since. (The size & mtime of each path are cached too, to avoid hashing unchanged
+# files.)
+# `record_change(change, file_path)` is called for each file 'added', 'changed' or 'removed'.
+# The images are processed on `executor` when given (the pool of a batch), else on a pool of `jobs` worker processes.
+# The cache can be shared by several destination directories (sites of a batch): the paths are absolute and the
+# entries of the other directories are kept.
+# Returns the stats of the run.
+def normalize_images(root, cache_file, jobs=1, record_change=None, executor=None):
+    stats = {'images_checked': 0, 'images_skipped': 0, 'images_heic_converted': 0, 'images_srgb_converted': 0,
+             'images_unchanged': 0, 'images_errors': 0}
+
+    if Image is None:
+        logger.error("ERROR: image processing needs Pillow: pip install pillow pillow-heif")
+        return stats
+
+    cache = load_images_cache(cache_file)
+    processed_hashes = set(cache['processed_hashes'])
+    files_cache = cache['files']
+    abs_root = os.path.join(os.path.abspath(root), '')
+    new_files_cache = {path: entry for path, entry in files_cache.items() if not path.startswith(abs_root)}
+
+    to_process = []
+    for dir_path, dirs, files in os.walk(root):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            if file.startswith('.') or not file.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(dir_path, file)
+            stats['images_checked'] += 1
+            stat = os.stat(path)
+            cached = files_cache.get(os.path.abspath(path))
+            if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                content_hash = cached[2]
+            else:
+                content_hash = file_hash(path)
+            if content_hash in processed_hashes:
+                stats['images_skipped'] += 1
+                new_files_cache[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, content_hash]
+                continue
+            to_process.append(path)
+
+    logger.info(f"Images: {stats['images_checked']} found, {stats['images_skipped']} already processed, {len(to_process)} to check.")
+
+    own_executor = None
+    if executor is None and jobs > 1 and len(to_process) > 1:
+        executor = own_executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    if executor is not None and len(to_process) > 1:
+        results = executor.map(normalize_image, to_process)
+    else:
+        results = map(normalize_image, to_process)
+
+    try:
+        for path, (action, output_path, output_hash) in zip(to_process, results):
+            if action.startswith('error'):
+                logger.error(f"!! ERROR processing {path}: {action[len('error: '):]}")
+                stats['images_errors'] += 1
+                continue
+            if action == 'heic':
+                logger.debug(f"Converted HEIC to JPEG with sRGB: {path} -> .jpeg")
+                stats['images_heic_converted'] += 1
+                if record_change is not None:
+                    record_change('removed', path)
+                    record_change('added', output_path)
+            elif action == 'srgb':
+                logger.debug(f"Converted to sRGB: {path}")
+                stats['images_srgb_converted'] += 1
+                if record_change is not None:
+                    record_change('changed', path)
+            else:
+                logger.debug(f"Skipping (already sRGB): {path}")
+                stats['images_unchanged'] += 1
+            processed_hashes.add(output_hash)
+            stat = os.stat(output_path)
+            new_files_cache[os.path.abspath(output_path)] = [stat.st_size, stat.st_mtime_ns, output_hash]
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+
+    cache['processed_hashes'] = sorted(processed_hashes)
+    cache['files'] = new_files_cache
+    save_images_cache(cache_file, cache)
+    return stats
+
+
+# ---
+# Responsive image variants
+#
+# For each image used by a page (markdown images and cover images), the variants are:
+# - the original format at each configured width smaller than the image (images are never enlarged)
+# - the alternate formats (WebP, AVIF) at the same widths and at the full size
+# They are encoded on a worker pool from the original in the vault into the cache directory, named after the hash of
+# the original, the width and the quality (`<hash>-<width>w-q<quality>.<ext>`), and published to a static directory of
+# the Hugo site with hard links. The variants of the images no page uses anymore are removed from the static directory
+# (the cache keeps them, it can be deleted at any time); the other files of the static directory are left alone.
+#
+# The templates find the variants of an image in the data file written by obsigo.py (images.json):
+#   {"pages": {page URI: {image URL in the page: image id}},
+#    "images": {image id: {"width", "height", "variants": [{"url", "width", "height", "type"}]}}}
+# For instance in a render-image hook:
+#   {{ with index site.Data.obsigo.images.pages .Page.RelPermalink }}{{ with index . $.Destination }}...
+
+
+def variant_settings_key(widths, formats, quality):
+    return f"{','.join(map(str, sorted(widths)))}/{','.join(formats)}/{quality}"
+
+
+# Convert an image to sRGB, in a mode that the formats of its variants can save:
+def prepare_variant_image(image, original_format):
+    image = ImageOps.exif_transpose(image)
+    icc_profile = image.info.get('icc_profile')
+    if icc_profile and not is_srgb(icc_profile):
+        source_profile = ImageCms.ImageCmsProfile(io.BytesIO(icc_profile))
+        # (the transform reads the pixels in the color space of the profile: CMYK, RGB or grayscale, a palette is RGB)
+        if image.mode not in ('RGB', 'RGBA', 'CMYK', 'L', 'LA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode == 'PA' else 'RGB')
+        if image.mode == 'LA':
+            alpha = image.getchannel('A')
+            image = ImageCms.profileToProfile(image.convert('L'), source_profile, srgb_profile(), outputMode='RGB')
+            image.putalpha(alpha)
+        else:
+            output_mode = 'RGBA' if image.mode == 'RGBA' else 'RGB'
+            image = ImageCms.profileToProfile(image, source_profile, srgb_profile(), outputMode=output_mode)
+    if original_format == 'jpeg':
+        return image.convert('RGB') if image.mode not in ('RGB', 'L') else image
+    if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+        return image.convert('RGBA' if 'transparency' in image.info or image.mode in ('PA', 'P') else 'RGB')
+    return image
+
+
+def save_variant(image, cache_path, variant_format, quality):
+    pillow_format = VARIANT_FORMATS[variant_format][0]
+    save_options = {} if variant_format == 'png' else {'quality': quality}
+    if variant_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    temp_path = cache_path + '.obsigo-tmp'
+    image.save(temp_path, pillow_format, **save_options)
+    os.replace(temp_path, cache_path)
+
+
+# Encode the missing variants of an image (runs in a worker process):
+# `job` is (path of the original, hash, widths, formats, quality, cache directory).
+# Returns the image info ({'width', 'height', 'variants': [{'file', 'width', 'height', 'format'}]}) and the number of
+# variants encoded, or an error message and None.
+def generate_variants(job):
+    path, digest, widths, formats, quality, cache_directory = job
+    try:
+        if path.lower().endswith('.heic') and pillow_heif is None:
+            return "error: pillow-heif is needed to read HEIC images (pip install pillow-heif)", None
+        original_format = {'.png': 'png', '.webp': 'webp'}.get(os.path.splitext(path)[1].lower(), 'jpeg')
+        encoded = 0
+        with Image.open(path) as original:
+            image = prepare_variant_image(original, original_format)
+            width, height = image.size
+            info = {'width': width, 'height': height, 'variants': []}
+            for variant_width in sorted({w for w in widths if w < width} | {width}):
+                variant_formats = [f for f in formats if f != original_format] if variant_width == width else \
+                    [original_format] + [f for f in formats if f != original_format]
+                variant_height = max(1, round(height * variant_width / width))
+                resized = None
+                for variant_format in variant_formats:
+                    name = f"{digest}-{variant_width}w-q{quality}{VARIANT_FORMATS[variant_format][1]}"
+                    cache_path = os.path.join(cache_directory, digest[:2], name)
+                    if not os.path.exists(cache_path):
+                        if resized is None:
+                            resized = image if variant_width == width else image.resize((variant_width, variant_height), Image.LANCZOS)
+                        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                        save_variant(resized, cache_path, variant_format, quality)
+                        encoded += 1
+                    info['variants'].append({'file': name, 'width': variant_width, 'height': variant_height,
+                                             'format': variant_format})
+        return info, encoded
+    except Exception as e:
+        return f"error: {e}", None
+
+
+def load_variants_index(cache_directory, settings_key):
+    try:
+        with open(os.path.join(cache_directory, 'index.json'), 'r') as f:
+            index = json.load(f)
+        if index.get('version') == VARIANTS_INDEX_VERSION:
+            if index.get('settings') != settings_key:
+                index.update(settings=settings_key, images={})
+            return index
+    except (OSError, ValueError):
+        pass
+    return {'version': VARIANTS_INDEX_VERSION, 'settings': settings_key, 'files': {}, 'images': {}}
+
+
+def save_variants_index(cache_directory, index):
+    temp_file = os.path.join(cache_directory, 'index.json.obsigo-tmp')
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_file, os.path.join(cache_directory, 'index.json'))
+    except OSError as e:
+        logger.error(f"ERROR writing image variants index: {e}")
+
+
+# Generate the variants of the images used by the pages and publish them:
+# `images` is {path of the original: [(page URI, image URL in the page)]}. The variants are published to
+# `publish_directory`, served at `publish_url`, and `record_change(change, file_path)` is called for each file
+# 'added' or 'removed' there. The variants are encoded on `executor` when given (the pool of a batch), else on a pool
+# of `jobs` worker processes.
+# Returns the data for the templates (see above) and the stats of the run.
+def generate_image_variants(images, widths, formats, quality, cache_directory, publish_directory, publish_url,
+                            jobs=1, record_change=None, executor=None):
+    stats = {'image_variants_sources': 0, 'image_variants_encoded': 0, 'image_variants_published': 0,
+             'image_variants_removed': 0, 'image_variants_errors': 0}
+    data = {'pages': {}, 'images': {}}
+    if Image is None:
+        logger.error("ERROR: image variants need Pillow: pip install pillow pillow-heif")
+        return data, stats
+
+    os.makedirs(cache_directory, exist_ok=True)
+    index = load_variants_index(cache_directory, variant_settings_key(widths, formats, quality))
+    new_files = {}
+    digests = {}
+    for path in sorted(images):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        cached = index['files'].get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            digest = cached[2]
+        else:
+            digest = file_hash(path)[:32]
+        new_files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        digests[path] = digest
+    stats['image_variants_sources'] = len(digests)
+
+    # The variants of an image are checked again if a file is missing from the cache (deleted...):
+    to_generate = {}
+    for path, digest in digests.items():
+        info = index['images'].get(digest)
+        if info is None or not all(os.path.exists(os.path.join(cache_directory, digest[:2], variant['file']))
+                                   for variant in info['variants']):
+            to_generate.setdefault(digest, path)
+    logger.info(f"Image variants: {len(digests)} images, {len(to_generate)} to encode.")
+
+    jobs_list = [(path, digest, widths, formats, quality, cache_directory) for digest, path in sorted(to_generate.items())]
+    own_executor = None
+    if executor is None and jobs > 1 and len(jobs_list) > 1:
+        executor = own_executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    if executor is not None and len(jobs_list) > 1:
+        results = executor.map(generate_variants, jobs_list)
+    else:
+        results = map(generate_variants, jobs_list)
+    failed = set()
+    try:
+        for (path, digest, *_), (info, encoded) in zip(jobs_list, results):
+            if encoded is None:
+                logger.error(f"!! ERROR generating the variants of {path}: {info[len('error: '):]}")
+                stats['image_variants_errors'] += 1
+                failed.add(digest)
+                continue
+            index['images'][digest] = info
+            stats['image_variants_encoded'] += encoded
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+
+    # Publish the variants (hard links to the cache) and remove the ones no page uses anymore:
+    os.makedirs(publish_directory, exist_ok=True)
+    published = set()
+    for path, digest in sorted(digests.items()):
+        if digest in failed:
+            continue
+        info = index['images'][digest]
+        data['images'][digest] = {
+            'width': info['width'],
+            'height': info['height'],
+            'variants': [{'url': publish_url.rstrip('/') + '/' + variant['file'], 'width': variant['width'],
+                          'height': variant['height'], 'type': VARIANT_FORMATS[variant['format']][2]}
+                         for variant in info['variants']],
+        }
+        for page_uri, image_url in images[path]:
+            data['pages'].setdefault(page_uri, {})[image_url] = digest
+        for variant in info['variants']:
+            published.add(variant['file'])
+            publish_path = os.path.join(publish_directory, variant['file'])
+            if not os.path.exists(publish_path):
+                cache_path = os.path.join(cache_directory, digest[:2], variant['file'])
+                copy_asset(cache_path, publish_path, os.path.getsize(cache_path), 'hardlink')
+                stats['image_variants_published'] += 1
+                if record_change is not None:
+                    record_change('added', publish_path)
+    for name in sorted(set(os.listdir(publish_directory)) - published):
+        if not VARIANT_NAME_RE.fullmatch(name):
+            continue
+        os.remove(os.path.join(publish_directory, name))
+        stats['image_variants_removed'] += 1
+        if record_change is not None:
+            record_change('removed', os.path.join(publish_directory, name))
+
+    index['files'] = {**index['files'], **new_files}
+    save_variants_index(cache_directory, index)
+    return data, stats
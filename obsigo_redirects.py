@@ -0,0 +1,418 @@
+#! python3
+# Compile the Netlify _redirects file and resolve URLs against it
+#
+# A rule is `from [query params] to [status][!] [conditions]` and the first matching rule wins. The rules generated
+# from the aliases are `*/alias uri 301`: any path ending with the alias. Unless the rule is forced (`301!`), a path
+# that is a live page is served as is and never redirected.
+#
+# The compiler normalizes and dedupes the rules, sorts the generated rules from the most specific to the least
+# specific, removes the rules that can never match, collapses redirect chains to a single hop and flags loops.
+#
+# The resolver checks URLs against the compiled rules with path tries, for instance all the old URLs of an access log:
+#   python3 obsigo_redirects.py static/_redirects access.log --live-dir public
+# (one URL, path or access log line per line, `-` = stdin)
+
+import os
+import re
+import sys
+import json
+import logging
+import argparse
+
+logger = logging.getLogger('obsigo.redirects')
+
+# Redirects followed before giving up (browsers give up after 20)
+MAX_HOPS = 10
+
+# Path of an access log line: "GET /path HTTP/1.1"
+ACCESS_LOG_PATH_RE = re.compile(r'"(?:GET|HEAD|POST) (\S+)')
+
+
+# Split a path into its segments (query string, fragment and empty segments are dropped):
+def split_path(path):
+    path = re.sub(r'^https?://[^/]*', '', path)
+    path = re.split(r'[?#]', path, 1)[0]
+    return [segment for segment in path.split('/') if segment]
+
+
+# Normalized form of a path used to compare paths: no trailing slash (like Netlify)
+def normalize_path(path):
+    return '/' + '/'.join(split_path(path))
+
+
+# Normalize an alias for a `*/alias` rule: no leading or trailing slash, no empty segments, spaces encoded
+# (a space would split the rule). Returns '' if nothing is left.
+def normalize_alias(alias):
+    return '/'.join(split_path(str(alias).strip().replace(' ', '%20')))
+
+
+class RedirectRule:
+
+    def __init__(self, source, destination, status='301', query=(), conditions=(), line=None):
+        self.source = source
+        self.destination = destination
+        self.status = status
+        self.query = list(query)
+        self.conditions = list(conditions)
+        self.line = line                # Original line of the base file (None for generated rules)
+        self.forced = status.endswith('!')
+        # Conditional rules (query parameters, country, role...) can't be checked locally
+        self.conditional = bool(self.query or self.conditions)
+
+        if source.startswith('*/') or source == '*':
+            self.kind = 'suffix'
+            self.segments = split_path(source[1:])
+        elif source.startswith('/') and source.endswith('/*') or source == '/*':
+            self.kind = 'prefix'
+            self.segments = split_path(source[:-1])
+        elif source.startswith('/'):
+            self.kind = 'exact'
+            self.segments = split_path(source)
+        else:
+            # Full URL (domain redirects...): never matched locally
+            self.kind = 'other'
+            self.segments = []
+
+    def text(self):
+        if self.line is not None:
+            return self.line
+        return ' '.join([self.source] + self.query + [self.destination, self.status] + self.conditions)
+
+
+# Parse a _redirects file: returns a list of RedirectRule and comment/blank lines (str) in order.
+def parse_redirects(text):
+    entries = []
+    for line in text.splitlines():
+        tokens = line.split()
+        if not tokens or tokens[0].startswith('#'):
+            entries.append(line)
+            continue
+        # Query parameters (key=value) come before the destination:
+        query = []
+        position = 1
+        while position < len(tokens) and '=' in tokens[position] and not tokens[position].startswith(('/', 'http')):
+            query.append(tokens[position])
+            position += 1
+        if position >= len(tokens):
+            logger.warning(f"!!!WARNING!!! Invalid redirect rule (no destination): {line}")
+            entries.append(line)
+            continue
+        destination = tokens[position]
+        status = '301'
+        conditions = tokens[position + 1:]
+        if conditions and re.match(r'\d{3}!?$', conditions[0]):
+            status = conditions.pop(0)
+        entries.append(RedirectRule(tokens[0], destination, status, query, conditions, line.strip()))
+    return entries
+
+
+class TrieNode:
+    __slots__ = ('children', 'placeholder', 'exact', 'splat')
+
+    def __init__(self):
+        self.children = {}
+        self.placeholder = None     # Child for a `:name` segment (matches any segment)
+        self.exact = None           # Index of the first rule ending here
+        self.splat = None           # Index of the first `/path/*` rule ending here (or `*/path` in the suffix trie)
+
+
+# Index the rules in two path tries to find the first matching rule of a path in O(path length):
+# - forward trie of the exact and `/prefix/*` rules (with `:placeholder` segments)
+# - trie of the reversed segments of the `*/suffix` rules
+class RedirectResolver:
+
+    def __init__(self, rules=(), live_paths=()):
+        self.rules = []
+        self.forward = TrieNode()
+        self.suffixes = TrieNode()
+        self.live_paths = {normalize_path(path) for path in live_paths}
+        for rule in rules:
+            self.add_rule(rule)
+
+    def add_rule(self, rule):
+        index = len(self.rules)
+        self.rules.append(rule)
+        if rule.conditional or rule.kind == 'other':
+            return
+        if rule.kind == 'suffix':
+            node = self.suffixes
+            for segment in reversed(rule.segments):
+                node = node.children.setdefault(segment, TrieNode())
+            if node.splat is None:
+                node.splat = index
+            return
+        node = self.forward
+        for segment in rule.segments:
+            if segment.startswith(':'):
+                if node.placeholder is None:
+                    node.placeholder = TrieNode()
+                node = node.placeholder
+            else:
+                node = node.children.setdefault(segment, TrieNode())
+        if rule.kind == 'prefix':
+            if node.splat is None:
+                node.splat = index
+        elif node.exact is None:
+            node.exact = index
+
+    # Find the first rule matching the segments of a path:
+    # Returns (rule index, {placeholder: value}) or None.
+    def match_segments(self, segments, forced_only=False):
+        best = None
+
+        def consider(index, params):
+            nonlocal best
+            if index is not None and (best is None or index < best[0]):
+                if not forced_only or self.rules[index].forced:
+                    best = (index, params)
+
+        def walk(node, position, params):
+            if node.splat is not None:
+                consider(node.splat, dict(params, splat='/'.join(segments[position:])))
+            if position == len(segments):
+                consider(node.exact, params)
+                return
+            child = node.children.get(segments[position])
+            if child is not None:
+                walk(child, position + 1, params)
+            if node.placeholder is not None:
+                walk(node.placeholder, position + 1, dict(params, **{'_' + str(position): segments[position]}))
+
+        walk(self.forward, 0, {})
+
+        node = self.suffixes
+        position = len(segments)
+        while node is not None:
+            if node.splat is not None:
+                consider(node.splat, {'splat': '/'.join(segments[:position])})
+            if position == 0:
+                break
+            position -= 1
+            node = node.children.get(segments[position])
+
+        return best
+
+    # Find the rule that redirects a path (taking the live pages into account):
+    def match(self, path):
+        return self.match_segments(split_path(path), forced_only=normalize_path(path) in self.live_paths)
+
+    # Destination of a rule for a path, with its placeholders replaced:
+    def destination(self, index, params):
+        rule = self.rules[index]
+        destination = rule.destination
+        if ':' not in destination:
+            return destination
+        values = {}
+        positions = [position for position, segment in enumerate(rule.segments) if segment.startswith(':')]
+        for position in positions:
+            values[rule.segments[position][1:]] = params.get('_' + str(position), '')
+        values['splat'] = params.get('splat', '')
+        return re.sub(r':(\w+)', lambda match: values.get(match.group(1), match.group()), destination)
+
+    # Follow the redirects of a URL: returns {url, status, destination, hops, loop}
+    def resolve(self, url):
+        result = {'url': url, 'status': None, 'destination': url, 'hops': 0, 'loop': False}
+        seen = {normalize_path(url)}
+        path = url
+        while True:
+            matched = self.match(path)
+            if matched is None:
+                return result
+            index, params = matched
+            rule = self.rules[index]
+            destination = self.destination(index, params)
+            if result['status'] is None:
+                result['status'] = rule.status
+            result['destination'] = destination
+            result['hops'] += 1
+            # Rewrites (200) and errors (404...) are not followed, nor external destinations
+            if not rule.status.startswith('30') or not destination.startswith('/'):
+                return result
+            normalized = normalize_path(destination)
+            if normalized in seen or result['hops'] > MAX_HOPS:
+                result['loop'] = True
+                return result
+            seen.add(normalized)
+            path = destination
+
+
+# Compile the rules of the _redirects file from the site aliases and the base redirects file:
+# `live_uris` are the canonical URIs of the published pages. If None, chains and loops are not checked (any page
+# would look like a redirect to itself).
+# Returns (text of the _redirects file, report)
+def compile_redirects(site_aliases_dict, base_text='', live_uris=None):
+    report = {'rules_in': 0, 'rules_out': 0, 'duplicates_removed': 0, 'never_match_removed': 0,
+              'chains_collapsed': 0, 'loops_detected': 0, 'live_conflicts': 0, 'invalid_removed': 0}
+    live_paths = {normalize_path(uri) for uri in live_uris} if live_uris is not None else set()
+
+    # Rules generated from the aliases, from the most specific (most segments) to the least specific:
+    generated_rules = []
+    for alias, uri in site_aliases_dict.items():
+        report['rules_in'] += 1
+        normalized_alias = normalize_alias(alias)
+        if not normalized_alias:
+            logger.warning(f"!!!WARNING!!! Empty alias '{alias}' for {uri}: it would redirect every page, skipping it.")
+            report['invalid_removed'] += 1
+            continue
+        # An alias that is the path of another live page never redirects that path: the page is served
+        if normalize_path(normalized_alias) in live_paths and normalize_path(normalized_alias) != normalize_path(uri):
+            logger.warning(f"!!!WARNING!!! Alias '{alias}' of {uri} is the path of a live page: that page wins.")
+            report['live_conflicts'] += 1
+        generated_rules.append(RedirectRule('*/' + normalized_alias, uri, '301'))
+    generated_rules.sort(key=lambda rule: (-len(rule.segments), rule.source))
+
+    entries = generated_rules + parse_redirects(base_text)
+    report['rules_in'] += sum(1 for entry in entries[len(generated_rules):] if isinstance(entry, RedirectRule))
+
+    # Remove the duplicates and the rules that can never match (an earlier rule matches everything they match):
+    resolver = RedirectResolver()
+    seen_rules = {}
+    compiled_entries = []
+    for entry in entries:
+        if not isinstance(entry, RedirectRule):
+            compiled_entries.append(entry)
+            continue
+        key = (entry.source, tuple(entry.query), tuple(entry.conditions))
+        if key in seen_rules:
+            first = seen_rules[key]
+            if (first.destination, first.status) == (entry.destination, entry.status):
+                report['duplicates_removed'] += 1
+            else:
+                logger.warning(f"!!!WARNING!!! Redirect rule can never match (same source as '{first.text()}'): {entry.text()}")
+                report['never_match_removed'] += 1
+            continue
+        covering_index = find_covering_rule(resolver, entry)
+        if covering_index is not None:
+            logger.warning(f"!!!WARNING!!! Redirect rule can never match (shadowed by '{resolver.rules[covering_index].text()}'): {entry.text()}")
+            report['never_match_removed'] += 1
+            continue
+        if entry.kind == 'exact' and not entry.forced and normalize_path(entry.source) in live_paths:
+            logger.warning(f"!!!WARNING!!! Redirect rule can never match (the page exists and is served): {entry.text()}")
+            report['never_match_removed'] += 1
+            continue
+        seen_rules[key] = entry
+        resolver.add_rule(entry)
+        compiled_entries.append(entry)
+
+    # Collapse the chains: each rule goes straight to the final destination
+    if live_uris is not None:
+        resolver.live_paths = live_paths
+        for rule in resolver.rules:
+            if rule.conditional or rule.kind == 'other' or not rule.status.startswith('30'):
+                continue
+            if not rule.destination.startswith('/') or ':' in rule.destination:
+                continue
+            result = resolver.resolve(rule.destination)
+            if result['loop'] or normalize_path(result['destination']) == normalize_path(rule.source):
+                logger.warning(f"!!!WARNING!!! Redirect loop: {rule.text()}")
+                report['loops_detected'] += 1
+            elif result['hops'] and result['status'].startswith('30'):
+                logger.debug(f"  Redirect chain collapsed: {rule.source} -> {rule.destination} -> {result['destination']}")
+                rule.destination = result['destination']
+                rule.line = None
+                report['chains_collapsed'] += 1
+
+    lines = [entry.text() if isinstance(entry, RedirectRule) else entry for entry in compiled_entries]
+    report['rules_out'] = sum(1 for entry in compiled_entries if isinstance(entry, RedirectRule))
+    text = ''.join(line + '\n' for line in lines)
+    return text, report
+
+
+# Find an earlier rule that matches every path matched by `rule` (so `rule` can never match):
+# Returns its index or None. Only literal patterns are checked.
+def find_covering_rule(resolver, rule):
+    if rule.conditional or rule.kind == 'other' or any(segment.startswith(':') for segment in rule.segments):
+        return None
+    if rule.kind == 'exact':
+        matched = resolver.match_segments(rule.segments)
+        return matched[0] if matched else None
+
+    covering_index = None
+    if rule.kind == 'prefix':
+        node = resolver.forward
+        for segment in [None] + rule.segments:
+            if segment is not None:
+                node = node.children.get(segment)
+                if node is None:
+                    break
+            if node.splat is not None:
+                covering_index = node.splat
+                break
+    else:
+        node = resolver.suffixes
+        for segment in [None] + list(reversed(rule.segments)):
+            if segment is not None:
+                node = node.children.get(segment)
+                if node is None:
+                    break
+            if node.splat is not None:
+                covering_index = node.splat
+                break
+        # `/*` matches everything
+        if covering_index is None and resolver.forward.splat is not None:
+            covering_index = resolver.forward.splat
+    return covering_index
+
+
+# Live paths of a built site (Hugo `public` directory): `x/index.html` is served as `/x/`
+def live_paths_from_directory(directory):
+    live_paths = set()
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            rel_path = os.path.relpath(os.path.join(root, file), directory).replace(os.sep, '/')
+            if file == 'index.html':
+                rel_path = os.path.dirname(rel_path)
+            live_paths.add('/' + rel_path)
+    return live_paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Resolve URLs against a _redirects file')
+    parser.add_argument('redirects_file', help='The _redirects file')
+    parser.add_argument('urls_file', nargs='?', default='-', help='URLs, paths or access log lines, one per line (default: stdin)')
+    parser.add_argument('--live-dir', help='Directory of the built site: its pages are served instead of being redirected')
+    parser.add_argument('--live', help='File listing the paths of the live pages, one per line')
+    parser.add_argument('--json', action='store_true', help='Output JSON instead of tab separated values')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    with open(args.redirects_file, 'r') as f:
+        rules = [entry for entry in parse_redirects(f.read()) if isinstance(entry, RedirectRule)]
+    live_paths = set()
+    if args.live_dir:
+        live_paths |= live_paths_from_directory(args.live_dir)
+    if args.live:
+        with open(args.live, 'r') as f:
+            live_paths |= {line.strip() for line in f if line.strip()}
+    resolver = RedirectResolver(rules, live_paths)
+
+    urls_file = sys.stdin if args.urls_file == '-' else open(args.urls_file, 'r')
+    urls = []
+    for line in urls_file:
+        match = ACCESS_LOG_PATH_RE.search(line)
+        url = match.group(1) if match else line.strip()
+        if url and not url.startswith('#'):
+            urls.append(url)
+
+    results = [resolver.resolve(url) for url in dict.fromkeys(urls)]
+    if args.json:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        for result in results:
+            columns = [result['url'], result['status'] or '-', result['destination'], str(result['hops'])]
+            if result['loop']:
+                columns.append('LOOP')
+            print('\t'.join(columns))
+
+    summary = {
+        'urls': len(results),
+        'redirected': sum(1 for result in results if result['status'] is not None and result['status'].startswith('30')),
+        'not_redirected': sum(1 for result in results if result['status'] is None),
+        'multiple_hops': sum(1 for result in results if result['hops'] > 1 and not result['loop']),
+        'loops': sum(1 for result in results if result['loop']),
+    }
+    print(', '.join(f"{key}: {value}" for key, value in summary.items()), file=sys.stderr)
+    if summary['loops']:
+        sys.exit(1)
@@ -0,0 +1,213 @@
+# User rewrite rules: the `rewrite_rules` of obsigo.yaml
+#
+# A rule rewrites what its regular expression matches in the markdown content of the pages:
+#
+#   rewrite_rules:
+#     - name: wikilink                      # Name of the rule in the stats (rewrite_rule_<name>)
+#       pattern: '\[\[(?P<page>[^\]|]+)\]\]'
+#       template: '[$page]({{< ref "$page" >}})'
+#
+# - `replacement` is a regular expression template (\1, \g<name>) and `template` a `$name` template (named groups
+#   of the pattern and `$match` for the whole match, see string.Template), so Hugo shortcodes don't need escaping.
+# - `flags`: any of IGNORECASE, MULTILINE, DOTALL and VERBOSE.
+# - `in_code`: also rewrite code blocks and inline code spans (false by default: code is copied as is).
+# - `target`: 'dest' (default) only rewrites the Hugo content, 'source' also rewrites the source file in the vault.
+#
+# The rules are not applied one after the other: they are compiled with the built-in conversions into the single
+# scanner of obsigo.py (before the built-ins), so a document is scanned once whatever the number of rules. The text
+# produced by a rule is not scanned again. When several rules match at the same position, the first one in the config
+# wins.
+# Rules starting with a literal character (like `\[\[` or `TODO`) are the cheapest: they are grouped by this
+# character behind a single check, so a large rule set costs about the same as a small one. The other rules (starting
+# with a character class, a group, IGNORECASE on a non-letter...) are tried one after the other at every position.
+
+import re
+import string
+
+# What a rule rewrites: the Hugo content only or the source file too
+RULE_TARGETS = ('dest', 'source')
+
+RULE_FLAGS = {
+    'IGNORECASE': ('i', re.IGNORECASE),
+    'MULTILINE': ('m', re.MULTILINE),
+    'DOTALL': ('s', re.DOTALL),
+    'VERBOSE': ('x', re.VERBOSE),
+}
+
+# Flags at the start of a pattern like `(?im)`
+INLINE_FLAGS_RE = re.compile(r'\(\?([imsx]+)\)')
+
+# Tokens of a pattern: escapes, character classes, group openings with a name or a reference, single characters
+PATTERN_TOKENS_RE = re.compile(r'\\.|\[\^?\]?(?:\\.|[^\\\]])*\]|\(\?P<\w+>|\(\?P=|\(\?\(|.', re.DOTALL)
+
+
+# Same pattern without capturing groups, so that it can be an alternative of the scanner whatever its groups:
+# (the groups are only needed to expand the replacement, with the regular expression of the rule alone)
+def strip_groups(pattern):
+    tokens = PATTERN_TOKENS_RE.findall(pattern)
+    output = []
+    for i, token in enumerate(tokens):
+        if re.fullmatch(r'\\[1-9]', token):
+            raise ValueError("backreferences (\\1) are not supported")
+        if token in ('(?P=', '(?('):
+            raise ValueError("backreferences (?P=name) are not supported")
+        if token.startswith('(?P<') or (token == '(' and tokens[i+1:i+2] != ['?']):
+            output.append('(?:')
+        else:
+            output.append(token)
+    return ''.join(output)
+
+
+# First character of every match of a pattern without groups, when it is a literal character:
+# Returns the character and the rest of the pattern, or None.
+def split_first_literal(pattern):
+    tokens = PATTERN_TOKENS_RE.findall(pattern)
+    if not tokens:
+        return None
+    first = tokens[0]
+    if len(first) == 2 and first[0] == '\\' and not first[1].isalnum():
+        char = first[1]
+    elif len(first) == 1 and first not in '.^$*+?{}[]\\|()':
+        char = first
+    else:
+        return None
+    # (the character may be optional)
+    if tokens[1:2] and tokens[1] in ('*', '+', '?', '{'):
+        return None
+    # (or only start one of the alternatives)
+    depth = 0
+    for token in tokens:
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif token == '|' and depth == 0:
+            return None
+    return char, pattern[len(first):]
+
+
+# Compile the `rewrite_rules` of the config:
+# Returns the rules as dicts, each with its own `regex`, the `scanner_pattern` of its alternative in the scanner (and
+# its `first_chars` and the `scanner_rest` after them when it starts with a literal character) and the `stat` key of
+# its hit counter. Raises ValueError for an invalid rule.
+def compile_rewrite_rules(rules_config):
+    rules = []
+    names = set()
+    for index, rule_config in enumerate(rules_config or []):
+        name = str(rule_config.get('name', index + 1))
+        try:
+            if not re.fullmatch(r'[\w.-]+', name):
+                raise ValueError("the name can only contain letters, digits, '_', '.' and '-'")
+            if name in names:
+                raise ValueError("duplicate name")
+            names.add(name)
+            if ('replacement' in rule_config) == ('template' in rule_config):
+                raise ValueError("needs either a `replacement` or a `template`")
+            target = rule_config.get('target', 'dest')
+            if target not in RULE_TARGETS:
+                raise ValueError(f"invalid target '{target}', must be one of: {', '.join(RULE_TARGETS)}")
+
+            pattern = str(rule_config['pattern'])
+            flag_letters = ''
+            flags = 0
+            inline_flags = INLINE_FLAGS_RE.match(pattern)
+            if inline_flags:
+                flag_letters = inline_flags.group(1)
+                pattern = pattern[inline_flags.end():]
+            for flag_name in rule_config.get('flags', []):
+                if flag_name not in RULE_FLAGS:
+                    raise ValueError(f"invalid flag '{flag_name}', must be one of: {', '.join(RULE_FLAGS)}")
+                flag_letters += RULE_FLAGS[flag_name][0]
+            for letter, flag in RULE_FLAGS.values():
+                if letter in flag_letters:
+                    flags |= flag
+            flag_letters = ''.join(sorted(set(flag_letters)))
+
+            regex = re.compile(pattern, flags)
+            scanner_pattern = strip_groups(pattern)
+            if re.compile(scanner_pattern, flags).groups:
+                raise ValueError("unsupported group syntax")
+            first_literal = None if 'x' in flag_letters else split_first_literal(scanner_pattern)
+            if first_literal is None:
+                first_chars = []
+                scanner_rest = None
+            else:
+                char, scanner_rest = first_literal
+                first_chars = sorted({char.lower(), char.upper()}) if 'i' in flag_letters else [char]
+            if flag_letters:
+                scanner_pattern = f"(?{flag_letters}:{scanner_pattern})"
+                if scanner_rest is not None:
+                    scanner_rest = f"(?{flag_letters}:{scanner_rest})"
+            # Check the replacement now rather than on the first match:
+            if 'template' in rule_config:
+                template = string.Template(str(rule_config['template']))
+                try:
+                    template.substitute(dict.fromkeys(regex.groupindex, ''), match='')
+                except KeyError as e:
+                    raise ValueError(f"unknown template placeholder {e}")
+            else:
+                template = None
+                regex.sub(str(rule_config['replacement']), '')
+        except KeyError as e:
+            raise ValueError(f"Rewrite rule '{name}': missing {e}")
+        except (ValueError, re.error) as e:
+            raise ValueError(f"Rewrite rule '{name}': {e}")
+
+        rules.append({
+            'name': name,
+            'stat': f"rewrite_rule_{name}",
+            'regex': regex,
+            'scanner_pattern': scanner_pattern,
+            'first_chars': first_chars,
+            'scanner_rest': scanner_rest,
+            'replacement': None if template else str(rule_config['replacement']),
+            'template': template,
+            'in_code': bool(rule_config.get('in_code', False)),
+            'target': target,
+        })
+    return rules
+
+
+# Alternative of the scanner matching any of the rules (None without rules):
+# The rules starting with a literal character are grouped by this character behind a single character class check,
+# so most positions are rejected at once. Which rule matched is found by match_rules().
+def rules_scanner_pattern(rules):
+    rests_by_char = {}
+    alternatives = []
+    for rule in rules:
+        for char in rule['first_chars']:
+            rests_by_char.setdefault(char, []).append(rule['scanner_rest'])
+        if not rule['first_chars']:
+            alternatives.append(rule['scanner_pattern'])
+    if rests_by_char:
+        chars = ''.join(re.escape(char) for char in rests_by_char)
+        branches = '|'.join(f"{re.escape(char)}(?:{'|'.join(rests)})" for char, rests in rests_by_char.items())
+        alternatives.insert(0, f"(?=[{chars}])(?:{branches})")
+    return '|'.join(alternatives) or None
+
+
+# Rules that may match at a position, by the character at this position (None: any other character):
+def index_rules(rules):
+    chars = {char for rule in rules for char in rule['first_chars']}
+    rules_index = {char: [rule for rule in rules if char in rule['first_chars'] or not rule['first_chars']]
+                   for char in chars}
+    rules_index[None] = [rule for rule in rules if not rule['first_chars']]
+    return rules_index
+
+
+# First rule (in the order of the config) matching at `pos` in `content`, where the scanner found that one matches:
+# Returns the rule and its match.
+def match_rules(rules_index, content, pos):
+    for rule in rules_index.get(content[pos:pos+1], rules_index[None]):
+        match = rule['regex'].match(content, pos)
+        if match:
+            return rule, match
+    raise ValueError(f"No rewrite rule matches at {pos}")
+
+
+# Replacement of a rule match:
+def expand_rule(rule, match):
+    if rule['template'] is not None:
+        values = {name: value or '' for name, value in match.groupdict().items()}
+        return rule['template'].substitute(values, match=match.group())
+    return match.expand(rule['replacement'])
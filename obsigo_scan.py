@@ -0,0 +1,149 @@
+# Scan the source directory (vault) for the markdown files and the _assets directories
+#
+# Directories are listed with os.scandir() and the hidden (.obsidian, .trash, .git...) or ignored ones are pruned
+# before descending into them. The ignore patterns use the gitignore syntax:
+#
+# - `ignore:` in obsigo.yaml, then the lines of `.obsigoignore` at the root of the source directory
+# - `name` matches at any depth, `dir/name` and `/name` are relative to the source directory
+# - `*`, `?`, `[abc]` don't match `/`, `**/` matches any number of directories and `/**` everything inside
+# - a trailing `/` only matches directories, `!pattern` includes again what a previous pattern excluded (but never
+#   the content of an excluded directory), `#` starts a comment
+#
+# The markdown files come with their stat result and the _assets directories with the stat results of their files,
+# so the later stages don't need to stat them again.
+
+import os
+import re
+import logging
+
+logger = logging.getLogger('obsigo.scan')
+
+IGNORE_FILE = '.obsigoignore'
+
+
+# Regular expression of a gitignore pattern:
+# Returns (regex, negate, directories only) or None for a blank line or a comment.
+def compile_ignore_pattern(pattern):
+    pattern = pattern.rstrip('\n').rstrip(' ')
+    if not pattern or pattern.startswith('#'):
+        return None
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\'):
+        pattern = pattern[1:]
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    # A pattern with a `/` (except at the end) is relative to the root
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            parts.append('/.*')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i+2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i+1:end].replace('\\', '\\\\').replace('[', '\\[')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[' + chars + ']')
+            i = end + 1
+        elif pattern[i] == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    regex = re.compile(('' if anchored else '(?:.*/)?') + ''.join(parts) + r'\Z', re.DOTALL)
+    return regex, negate, dir_only
+
+
+# Ignore patterns of the config and of the `.obsigoignore` file of the source directory, compiled:
+def load_ignore_patterns(source_directory, config_patterns=None):
+    lines = list(config_patterns or [])
+    try:
+        with open(os.path.join(source_directory, IGNORE_FILE), 'r', encoding='utf-8') as f:
+            lines += f.read().splitlines()
+    except FileNotFoundError:
+        pass
+    return [pattern for pattern in map(compile_ignore_pattern, lines) if pattern is not None]
+
+
+# Check a path relative to the source directory against the ignore patterns:
+# The last matching pattern wins.
+def is_ignored(ignore_patterns, rel_path, is_dir):
+    rel_path = rel_path.replace(os.sep, '/')
+    ignored = False
+    for regex, negate, dir_only in ignore_patterns:
+        if (is_dir or not dir_only) and regex.match(rel_path):
+            ignored = not negate
+    return ignored
+
+
+# Scan the source directory:
+# Yields ('markdown', relative path, path, stat result) for each markdown file and
+# ('assets', relative path, path, {filename: stat result}) for each _assets directory (not descended into).
+# Hidden directories and ignored paths are skipped, and counted in stats_dict['source_paths_ignored'].
+def scan_source_directory(source_directory, ignore_patterns=(), stats_dict=None):
+    pending = ['']
+    while pending:
+        rel_dir = pending.pop()
+        dir_path = os.path.join(source_directory, rel_dir) if rel_dir else source_directory
+        try:
+            with os.scandir(dir_path) as entries:
+                entries = list(entries)
+        except OSError as e:
+            logger.warning(f"!!!WARNING!!! Can't read directory {dir_path}: {e}")
+            continue
+
+        subdirs = []
+        for entry in entries:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if not is_dir and not entry.name.endswith('.md'):
+                continue
+            rel_path = os.path.join(rel_dir, entry.name)
+            if (is_dir and entry.name.startswith('.')) or (ignore_patterns and is_ignored(ignore_patterns, rel_path, is_dir)):
+                logger.debug(f"Skipping: {rel_path}")
+                if stats_dict is not None:
+                    stats_dict['source_paths_ignored'] += 1
+                continue
+            if is_dir:
+                subdirs.append((rel_path, entry))
+            elif entry.is_file():
+                yield 'markdown', rel_path, entry.path, entry.stat()
+
+        for rel_path, entry in subdirs:
+            if entry.name == '_assets':
+                yield 'assets', rel_path, entry.path, scan_assets_directory(entry.path, rel_path, ignore_patterns, stats_dict)
+            else:
+                pending.append(rel_path)
+
+
+# Stat results of the files of an _assets directory (not ignored): {filename: stat result}
+def scan_assets_directory(path, rel_path, ignore_patterns, stats_dict):
+    files = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if ignore_patterns and is_ignored(ignore_patterns, os.path.join(rel_path, entry.name), False):
+                if stats_dict is not None:
+                    stats_dict['source_paths_ignored'] += 1
+                continue
+            files[entry.name] = entry.stat()
+    return files
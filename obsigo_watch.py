@@ -0,0 +1,187 @@
+# Watch a source directory tree for changes (used by `obsigo --watch`)
+# Uses inotify on Linux and falls back to polling everywhere else.
+
+import os
+import sys
+import time
+import errno
+import logging
+import select
+import struct
+import ctypes
+import ctypes.util
+
+logger = logging.getLogger('obsigo.watch')
+
+# inotify event masks (see `man inotify`)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+EVENT_HEADER = struct.Struct('iIII')
+
+
+# Hidden directories (.obsidian, .trash, .git...) are never watched: Obsidian writes to .obsidian/workspace.json
+# all the time.
+def is_hidden(name):
+    return name.startswith('.')
+
+
+# Watch a directory tree with Linux inotify (through libc, no extra dependency):
+class InotifyWatcher:
+
+    def __init__(self, root):
+        self.root = root
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched_dirs = {}      # watch descriptor -> directory path
+        self.add_tree(root)
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "inotify watch limit reached (see /proc/sys/fs/inotify/max_user_watches)")
+            # The directory may have disappeared in the meantime
+            return
+        self.watched_dirs[wd] = path
+
+    def add_tree(self, path):
+        self.add_watch(path)
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            for d in dirs:
+                self.add_watch(os.path.join(root, d))
+
+    # Read the pending events. Returns the list of changed paths, or None if events were lost (queue overflow)
+    def read_events(self):
+        changed_paths = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed_paths
+            overflow = False
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset+length].rstrip(b'\0'))
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    self.watched_dirs.pop(wd, None)
+                    continue
+                dir_path = self.watched_dirs.get(wd)
+                if dir_path is None or is_hidden(name):
+                    continue
+                path = os.path.join(dir_path, name) if name else dir_path
+                # New (or moved in) sub directory: watch it too
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                changed_paths.append(path)
+            if overflow:
+                return None
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        return bool(readable)
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Watch a directory tree by comparing the mtime & size of all files at regular intervals:
+class PollingWatcher:
+
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.take_snapshot()
+        self.pending_paths = []
+
+    def take_snapshot(self):
+        snapshot = {}
+        for root, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not is_hidden(d)]
+            for file in files:
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def read_events(self):
+        changed_paths = self.pending_paths
+        self.pending_paths = []
+        return changed_paths
+
+    def wait(self, timeout):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            new_snapshot = self.take_snapshot()
+            changed_paths = [path for path in new_snapshot.keys() | self.snapshot.keys()
+                             if new_snapshot.get(path) != self.snapshot.get(path)]
+            self.snapshot = new_snapshot
+            if changed_paths:
+                self.pending_paths.extend(changed_paths)
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            delay = self.interval if deadline is None else min(self.interval, max(0, deadline - time.monotonic()))
+            time.sleep(delay)
+
+    def close(self):
+        pass
+
+
+# Make the best watcher available on this system:
+def make_watcher(root, poll_interval=1.0):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"Cannot use inotify ({e}), falling back to polling.")
+    return PollingWatcher(root, poll_interval)
+
+
+# Block until something changes, then wait until nothing has changed for `debounce` seconds so that a burst of
+# changes (Obsidian autosaves, renames of a whole folder...) is handled as a single batch.
+# Returns the set of changed paths, or None if the watcher lost track and everything must be checked.
+def wait_for_changes(watcher, debounce=0.3):
+    changed_paths = set()
+    lost_events = False
+    timeout = None
+    while watcher.wait(timeout):
+        events = watcher.read_events()
+        if events is None:
+            lost_events = True
+        else:
+            changed_paths.update(events)
+        timeout = debounce
+    return None if lost_events else changed_paths
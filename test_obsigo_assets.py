@@ -0,0 +1,93 @@
+#! python3
+# Tests of the destination _assets pruning of obsigo.py, on a small site in a temporary directory
+#
+#   python3 -m unittest test_obsigo_assets      (or: python3 -m pytest test_obsigo_assets.py)
+
+import os
+import json
+import logging
+import tempfile
+import unittest
+
+import obsigo
+
+CONFIG = """\
+source_directory: ./vault
+destination_directory: ./content
+src_redirects_base_file: ./base.txt
+dest_redirects_file: ./static/_redirects
+unimportant_frontmatter_keys: []
+hugo_data_directory: ./data
+ignore: [drafts/]
+"""
+
+
+class PruneAssetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved_cwd = os.getcwd()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.temp_dir.name)
+        with open('obsigo.yaml', 'w') as f:
+            f.write(CONFIG)
+        for section in ('blog', 'notes'):
+            self.write(f"vault/{section}/page.md", f"---\ntitle: {section}\n---\n![pic](_assets/pic.jpg)\n")
+            self.write(f"vault/{section}/_assets/pic.jpg", 'jpeg')
+            self.write(f"vault/{section}/_assets/old.txt", 'text')
+
+    def tearDown(self):
+        os.chdir(self.saved_cwd)
+        self.temp_dir.cleanup()
+
+    def write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+
+    def run_obsigo(self, *args):
+        self.assertEqual(obsigo.main(['-q', *args]), 0)
+        logging.getLogger().handlers.clear()
+        with open('obsigo_report.json') as f:
+            return json.load(f)
+
+    def check_removed_assets_directory(self, *args):
+        self.run_obsigo('-k')
+        self.assertTrue(os.path.exists('content/blog/_assets/pic.jpg'))
+        os.remove('vault/blog/_assets/pic.jpg')
+        os.remove('vault/blog/_assets/old.txt')
+        os.rmdir('vault/blog/_assets')
+        stats = self.run_obsigo(*args)
+        self.assertEqual(stats['assets_files_pruned'], 2)
+        self.assertFalse(os.path.exists('content/blog/_assets'))
+        self.assertTrue(os.path.exists('content/notes/_assets/pic.jpg'))
+        with open('obsigo_changes.json') as f:
+            self.assertIn(os.path.normpath('content/blog/_assets/pic.jpg'), json.load(f)['removed'])
+
+    def test_removed_assets_directory_keep(self):
+        self.check_removed_assets_directory('-k')
+
+    def test_removed_assets_directory_incremental(self):
+        self.check_removed_assets_directory('-u')
+
+    def test_removed_assets_file(self):
+        self.run_obsigo('-k')
+        os.remove('vault/blog/_assets/old.txt')
+        stats = self.run_obsigo('-u')
+        self.assertEqual(stats['assets_files_pruned'], 1)
+        self.assertFalse(os.path.exists('content/blog/_assets/old.txt'))
+        self.assertTrue(os.path.exists('content/blog/_assets/pic.jpg'))
+
+    def test_out_of_scope_and_ignored_directories_kept(self):
+        self.write('content/drafts/_assets/draft.jpg', 'jpeg')
+        self.run_obsigo('-k')
+        os.remove('vault/notes/_assets/pic.jpg')
+        os.remove('vault/notes/_assets/old.txt')
+        os.rmdir('vault/notes/_assets')
+        stats = self.run_obsigo('-k', '--only', 'blog')
+        self.assertEqual(stats['assets_files_pruned'], 0)
+        self.assertTrue(os.path.exists('content/notes/_assets/pic.jpg'))
+        self.assertTrue(os.path.exists('content/drafts/_assets/draft.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+#! python3
+# Tests of the URL checker of obsigo_audit.py against a stub HTTP server on 127.0.0.1
+#
+#   python3 -m unittest test_obsigo_audit      (or: python3 -m pytest test_obsigo_audit.py)
+
+import os
+import time
+import asyncio
+import tempfile
+import threading
+import unittest
+import http.server
+
+from obsigo_audit import check_urls_async, check_urls
+
+# Time the slow endpoints of the stub server take to answer
+SLOW_SECONDS = 2.0
+DELAY_SECONDS = 0.3
+
+
+# Stub server: /ok (200), /missing (404), /moved (301 to /ok), /no-head (405 for HEAD, 200 for GET),
+# /delay (200 after DELAY_SECONDS) and /slow (200 after SLOW_SECONDS)
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.answer(with_body=False)
+
+    def do_GET(self):
+        self.answer(with_body=True)
+
+    def answer(self, with_body):
+        path = self.path.split('?')[0]
+        if path == '/slow':
+            time.sleep(SLOW_SECONDS)
+        elif path == '/delay':
+            time.sleep(DELAY_SECONDS)
+        if path == '/moved':
+            status, headers = 301, {'Location': '/ok'}
+        elif path == '/no-head' and not with_body:
+            status, headers = 405, {}
+        elif path in ('/ok', '/no-head', '/delay', '/slow'):
+            status, headers = 200, {}
+        else:
+            status, headers = 404, {}
+        body = f"{status}\n".encode('ascii')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if with_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # (the checker closes the connections of the requests that time out)
+        pass
+
+
+class CheckUrlsTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer(('127.0.0.1', 0), StubHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def check(self, paths, concurrency=10, per_host=2, timeout=5.0):
+        return asyncio.run(check_urls_async([self.base_url + path for path in paths], concurrency, per_host, timeout))
+
+    def test_statuses(self):
+        results = self.check(['/ok', '/missing', '/no-head'])
+        self.assertEqual(results[self.base_url + '/ok']['status'], 200)
+        self.assertEqual(results[self.base_url + '/missing']['status'], 404)
+        # (GET when HEAD is not allowed)
+        self.assertEqual(results[self.base_url + '/no-head']['status'], 200)
+        for result in results.values():
+            self.assertIsNone(result['error'])
+
+    def test_redirect_followed(self):
+        result = self.check(['/moved'])[self.base_url + '/moved']
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['final_url'], self.base_url + '/ok')
+
+    def test_slow_request_times_out(self):
+        start = time.perf_counter()
+        result = self.check(['/slow'], timeout=0.5)[self.base_url + '/slow']
+        self.assertIsNone(result['status'])
+        self.assertEqual(result['error'], "timeout after 0.5s")
+        self.assertLess(time.perf_counter() - start, SLOW_SECONDS)
+
+    def test_waiting_for_the_host_is_not_timed(self):
+        # One request at a time to the host: the last one waits 3 * DELAY_SECONDS for its turn, more than the timeout
+        results = self.check([f"/delay?{i}" for i in range(4)], per_host=1, timeout=DELAY_SECONDS + 0.5)
+        for url, result in results.items():
+            self.assertEqual(result['status'], 200, f"{url}: {result['error']}")
+
+    def test_cached_results(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache_file = os.path.join(temp_dir, 'cache.json')
+            urls = [self.base_url + '/ok', self.base_url + '/missing']
+            results, checked_count = check_urls(urls, cache_file, 3600)
+            self.assertEqual(checked_count, 2)
+            self.assertEqual(results[self.base_url + '/missing']['status'], 404)
+            results, checked_count = check_urls(urls, cache_file, 3600)
+            self.assertEqual(checked_count, 0)
+            self.assertEqual(results[self.base_url + '/ok']['status'], 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
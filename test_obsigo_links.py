@@ -0,0 +1,79 @@
+#! python3
+# Tests of the markdown scanner of obsigo.py (process_links()) against the golden corpus of test_corpus/links:
+# each `<case>.md` is converted and compared with `<case>.hugo.md`. The source content must be left unchanged (no
+# rewrite rules). A deliberate change of the output updates the `.hugo.md` files in the same commit.
+#
+#   python3 -m unittest test_obsigo_links      (or: python3 -m pytest test_obsigo_links.py)
+
+import os
+import glob
+import unittest
+
+import obsigo
+
+CORPUS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_corpus', 'links')
+
+CONFIG = {
+    'source_directory': './vault',
+    'destination_directory': './content',
+    'src_redirects_base_file': './base.txt',
+    'dest_redirects_file': './static/_redirects',
+    'unimportant_frontmatter_keys': [],
+}
+
+
+def read_file(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+class ProcessLinksTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.converter = obsigo.Converter(CONFIG)
+
+    def convert(self, case):
+        content = read_file(os.path.join(CORPUS_DIRECTORY, f"{case}.md"))
+        stats_dict = obsigo.new_stats_dict()
+        source_content, hugo_content = obsigo.process_links(self.converter, content, f"{case}.md", stats_dict)
+        self.assertEqual(source_content, content)
+        return hugo_content, stats_dict
+
+    def test_corpus(self):
+        cases = sorted(os.path.basename(path)[:-len('.md')] for path in glob.glob(os.path.join(CORPUS_DIRECTORY, '*.md'))
+                       if not path.endswith('.hugo.md'))
+        self.assertTrue(cases)
+        for case in cases:
+            with self.subTest(case=case):
+                hugo_content, _ = self.convert(case)
+                self.assertEqual(hugo_content, read_file(os.path.join(CORPUS_DIRECTORY, f"{case}.hugo.md")))
+
+    # The fixes of the single pass scanner, each checked on its own:
+
+    def test_code_is_not_rewritten(self):
+        hugo_content, stats_dict = self.convert('code_spans')
+        self.assertIn('`[x](a/index.md)`, `#tag`, `==mark==` and `![i](p.heic)`', hugo_content)
+        self.assertIn('[x](a/index.md) #tag ==mark== ![i](p.heic)\n', hugo_content)
+        self.assertEqual(stats_dict['links_removed_index.md'], 1)
+
+    def test_hashtag_prefix_of_another(self):
+        hugo_content, _ = self.convert('hashtag_prefix')
+        self.assertIn('[#world-two](/tags/world-two/)', hugo_content)
+        self.assertNotIn('[#world](/tags/world/)-two', hugo_content)
+
+    def test_identical_links_rewritten_in_place(self):
+        hugo_content, stats_dict = self.convert('duplicate_links')
+        self.assertIn('![Pic](_assets/pic.jpeg "First")\n![Pic](_assets/pic.jpeg "Second")', hugo_content)
+        self.assertIn('[Page](blog/) `[Page](blog/index.md)` [Page](blog/)', hugo_content)
+        self.assertEqual(stats_dict['links_removed_index.md'], 2)
+
+    def test_image_embed_after_bracket(self):
+        hugo_content, stats_dict = self.convert('youtube')
+        self.assertIn('[{{< youtube XyZ-9 >}}](https://example.com/video)', hugo_content)
+        self.assertIn('[![Logo](_assets/logo.jpeg)](https://example.com)', hugo_content)
+        self.assertEqual(stats_dict['youtube_links_converted'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()